@@ -14,21 +14,91 @@ Giulio Del Corso and Simon Kanka
 
 #%% Libraries
 import os
+import time
+import webbrowser
+import multiprocessing
 import customtkinter
 
 # Tkinter to define the GUI
 from tkinter import filedialog
 from tkinter import Menu
+from tkinter import StringVar
+from tkinter import Listbox
+from tkinter import BooleanVar
 
 # Aux libraries to analyze the signal
-import pandas as pd
 import numpy as np
 
 # Plot figures (including the shown canvas)
 import matplotlib.pyplot as plt
 import matplotlib.transforms as transforms
+from matplotlib.patches import Rectangle
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
+# Compact storage of the channels
+from TSS_storage import STORAGE_MODES, Study, write_processed_csv
+
+# Readers of the raw formats (Digitrapper export, EDF/EDF+)
+from TSS_readers import read_raw, reader_filetypes
+
+# Chunked compressed archive of the processed studies
+from TSS_archive import ARCHIVE_EXTENSION, read_study, write_archive
+
+# Unified index of the pH and impedance time bases
+from TSS_timeline import TimelineIndex
+
+# Training-set exporter of the labelled studies
+from TSS_export import export_training_set
+
+# Cross-study catalog of the labels
+from TSS_catalog import AnnotationCatalog
+
+# Inter-annotator agreement
+from TSS_agreement import compare_label_sets, summary
+from TSS_archive import read_labels
+
+# Medical diary of the recording
+from TSS_diary import DIARY_COLORS
+
+# Derived channels and decimation of the plotted traces
+from TSS_derived import default_derived_channels
+from TSS_decimation import decimate_minmax
+
+# Event-triggered averaging of the labels
+from TSS_averaging import event_average
+from TSS_export import CATEGORIES
+
+# Local tile server (browser viewer)
+from TSS_server import TileServer
+
+# Live tailing of the files still being written
+from TSS_tail import POLL_MS, TAIL_CONTEXT_MS, StudyTailer, tail_study
+
+# Data-quality scan of the imported recordings
+from TSS_quality import (QUALITY_COLORS, QUALITY_TYPES, scan_study, 
+                                    merge_quality, clip_values, mask_gaps)
+
+# Snapping of the label boundaries to the signal features
+from TSS_snapping import SNAP_FRACTION, build_snap_index, merge_snap_index
+
+# Gallery of the labelled events
+from TSS_gallery import render_gallery
+
+# Paginated report of a whole study
+from TSS_report import WINDOW_MS as REPORT_WINDOW_MS, render_report
+
+# Studies open at once, sharing the memory budget of the block cache
+from TSS_session import StudySession
+
+# Query-by-example search of the intervals similar to a label
+from TSS_similarity import find_similar
+
+# Per-label feature tables of a cohort of studies
+from TSS_features import extract_features
+
+# Direction and velocity of the bolus of the labelled events
+from TSS_propagation import bolus_propagation, propagation_text
+
 # Simplify parameters
 plt.rcParams['path.simplify'] = True
 plt.rcParams['agg.path.chunksize'] = 10000
@@ -53,7 +123,7 @@ class GUI_generate():
         if not os.path.isdir(self.tmp_path):
             os.mkdir(self.tmp_path)
         
-        # Number of rows included in each intermediate csv
+        # Number of rows parsed at once during import
         self.how_many_signals = 1000000
         
         # Initialize the parameters to import labelling
@@ -61,6 +131,12 @@ class GUI_generate():
         self.x_values = []                  # Time of labelled signal
         self.color_category = []            # Color of labelled signal
         self.label_n = 0                    # Number of labelled signals
+        self.agreement = None               # Agreement with other annotators
+        self.diary = None                   # Events of the medical diary
+        self.quality = None                 # Problems found in the signals
+        self.snap_index = None              # Candidate boundaries of labels
+        self.propagation = {}               # Bolus propagation of the labels
+        self.meal_candidates = []           # Meals of the diary (not labels)
         # Define the colors of the plots and the categories
         self.colors = ['#0173b2', '#de8f05', '#029e73', '#d55e00', '#cc78bc', 
                        '#ca9161', '#fbafe4', '#949494', '#ece133', '#56b4e9', 
@@ -79,12 +155,34 @@ class GUI_generate():
         self.switch_draw = False    # If TRUE starts to draw the signal
         self.switch_update = False  # Needed to False to define the first plot
         
+        # Redraw scheduler: the view changes are coalesced in a single redraw
+        self.redraw_delay = 30      # Delay of the scheduled redraw (ms)
+        self.redraw_id = None       # Pending redraw (root.after id)
+        self.redraw_full = False    # If TRUE the pending redraw slices signals
+        
         # List of buttons to activate and deactivate the buttons on the canvas
         self.button_list = []       
 
-        # Initialize dataframes
-        self.impedence_df = pd.DataFrame()  # Multiple impedence signals df
-        self.df_ph = pd.DataFrame()         # Ph values df
+        # Initialize the channel stores
+        self.impedence_store = None         # Multiple impedence signals
+        self.ph_store = None                # Ph values
+        self.derived = None                 # Derived impedence channels
+        
+        # Studies open at once (Studies menu) with a shared memory budget
+        self.session = StudySession()
+        
+        # Storage mode of the channels: 'float64', 'float32' (int64 time) or 
+        # 'int16' (scaled values with per-channel scale and offset)
+        self.storage_mode = 'float32'
+        
+        # Catalog of the labels of the saved/imported studies
+        self.catalog = AnnotationCatalog()
+        
+        self.tile_server = None             # Local server of the study
+        
+        # Follow mode: file still being written, polled with root.after
+        self.tailer = None                  # Parser of the appended bytes
+        self.follow_id = None               # Pending poll (root.after id)
     
         
         # Initialize the dimension of the canvas (import window) and the Root
@@ -127,11 +225,130 @@ class GUI_generate():
             label='Import processed signal',
             command=self.import_signal
             )
+        file_menu.add_command(
+            label='Search labels',
+            command=self.search_labels
+            )
+        file_menu.add_command(
+            label='Find similar',
+            command=self.find_similar_labels
+            )
+        file_menu.add_command(
+            label='Accept diary meals',
+            command=self.accept_meal_candidates
+            )
+        file_menu.add_command(
+            label='Compare annotations',
+            command=self.compare_annotations
+            )
+        file_menu.add_command(
+            label='Export training set',
+            command=self.export_training_set
+            )
+        file_menu.add_command(
+            label='Export label features',
+            command=self.export_label_features
+            )
+        file_menu.add_command(
+            label='Event-triggered average',
+            command=self.event_average_view
+            )
+        file_menu.add_command(
+            label='Event gallery',
+            command=self.event_gallery
+            )
+        file_menu.add_command(
+            label='Print report',
+            command=self.print_report
+            )
+        file_menu.add_command(
+            label='Open in browser',
+            command=self.open_in_browser
+            )
+        file_menu.add_command(
+            label='Follow growing file',
+            command=self.follow_file
+            )
+        file_menu.add_command(
+            label='Stop following',
+            command=self.stop_follow
+            )
         file_menu.add_command(
             label='Exit',
             command=self.root.destroy
             )
         
+        # Options menu: storage mode of the imported signals
+        options_menu = Menu(menubar, tearoff=False, font = (" ",12))
+        menubar.add_cascade(
+            label="Options",
+            menu=options_menu,
+            )
+        
+        self.storage_mode_var = StringVar(self.root, value=self.storage_mode)
+        storage_menu = Menu(options_menu, tearoff=False, font = (" ",12))
+        options_menu.add_cascade(label='Storage mode', menu=storage_menu)
+        
+        for mode in STORAGE_MODES:
+            storage_menu.add_radiobutton(
+                label=mode,
+                value=mode,
+                variable=self.storage_mode_var,
+                command=lambda: setattr(self, 'storage_mode', 
+                                                  self.storage_mode_var.get())
+                )
+        
+        # Options menu: derived channels shown over the impedence channels
+        derived_menu = Menu(options_menu, tearoff=False, font = (" ",12))
+        options_menu.add_cascade(label='Derived channels', menu=derived_menu)
+        
+        self.derived_vars = {}
+        for group in ['Baseline', 'Moving average', 'Derivative', 'Minimum']:
+            self.derived_vars[group] = BooleanVar(self.root, value=False)
+            derived_menu.add_checkbutton(
+                label=group,
+                variable=self.derived_vars[group],
+                command=self.toggle_derived
+                )
+        
+        # Options menu: clipping and gap masking of the plotted traces
+        self.clip_var = BooleanVar(self.root, value=False)
+        self.mask_gaps_var = BooleanVar(self.root, value=False)
+        options_menu.add_checkbutton(
+            label='Clip impedence above 11',
+            variable=self.clip_var,
+            command=self.request_redraw
+            )
+        options_menu.add_checkbutton(
+            label='Mask gaps',
+            variable=self.mask_gaps_var,
+            command=self.request_redraw
+            )
+        
+        # Options menu: snapping of the label boundaries
+        self.snap_var = BooleanVar(self.root, value=False)
+        options_menu.add_checkbutton(
+            label='Snap label boundaries',
+            variable=self.snap_var
+            )
+        
+        # Options menu: direction and velocity of the bolus over the labels
+        self.propagation_var = BooleanVar(self.root, value=False)
+        options_menu.add_checkbutton(
+            label='Show propagation',
+            variable=self.propagation_var,
+            command=self.request_redraw
+            )
+        
+        # Studies menu: open studies (one per tab) and close the active one
+        self.studies_menu = Menu(menubar, tearoff=False, font = (" ",12))
+        menubar.add_cascade(
+            label="Studies",
+            menu=self.studies_menu,
+            )
+        self.study_var = StringVar(self.root, value='')
+        self.refresh_studies_menu()
+        
         # Main loop and GUI update
         self.root.update()
         self.root.mainloop()
@@ -155,7 +372,7 @@ class GUI_generate():
             self.slider_val.configure(text=
                                         str(float(self.slider_1.get()))+' min')
             
-            self.update_graph()
+            self.request_redraw()
     ###########################################################################                         
                               
          
@@ -172,7 +389,7 @@ class GUI_generate():
             self.par_left_time = min(self.par_left_time + shift_amount, 
                                         self.par_max_time-self.par_time_window)
         
-        self.update_graph()
+        self.request_redraw()
     ###########################################################################        
 
 
@@ -189,7 +406,7 @@ class GUI_generate():
             self.par_left_time = min(self.par_left_time + shift_amount, 
                                         self.par_max_time-self.par_time_window)
         
-        self.update_graph()
+        self.request_redraw()
     ###########################################################################        
 
 
@@ -205,7 +422,7 @@ class GUI_generate():
         self.par_left_time = max(self.par_left_time - shift_amount, 
                                                              self.par_min_time)
         
-        self.update_graph()
+        self.request_redraw()
     ###########################################################################  
 
 
@@ -221,7 +438,7 @@ class GUI_generate():
         self.par_left_time = max(self.par_left_time - shift_amount, 
                                                              self.par_min_time)
         
-        self.update_graph()
+        self.request_redraw()
     ###########################################################################        
         
     
@@ -250,10 +467,17 @@ class GUI_generate():
         # Temporary store the x_values to be passed at interval_select method 
         # to save the labeled time interval
         self.signal_xvalues_temp = []
+        self.span_temp = None               # Preview of the labelled span
+        self.background = None              # Cached plot (blitted previews)
 
-        # Call the event handler on the self.interval_select method
+        # Call the event handlers: the interval is selected by dragging (or 
+        # with two clicks), while the preview follows the mouse
         self.id = self.fig.canvas.mpl_connect('button_press_event',
                                                           self.interval_select)
+        self.id_motion = self.fig.canvas.mpl_connect('motion_notify_event',
+                                                            self.interval_drag)
+        self.id_release = self.fig.canvas.mpl_connect('button_release_event',
+                                                         self.interval_release)
     ###########################################################################
     
     
@@ -261,37 +485,133 @@ class GUI_generate():
     ###########################################################################           
     def interval_select(self, event):
         ''' 
-        Aux function called by the event handler. It waits two left clicks of
-        the mouse to identify the part of the graph to be labelled.
+        Aux function called by the event handler. The first left click starts
+        the interval to be labelled (and its preview), the second left click 
+        (or the release after a drag) ends it.
         
         It is called by the method "mark_signal()"
         '''
         
-        # First (left) click inside the canvas
-        if event.inaxes==self.ax and event.button == 1 and self.click_counts<2: 
-            self.signal_xvalues_temp.append(event.xdata)
-            self.click_counts = self.click_counts + 1
+        if event.inaxes != self.ax or event.button != 1:
+            return
         
-        if self.click_counts == 2:              # Second (left) click 
-            (self.signal_xvalues_temp).sort()   # Sort the two values       
+        if self.click_counts == 0:              # First (left) click 
+            self.signal_xvalues_temp = [self.snap_time(event.xdata)]
+            self.press_x = event.x              # Pixel of the click
+            self.click_counts = 1
             
-            # Append to the main lists
-            self.x_values.append(self.signal_xvalues_temp)
-            self.color_category.append(self.signal_color_temp)
-            self.category.append(self.signal_type_temp)
+            # Preview of the span: animated artist, drawn with blitting
+            self.span_temp = Rectangle((self.signal_xvalues_temp[0], 0), 0, 1, 
+                             transform=self.ax.get_xaxis_transform(), 
+                             color=self.signal_color_temp, alpha=0.2, 
+                                                                animated=True)
+            self.ax.add_patch(self.span_temp)
             
-            
-            self.label_n = self.label_n + 1     # Increase number of labels
+        elif self.click_counts == 1:            # Second (left) click 
+            self.commit_interval(event.xdata)
+    ###########################################################################   
+    
+    
+    
+    ###########################################################################           
+    def interval_drag(self, event):
+        '''
+        Aux function called when the mouse moves: the preview of the span is
+        redrawn over the cached background of the plot (blitting).
+        '''
+        
+        if self.click_counts != 1 or event.inaxes != self.ax:
+            return
+        
+        x0 = self.signal_xvalues_temp[0]
+        x1 = self.snap_time(event.xdata)
+        self.span_temp.set_x(min(x0, x1))
+        self.span_temp.set_width(abs(x1 - x0))
+        
+        # No background cached yet (before the first draw or after a resize):
+        # the draw caches it for the next moves
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.span_temp)
+        self.canvas.blit(self.ax.bbox)
+    ###########################################################################   
+    
+    
+    
+    ###########################################################################           
+    def interval_release(self, event):
+        '''
+        Aux function called when the mouse is released: after a drag the 
+        interval is labelled, after a click the second click is awaited.
+        '''
+        
+        if self.click_counts != 1 or event.inaxes != self.ax or \
+                                                              event.button != 1:
+            return
+        
+        if abs(event.x - self.press_x) > 3:    # Drag (pixels)
+            self.commit_interval(event.xdata)
+    ###########################################################################   
+    
+    
+    
+    ###########################################################################           
+    def snap_time(self, x):
+        '''
+        Aux function to snap a clicked time to the nearest candidate boundary
+        (impedence drop or pH crossing) if snapping is active. The candidates
+        are computed at import, each click is a single sorted lookup.
+        '''
+        
+        if not self.snap_var.get() or self.snap_index is None:
+            return x
+        return self.snap_index.snap(x, SNAP_FRACTION*self.par_time_window)
+    ###########################################################################   
+    
+    
+    
+    ###########################################################################           
+    def commit_interval(self, x):
+        '''
+        Aux function to save the selected interval. Only the patches of the 
+        new span are added to the plot (no update of the signals).
+        '''
+        
+        self.signal_xvalues_temp.append(self.snap_time(x))
+        (self.signal_xvalues_temp).sort()       # Sort the two values       
+        self.click_counts = 2
+        
+        # Append to the main lists
+        self.x_values.append(self.signal_xvalues_temp)
+        self.color_category.append(self.signal_color_temp)
+        self.category.append(self.signal_type_temp)
+        
+        self.label_n = self.label_n + 1         # Increase number of labels
 
-            self.fig.canvas.mpl_disconnect(self.id)
-            self.root.config(cursor = "arrow")
-            
-            # Activate again deactivated buttons
-            for button in self.button_list:
-                button.configure(state="normal", fg_color="cornflower blue",
-                                               hover_color = "dark slate blue")
-            
-            self.update_graph()
+        self.fig.canvas.mpl_disconnect(self.id)
+        self.fig.canvas.mpl_disconnect(self.id_motion)
+        self.fig.canvas.mpl_disconnect(self.id_release)
+        self.root.config(cursor = "arrow")
+        
+        # Activate again deactivated buttons
+        for button in self.button_list:
+            button.configure(state="normal", fg_color="cornflower blue",
+                                           hover_color = "dark slate blue")
+        
+        # The preview becomes the persistent span, plus the whole time span
+        self.span_temp.set_x(self.signal_xvalues_temp[0])
+        self.span_temp.set_width(self.signal_xvalues_temp[1] - 
+                                                  self.signal_xvalues_temp[0])
+        self.span_temp.set_animated(False)
+        self.span_temp = None
+        self.ax_total.axvspan(self.signal_xvalues_temp[0], 
+                              self.signal_xvalues_temp[1], 
+                                     color=self.signal_color_temp, alpha=0.5)
+        
+        self.canvas.draw_idle()
     ###########################################################################   
     
     
@@ -343,13 +663,53 @@ class GUI_generate():
                                                hover_color = "dark slate blue")
                 
                 self.fig.canvas.mpl_disconnect(self.id)
-                self.update_graph()                            
+                self.request_redraw()                            
                 
         self.id = self.fig.canvas.mpl_connect('button_press_event',identify_interval)
     ###########################################################################   
 
 
         
+    ###########################################################################       
+    def next_diary_event(self):
+        """
+        Button to move the time window to the next event of the diary. The 
+        event is shown at 10% of the time window.
+        """
+        
+        if self.diary is None:
+            return
+        
+        i = self.diary.next_event(self.par_left_time + self.par_time_window/10)
+        if i is not None:
+            self.par_left_time = max(self.diary.time[i] - 
+                                 self.par_time_window/10, self.par_min_time)
+            print("Diary: ", self.diary.kind[i], " - ", self.diary.text[i])
+            self.request_redraw()
+    ###########################################################################   
+    
+    
+    
+    ###########################################################################       
+    def previous_diary_event(self):
+        """
+        Button to move the time window to the previous event of the diary.
+        """
+        
+        if self.diary is None:
+            return
+        
+        i = self.diary.previous_event(self.par_left_time + 
+                                                       self.par_time_window/10)
+        if i is not None:
+            self.par_left_time = max(self.diary.time[i] - 
+                                 self.par_time_window/10, self.par_min_time)
+            print("Diary: ", self.diary.kind[i], " - ", self.diary.text[i])
+            self.request_redraw()
+    ###########################################################################   
+    
+    
+    
     ###########################################################################       
     def select_and_see(self,event):
         """
@@ -361,7 +721,7 @@ class GUI_generate():
             x = event.xdata
             self.par_left_time = x
             
-            self.update_graph()
+            self.request_redraw()
     ###########################################################################   
     
     
@@ -380,58 +740,59 @@ class GUI_generate():
             self.slider_font_text.configure(text='fontsize plot: ' + 
                                               str(int(self.slider_font.get())))
             
-            self.update_graph()
+            self.request_redraw(full=False)
     ###########################################################################
 
 
 
-    ###########################################################################        
-    def bisection_selection(self, t, t_min, t_max):
+    ###########################################################################    
+    def request_redraw(self, full=True):
         """
-        t: (list) time values
-        t_min: (int) minimum time of the interval to plot
-        t_max: (int) maximum time of the interval to plot
-        Aux function to select the indices of the signal slice given the 
-        minimum and maximum time. It is based on the bisection algorithm to 
-        drastically optimize the searching time.
+        Aux function to schedule a redraw of the plot. The requests received 
+        before the redraw are coalesced: only the latest view is rendered.
+        full: (bool) if False only the font size of the plot is updated
         """
         
-        cond_min = 0            # Minimum starting point
-        right_cond_min= len(t)  # Maximum starting point
+        self.redraw_full = self.redraw_full or full
         
-        Found = False           # Found switch
+        if self.redraw_id is None:
+            self.redraw_id = self.root.after(self.redraw_delay, self.redraw)
+    ###########################################################################
+
+
+
+    ###########################################################################    
+    def redraw(self):
+        """
+        Aux function called by the scheduler to render the pending view.
+        """
         
-        # Iterate to find min condition (cond_min)
-        while not Found:
-            candidate = int((cond_min+right_cond_min)/2)
-            
-            if t[candidate]<t_min:
-                cond_min = candidate
-            else:
-                right_cond_min = candidate
-                
-            if abs(right_cond_min-cond_min)<2:  # Halting criterion
-                Found = True
-            
-        # Search for max condition (cond_max)    
-        left_cond_max = cond_min    # Use minimum condition as starting point
-        cond_max = len(t)           # Maximum starting point
+        self.redraw_id = None
+        full, self.redraw_full = self.redraw_full, False
         
-        Found = False               # Found switch
+        if not self.switch_update:
+            return
         
+        if full:
+            self.update_graph()
+        else:
+            self.update_fontsize()
+    ###########################################################################
+
+
+
+    ###########################################################################    
+    def update_fontsize(self):
+        """
+        Aux function to apply the font size to the texts of the plot without
+        slicing the signals again.
+        """
         
-        # Iterate to find max condition (cond_max)
-        while not Found:
-            candidate = int((cond_max+left_cond_max)/2)
-            if t[candidate]<t_max:
-                left_cond_max = candidate
-            else:
-                cond_max = candidate
-                
-            if abs(cond_max-left_cond_max)<2:
-                Found = True
+        for ax in (self.ax, self.ax_total):
+            for text in ax.texts + ax.get_xticklabels():
+                text.set_fontsize(self.fontsize)
         
-        return cond_min, cond_max
+        self.canvas.draw_idle()
     ###########################################################################
 
 
@@ -516,9 +877,9 @@ class GUI_generate():
             self.button_list.append(button_right_shift)
 
             # Initialize the time
-            self.par_min_time = int(min(self.df_ph['Time_ph(ms)'])) # Min time
+            self.par_min_time = self.timeline.bounds('ph')[0]   # Min time
             self.par_left_time = self.par_min_time              # Actual time
-            self.par_max_time = int(max(self.time_impedence))   # Max time
+            self.par_max_time = self.timeline.bounds('impedence')[1] # Max time
             
             # Frame of vertical zoom slider 
             self.zoom_frame = customtkinter.CTkFrame(self.root)
@@ -531,9 +892,9 @@ class GUI_generate():
                                                         uniform="Silent_Creme")
             
             self.slider_1 = customtkinter.CTkSlider(self.zoom_frame, from_=0.5, 
-                             to=20, number_of_steps=39, orientation='vertical')
+                             to=20, number_of_steps=39, orientation='vertical',
+                                                   command=self.slider_event)
             self.slider_1.set(2)
-            self.slider_1.bind("<ButtonRelease-1>", self.slider_event)
             
             self.par_time_window = 1000*60*self.slider_1.get()
             
@@ -632,6 +993,30 @@ class GUI_generate():
                                       padx=(20,20), pady=(10, 10), sticky="ew")
             self.button_list.append(button_remove_mark)
 
+            # Frame: Navigate the events of the medical diary
+            self.diary_frame = customtkinter.CTkFrame(self.root)
+            self.diary_frame.grid(row=0, column=9, columnspan=3, padx=(20, 20), 
+                                                  pady=(10, 10), sticky="nsew")
+            
+            self.diary_frame.columnconfigure(list(range(2)), weight = 1, 
+                                                        uniform="Silent_Creme")
+            self.diary_frame.rowconfigure(list(range(1)), weight = 1, 
+                                                        uniform="Silent_Creme")
+            
+            button_previous_diary = customtkinter.CTkButton(
+                           master=self.diary_frame, text="< Diary", 
+                           font = my_font_2, command=self.previous_diary_event)
+            button_previous_diary.grid(row=0, column=0, padx=5, pady=5, 
+                                                                sticky="nsew")
+            self.button_list.append(button_previous_diary)
+            
+            button_next_diary = customtkinter.CTkButton(
+                           master=self.diary_frame, text="Diary >", 
+                           font = my_font_2, command=self.next_diary_event)
+            button_next_diary.grid(row=0, column=1, padx=5, pady=5, 
+                                                                sticky="nsew")
+            self.button_list.append(button_next_diary)
+
             # Frame: Select font size 
             self.font_frame = customtkinter.CTkFrame(self.root)
             self.font_frame.grid(row=7, column=9, columnspan=3, padx=(20, 20), 
@@ -643,9 +1028,9 @@ class GUI_generate():
                                                         uniform="Silent_Creme")
                 
             self.slider_font = customtkinter.CTkSlider(self.font_frame, 
-                  from_=6, to=20, number_of_steps=14, orientation='horizontal')
+                  from_=6, to=20, number_of_steps=14, orientation='horizontal',
+                                                 command=self.slider_font_size)
             self.slider_font.set(2)
-            self.slider_font.bind("<ButtonRelease-1>", self.slider_font_size)
             self.slider_font.grid(row=0, column=0, columnspan = 3,rowspan=1, 
                                                                     pady=(5,0))
 
@@ -668,7 +1053,10 @@ class GUI_generate():
               gridspec_kw={'height_ratios': [10, 1]}, figsize=(10,6),dpi = 100)
              
             self.ax = self.axes[0]
+            plt.close(self.fig)     # The figure is owned by the Tk canvas only
             self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
+            self.canvas.get_tk_widget().grid(row=0, column=1,rowspan = 7, 
+                    columnspan=8, padx = (0,0), pady=(0, 0), sticky="nsew")
             
             self.signal_names = np.array(['signal_' + str(i) + '_selected' 
                                             for i in range(1,7)],dtype = 'str')
@@ -722,12 +1110,7 @@ class GUI_generate():
             # Number of time visualization in the total time plot 
             steps = 8
 
-            min_time_imp = np.min(self.time_impedence)
-            max_time_imp = np.max(self.time_impedence)
-            min_time_ph = np.min(self.time_ph)
-            max_time_ph = np.max(self.time_ph)
-            max_time_vis = np.min([max_time_imp,max_time_ph])
-            min_time_vis = np.max([min_time_ph,min_time_imp])
+            min_time_vis, max_time_vis = self.timeline.common_bounds()
                            
             stringa_visualiza = []
             time_visualize = []
@@ -762,6 +1145,13 @@ class GUI_generate():
             # Activate the possibility to zoom on a selected piece of the signal 
             self.fig.canvas.mpl_connect('button_press_event', lambda event: 
                         self.select_and_see(event) if event.dblclick else None)
+            
+            # Cache the background of the plot (for the blitted previews)
+            self.background = None
+            self.fig.canvas.mpl_connect('draw_event', lambda event: setattr(
+               self, 'background', self.canvas.copy_from_bbox(self.ax.bbox)))
+            self.fig.canvas.mpl_connect('resize_event', lambda event: 
+                                        setattr(self, 'background', None))
 
             self.update_graph()
     ###########################################################################
@@ -772,113 +1162,30 @@ class GUI_generate():
     def import_signal_raw(self):
         '''
         Aux function to import the raw signal as exported from the main 
-        software.
+        software (or from another raw format with a registered reader).
         '''
         
         # if self.switch_import:
         self.path_signal = filedialog.askopenfilename(
-                                          filetypes = (("Txt Files","*.txt"),))
-        
-        
-        # Open the file
-        opener = open(self.path_signal, 'r')  
-        list_lines = opener.readlines()
+                                               filetypes = reader_filetypes())
         
-        # Find the beginning of the 7 signals
-        # Ph Array
-        start_ph_array = list_lines.index('Ph Array\n')+ 4
-
-        # Impedance Array
-        start_impedence_array = list_lines.index('Impedance Array\n') + 4
-
-        # Medical Diary
-        start_diary = list_lines.index('Diary\n')
-        
-        # Database ph:
-        list_ph = []
-        
-        for i_temp in range(start_ph_array,start_impedence_array-5):
-            
-            temp_row = list_lines[i_temp]
-            list_ph.append([int(temp_row.split('\t')[0]),
-                              float((temp_row.split('\t')[1]).split('\n')[0])])
-          
-        self.df_ph = pd.DataFrame(list_ph, columns =['Time_ph(ms)','Value_ph'])    
-        self.time_ph = self.df_ph['Time_ph(ms)']
         
-        # Database Impedence (6 channels)
-        # Warning: should be saved every self.how_many_signals
-        list_impedence = []
-        count_subdivision = 0
+        # Read the 7 signals into the channel stores (EDF files are mapped
+        # and decoded on demand)
+        mode, chunk_rows = self.storage_mode, self.how_many_signals
+        study = read_raw(self.path_signal, mode, chunk_rows)
+        self.add_study(self.path_signal, study, 
+                                     lambda key: read_raw(key, mode, chunk_rows))
         
-        printed_percentage = 0
-        print("Load percentage: ",printed_percentage)
-        
-        for i_temp in range(start_impedence_array,start_diary-1):
-            tmp_percentage = int(i_temp*100/len(range(start_impedence_array,start_diary-1)))
-            
-            if tmp_percentage >= printed_percentage+5:
-                printed_percentage = tmp_percentage
-                print("Load percentage: ",printed_percentage)
-                
-            temp_row = list_lines[i_temp]
-            
-            temp_row_list = (temp_row.replace('\n','')).split('\t')
-            
-            list_impedence.append([int(temp_row_list[0]),
-                               float(temp_row_list[1]),float(temp_row_list[2]),
-                               float(temp_row_list[3]),float(temp_row_list[4]),
-                              float(temp_row_list[5]),float(temp_row_list[5])])
-            
-            if i_temp%self.how_many_signals == 0:
-                count_subdivision += 1
-                df_impedence = pd.DataFrame(list_impedence, 
-                            columns = ['Time(ms)','Value_1','Value_2',
-                              'Value_3','Value_4','Value_5','Value_6'])
-                df_impedence.to_csv(os.path.join(self.tmp_path, 
-                           'impedence_'+str(count_subdivision)+'.csv'), 
-                                                         index = False)
-                # Reset the list
-                list_impedence = []
-            
-        # Merge the datasets
-        list_datasets = os.listdir(self.tmp_path)
-        list_datasets= [i for i in os.listdir(self.tmp_path) 
-                                                        if ("impedence_" in i)]
-        
-        # Range over the number
-        self.impedence_df= pd.DataFrame() 
-        
-        for i in range(0, len(list_datasets)):
-            tmp_path_df = os.path.join(self.tmp_path,
-                                                  "impedence_"+str(i+1)+'.csv')
-            tmp_df = pd.read_csv(tmp_path_df)
-            self.impedence_df = pd.concat([self.impedence_df, tmp_df], 
-                                                             ignore_index=True)
-            
-            # Remove the tmp csv
-            os.remove(tmp_path_df)
-        
-        self.switch_draw = True
-        
-        # Define the list of the signals
-        self.time_impedence = self.impedence_df['Time(ms)'].to_list()
-        self.signal_1 = self.impedence_df['Value_1'].to_list()
-        self.signal_2 = self.impedence_df['Value_2'].to_list()
-        self.signal_3 = self.impedence_df['Value_3'].to_list()
-        self.signal_4 = self.impedence_df['Value_4'].to_list()
-        self.signal_5 = self.impedence_df['Value_5'].to_list()
-        self.signal_6 = self.impedence_df['Value_6'].to_list()   
+        # The meals of the diary are shown as candidates of "Meal" labels,
+        # they become labels only when accepted by the annotator
+        if self.diary is not None:
+            self.meal_candidates.extend([[int(period[0]), int(period[1])] 
+                                      for period in self.diary.meal_periods()])
         
         self.save_processed_signal()
 
-       # for name in self.signal_names:
-       #     vector = np.array(getattr(self,name)) 
-       #     x = np.where(vector > 11)[0]
-       #     vector[x] = 11
-       #     setattr(self,name,vector)
-            
-       # self.plot_graph()
+        # Values above 11 are clipped at display time (Options menu)
     ###########################################################################        
         
     
@@ -930,8 +1237,7 @@ class GUI_generate():
         steps = 8
         
         # selecting the time window to visualize the measurement time: hh:mm:ss
-        min_time_vis = np.min(self.time_impedence)
-        max_time_vis = np.max(self.time_impedence)
+        min_time_vis, max_time_vis = self.timeline.bounds('impedence')
 
         stringa_visualiza = []
         time_visualize = []
@@ -990,34 +1296,23 @@ class GUI_generate():
         if self.par_left_time + self.par_time_window >= self.par_max_time:
             self.par_left_time = self.par_max_time - self.par_time_window
 
-        self.cond_min, self.cond_max  = self.bisection_selection(
-                                       self.time_impedence, self.par_left_time, 
+        # Slices of all the time bases with a single lookup
+        ranges = self.timeline.ranges(self.par_left_time, 
                                        self.par_left_time+self.par_time_window)
         
+        self.cond_min, self.cond_max = ranges['impedence']
+        self.cond_min_ph, self.cond_max_ph = ranges['ph']
+        
         time_impedence_selected = self.time_impedence[self.cond_min:self.cond_max]
         
-        self.signal_1_selected = np.array(
-                                    self.signal_1[self.cond_min:self.cond_max])
-        self.signal_2_selected = np.array(
-                                    self.signal_2[self.cond_min:self.cond_max])
-        self.signal_3_selected = np.array(
-                                    self.signal_3[self.cond_min:self.cond_max])
-        self.signal_4_selected = np.array(
-                                    self.signal_4[self.cond_min:self.cond_max])
-        self.signal_5_selected = np.array(
-                                    self.signal_5[self.cond_min:self.cond_max])
-        self.signal_6_selected = np.array(
-                                    self.signal_6[self.cond_min:self.cond_max])
-        
-        self.time_ph = self.df_ph['Time_ph(ms)']
-        signal_ph = self.df_ph['Value_ph']
-        
-        self.cond_min_ph, self.cond_max_ph  = self.bisection_selection(
-                                              self.time_ph, self.par_left_time, 
-                                       self.par_left_time+self.par_time_window)
+        # Decode only the visible slice of each channel
+        for k in range(self.impedence_store.n_channels):
+            setattr(self, 'signal_'+str(k+1)+'_selected', 
+                self.impedence_store.channel(k, self.cond_min, self.cond_max))
         
         time_ph_selected = self.time_ph[self.cond_min_ph:self.cond_max_ph]
-        self.signal_ph_selected = signal_ph[self.cond_min_ph:self.cond_max_ph]
+        self.signal_ph_selected = self.ph_store.channel(0, self.cond_min_ph, 
+                                                              self.cond_max_ph)
 
         times_dictionary = {'time_ph':time_ph_selected, 
                                           'time_imped':time_impedence_selected}
@@ -1030,7 +1325,7 @@ class GUI_generate():
         # order to be visualized.                
         for (p,n) in enumerate(self.signal_names):
             if p == 0:
-                self.ax.plot(times_dictionary['time_ph'],getattr(self,n),
+                self.plot_trace(times_dictionary['time_ph'], getattr(self,n),
                                                         color = self.colors[p])
                 discriminator =4*np.ones(len(times_dictionary['time_ph']))
                 self.ax.plot(times_dictionary['time_ph'], discriminator, 
@@ -1043,8 +1338,22 @@ class GUI_generate():
             else:
                 # Adding the plot to the signal in order to visualize it 
                 # in the same plot
-                self.ax.plot(times_dictionary['time_imped'], 
-                      getattr(self,n) + self.yticks[p], color = self.colors[p]) 
+                values = getattr(self,n)
+                if self.clip_var.get():
+                    values = clip_values(values)
+                self.plot_trace(times_dictionary['time_imped'], 
+                              values + self.yticks[p], color = self.colors[p]) 
+
+        # Derived channels (computed only on the visible blocks) drawn over 
+        # the row of their source channel
+        if self.derived is not None:
+            for name in self.derived.active:
+                derived = self.derived.channels[name]
+                self.plot_trace(times_dictionary['time_imped'], 
+                   derived.gain*self.derived.channel(name, self.cond_min, 
+                                                                 self.cond_max)
+                        + self.yticks[derived.row+1] + derived.offset, 
+                                         color = 'k', linewidth = 0.6)
 
         steps = 6
         indice = np.floor((time_impedence_selected[-1]
@@ -1067,10 +1376,7 @@ class GUI_generate():
             stringa_visualiza.append(f'{ore:02}:{minutes:02}:{secondi:02}')
             time_visualize.append(time_impedence_selected[0] + indice*(n))
 
-        min_plot = np.max([np.min(time_impedence_selected),
-                                                     np.min(time_ph_selected)])
-        max_plot = np.min([np.max(time_impedence_selected),
-                                                     np.max(time_ph_selected)])
+        min_plot, max_plot = self.timeline.window_bounds(ranges)
         time_impedence_selected_s = (max_plot)*10**-3
 
         ore = int(np.floor(time_impedence_selected_s/3600))
@@ -1094,6 +1400,22 @@ class GUI_generate():
             self.ax.axvspan(self.x_values[i][0], self.x_values[i][1], 
                                        color=self.color_category[i], alpha=0.2)
 
+        # plot the meal candidates of the diary (hatched, not yet labels)
+        for candidate in self.meal_candidates:
+            self.ax.axvspan(candidate[0], candidate[1], facecolor='none', 
+                       edgecolor=self.colors[4], hatch='//', alpha=0.5)
+
+        # write the bolus propagation over the labels in the shown window
+        if self.propagation_var.get():
+            self.annotate_propagation(min_plot, max_plot)
+
+        # plot the events of the diary in the shown window
+        if self.diary is not None and len(self.diary) > 0:
+            d0, d1 = np.searchsorted(self.diary.time, [min_plot, max_plot])
+            self.ax.vlines(self.diary.time[d0:d1], 0, self.yticks[-1]+4, 
+                       colors=[DIARY_COLORS[k] for k in self.diary.kind[d0:d1]],
+                                                 linestyles='dashed', alpha=0.8)
+
         # clean the total axis plot to avoid multiple plot instances    
         self.ax_total.cla()
 
@@ -1105,40 +1427,369 @@ class GUI_generate():
             self.ax_total.axvspan(self.x_values[i][0], self.x_values[i][1], 
                                        color=self.color_category[i], alpha=0.5)
 
-        
-        canvas = FigureCanvasTkAgg(self.fig,master=self.root)
+        # add the markers of the diary events (single collection)
+        if self.diary is not None and len(self.diary) > 0:
+            self.ax_total.vlines(self.diary.time, 0.95, 1.05, 
+                         colors=[DIARY_COLORS[k] for k in self.diary.kind], 
+                                                               linewidth=1)
+
+        # add the disagreements with the other annotators (single collection)
+        if self.agreement is not None:
+            disagreements = self.agreement['disagreements']
+            self.ax_total.broken_barh(np.column_stack([disagreements[:,0], 
+                             disagreements[:,1] - disagreements[:,0]]), 
+                                  (0.95, 0.03), facecolors='red', alpha=0.8)
+        
+        # add the problems found by the quality scan (one collection per type)
+        if self.quality is not None and len(self.quality) > 0:
+            for kind in QUALITY_TYPES:
+                intervals = self.quality.intervals(kind)
+                if len(intervals) > 0:
+                    self.ax_total.broken_barh(np.column_stack([intervals[:,0], 
+                        np.maximum(intervals[:,1] - intervals[:,0], 1)]), 
+                                (1.02, 0.03), facecolors=QUALITY_COLORS[kind])
+        
+        self.canvas.draw_idle()
+    ###########################################################################
+
+
 
-        canvas.draw_idle()
-        canvas.get_tk_widget().grid(row=0, column=1,rowspan = 7, columnspan=8, 
-                                      padx = (0,0), pady=(0, 0), sticky="nsew")
-        plt.close(self.fig)
+    ###########################################################################
+    def annotate_propagation(self, min_plot, max_plot):
+        '''
+        Aux function to write the direction and the velocity of the bolus
+        over the labels in the shown window. The labels not yet seen are
+        computed all at once and kept by (start, end).
+        '''
+        
+        shown = [tuple(x) for x in self.x_values 
+                                    if max(x) >= min_plot and min(x) <= max_plot]
+        new = [x for x in shown if x not in self.propagation]
+        if new:
+            result = bolus_propagation(Study(self.impedence_store, 
+                                                      self.ph_store), new)
+            for x, direction, velocity in zip(new, result['direction'], 
+                                                         result['velocity']):
+                self.propagation[x] = propagation_text(direction, velocity)
+        
+        for x in shown:
+            self.ax.text((max(min(x), min_plot) + min(max(x), max_plot))/2, 
+                         self.yticks[-1]+2, self.propagation[x], 
+                                      ha='center', fontsize=self.fontsize)
     ###########################################################################
 
         
         
+    ###########################################################################            
+    def set_study(self, study, state=None):
+        '''
+        Aux function to use the signals and the labels of an imported study.
+        state: (dict) view and analyses of the study kept by the session
+        '''
+        
+        state = {} if state is None else state
+        
+        self.impedence_store = study.impedence
+        self.ph_store = study.ph
+        
+        self.time_impedence = self.impedence_store.time
+        self.time_ph = self.ph_store.time
+        
+        # Index mapping any time range to the slices of both time bases
+        self.timeline = TimelineIndex({'impedence': self.impedence_store, 
+                                                         'ph': self.ph_store})
+        
+        self.category = study.category
+        self.x_values = study.x_values
+        self.color_category = study.color_category
+        self.label_n = len(self.category)
+        self.agreement = state.get('agreement')
+        self.diary = study.diary
+        
+        # Gaps, bad timestamps, missing, saturated and flat-lined samples
+        if study.quality is None:
+            study.quality = scan_study(study)
+            if len(study.quality) > 0:
+                print("Quality: ", study.quality.summary())
+        self.quality = study.quality
+        
+        # Candidate boundaries of the labels (snapping of the clicks)
+        if 'snap_index' not in state:
+            state['snap_index'] = build_snap_index(study)
+        self.snap_index = state['snap_index']
+        
+        # Bolus propagation of the labels (computed when shown)
+        self.propagation = state.setdefault('propagation', {})
+        
+        # Meals of the diary not yet accepted as labels
+        self.meal_candidates = state.setdefault('meal_candidates', [])
+        
+        # Derived channels of the impedence (computed lazily when shown)
+        sample_ms = (self.time_impedence.max() - self.time_impedence.min())/ \
+                                      max(len(self.time_impedence)-1, 1)
+        self.derived = default_derived_channels(self.impedence_store, 
+                                                  max(sample_ms, 1))
+        self.toggle_derived(redraw=False)
+        
+        self.switch_draw = True
+        
+        print("Storage ("+study.impedence.mode+"): ", 
+                               round(study.nbytes/2**20, 1), " MB")
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def add_study(self, key, study, loader=None):
+        '''
+        Aux function to open a study in the session (new entry of the 
+        Studies menu) and use it. The loader is used to load the signals 
+        again if they are released to stay in the memory budget. Opening 
+        another study stops the follow mode.
+        '''
+        
+        if self.tailer is not None and key != self.tailer.path:
+            self.stop_follow()
+        self.store_view()
+        entry = self.session.open(key, study, loader)
+        self.refresh_studies_menu()
+        self.set_study(study, entry.state)
+        
+        if self.switch_update:
+            self.restore_view(entry)
+    ###########################################################################
+    
+    
+    
+    ###########################################################################
+    def accept_meal_candidates(self):
+        '''
+        Aux function to label the meal candidates of the diary as "Meal" (the
+        candidates overlapping a "Meal" label are skipped).
+        '''
+        
+        if not self.meal_candidates:
+            print("No meal candidates")
+            return
+        
+        meals = [x for c, x in zip(self.category, self.x_values) 
+                                                              if c == "Meal"]
+        for candidate in self.meal_candidates:
+            if any(x[0] <= candidate[1] and x[1] >= candidate[0] 
+                                                              for x in meals):
+                continue
+            self.x_values.append(list(candidate))
+            self.category.append("Meal")
+            self.color_category.append(self.colors[4])
+        self.label_n = len(self.category)
+        del self.meal_candidates[:]
+        
+        self.request_redraw()
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def store_view(self):
+        '''
+        Aux function to keep the labels and the view of the active study in 
+        the session before another study is shown.
+        '''
+        
+        if self.session.active is None or self.impedence_store is None:
+            return
+        
+        entry = self.session.studies[self.session.active]
+        entry.study.category = self.category
+        entry.study.x_values = self.x_values
+        entry.study.color_category = self.color_category
+        entry.study.diary = self.diary
+        entry.state['agreement'] = self.agreement
+        entry.state['path_signal'] = self.path_signal
+        if self.switch_update:
+            entry.state['left_time'] = self.par_left_time
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def restore_view(self, entry):
+        '''
+        Aux function to show a study of the session in the existing figure,
+        at the time it was shown last (no rebuild of the widgets).
+        '''
+        
+        self.par_min_time = self.timeline.bounds('ph')[0]
+        self.par_max_time = self.timeline.bounds('impedence')[1]
+        self.par_left_time = min(max(entry.state.get('left_time', 
+                        self.par_min_time), self.par_min_time), 
+                                   self.par_max_time - self.par_time_window)
+        
+        self.root.title("Time Series Scribe - " + entry.name)
+        self.request_redraw()
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def switch_study(self, key):
+        '''
+        Aux function to show another open study (Studies menu). Its signals
+        are loaded again only if they had been released.
+        '''
+        
+        if key == self.session.active or key not in self.session.studies:
+            return
+        
+        if self.tailer is not None:
+            self.stop_follow()
+        
+        self.store_view()
+        entry = self.session.activate(key)
+        self.path_signal = entry.state.get('path_signal', key)
+        self.set_study(entry.study, entry.state)
+        self.refresh_studies_menu()
+        
+        if self.switch_update:
+            self.restore_view(entry)
+        
+        print("Session ("+str(len(self.session))+" studies): ", 
+                                round(self.session.nbytes/2**20, 1), " MB")
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def close_study(self):
+        '''
+        Aux function to close the active study (its cached blocks are 
+        dropped) and show the most recently used one.
+        '''
+        
+        key = self.session.active
+        if key is None:
+            return
+        
+        if self.tailer is not None:
+            self.stop_follow()
+        
+        # The server of the closed study is stopped (its tiles are dropped)
+        if self.tile_server is not None and \
+                        self.tile_server.study.impedence is self.impedence_store:
+            self.tile_server.stop()
+            self.session.unpin(self.tile_server)
+            self.tile_server = None
+        
+        next_key = self.session.close(key)
+        self.refresh_studies_menu()
+        
+        if next_key is not None:
+            entry = self.session.activate(next_key)
+            self.path_signal = entry.state.get('path_signal', next_key)
+            self.set_study(entry.study, entry.state)
+            self.refresh_studies_menu()
+            if self.switch_update:
+                self.restore_view(entry)
+        else:
+            self.impedence_store = None
+            self.ph_store = None
+            self.derived = None
+            self.switch_draw = False
+            if self.switch_update:
+                self.ax.cla()
+                self.ax_total.cla()
+                self.canvas.draw_idle()
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def refresh_studies_menu(self):
+        '''
+        Aux function to list the open studies in the Studies menu.
+        '''
+        
+        self.studies_menu.delete(0, 'end')
+        for key in self.session.order:
+            self.studies_menu.add_radiobutton(
+                label=self.session.studies[key].name,
+                value=key,
+                variable=self.study_var,
+                command=lambda: self.switch_study(self.study_var.get())
+                )
+        self.studies_menu.add_separator()
+        self.studies_menu.add_command(
+            label='Close study',
+            command=self.close_study
+            )
+        self.study_var.set(self.session.active or '')
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def plot_trace(self, time, values, **kwargs):
+        '''
+        Aux function to plot a (raw or derived) trace in the main axis, 
+        decimated to the min/max of each pixel column.
+        '''
+        n_bins = int(self.fig.get_figwidth()*self.fig.dpi)
+        time, values = decimate_minmax(time, values, n_bins)
+        if self.mask_gaps_var.get():
+            time, values = mask_gaps(time, values)
+        self.ax.plot(time, values, **kwargs)
+    ###########################################################################
+    
+    
+    
+    ###########################################################################            
+    def toggle_derived(self, redraw=True):
+        '''
+        Aux function to show the derived channels selected in the Options 
+        menu.
+        '''
+        if self.derived is None:
+            return
+        
+        for name, derived in self.derived.channels.items():
+            group = name.rstrip('0123456789 ')
+            self.derived.set_active(name, self.derived_vars[group].get())
+            
+        if redraw and self.switch_update:
+            self.request_redraw()
+    ###########################################################################
+    
+    
+    
     ###########################################################################            
     def save_processed_signal(self):
         '''
-        Aux function to save the processed signal as csv.
+        Aux function to save the processed signal as csv (or as chunked 
+        compressed archive if the .tssa extension is selected).
         '''
-        # Activate only if the df are non empty:
-        if not self.impedence_df.empty:
+        # Activate only if a signal has been imported:
+        if self.impedence_store is not None:
             save_path = filedialog.asksaveasfilename(
-                                          filetypes = (("CSV Files","*.csv"),))
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
             
             # Check if the extension has been added
-            if '.csv' not in save_path:
+            if '.csv' not in save_path and \
+                                  not save_path.endswith(ARCHIVE_EXTENSION):
                 save_path = save_path +'.csv'
                 
-            # Define the dataframe list of signals and etiquettes:
-            labelling_df = pd.DataFrame()
-            labelling_df['labels'] = self.category
-            labelling_df['color_label'] = self.color_category
-            labelling_df['intervals'] = self.x_values
-         
-            impedence_df_merged = pd.concat([self.impedence_df,
-                                              self.df_ph,labelling_df], axis=1)     
-            impedence_df_merged.to_csv(save_path, index = False)
+            # Save the signals with the labels
+            study = Study(self.impedence_store, self.ph_store, self.category, 
+                   self.x_values, self.color_category, diary = self.diary,
+                                                      quality = self.quality)
+            
+            if save_path.endswith(ARCHIVE_EXTENSION):
+                write_archive(save_path, study)
+            else:
+                write_processed_csv(save_path, study)
+            
+            # Update the catalog of the labels
+            self.catalog.register_study(save_path, study)
     ###########################################################################
 
 
@@ -1150,62 +1801,593 @@ class GUI_generate():
         '''
         # if self.switch_import:
         self.path_signal = filedialog.askopenfilename(
-                                          filetypes = (("CSV Files","*.csv"),))
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
         # self.switch_import = True
         
-        # Load the dataframe
-        impedence_df_merged = pd.read_csv(self.path_signal, low_memory=False)
+        self.open_study(self.path_signal)
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def open_study(self, path, left_time=None):
+        '''
+        Aux function to load a processed study (csv or archive) and plot it,
+        optionally starting the view at left_time (ms).
+        '''
+        
+ 
+        if path in self.session.studies:
+            # Already open: show its tab
+            self.switch_study(path)
+        else:
+            # Load the signals and the labels (the archive blocks are decoded
+            # only when shown)
+            mode = self.storage_mode
+            study = read_study(path, mode)
+            self.add_study(path, study, lambda key: read_study(key, mode))
+            
+            # Update the catalog of the labels
+            self.catalog.register_study(path, study)
+        
+        self.path_signal = path
+
+        #plot the figure for the first time
+        if not self.switch_update:
+            self.plot_graph()
+        
+        if left_time is not None:
+            self.par_left_time = max(left_time - self.par_time_window/10, 
+                                                             self.par_min_time)
+            self.request_redraw()
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def search_labels(self):
+        '''
+        Aux function to search the labels of all the catalogued studies by 
+        category, minimum duration and age of the study. A double click on a
+        result opens the study at the time of the label.
+        '''
         
-        # Split the dataframe
-        self.impedence_df = impedence_df_merged[['Time(ms)','Value_1',
-                            'Value_2','Value_3','Value_4','Value_5','Value_6']]
-        self.df_ph = impedence_df_merged[ ['Time_ph(ms)','Value_ph']]
+        window = customtkinter.CTkToplevel(self.root)
+        window.title("Search labels")
+        window.geometry("600x400")
+        window.columnconfigure(list(range(4)), weight = 1)
+        window.rowconfigure(2, weight = 1)
+        
+        # Category of the labels
+        category = customtkinter.CTkOptionMenu(window, 
+                               values = ['All'] + self.catalog.categories())
+        category.grid(row=0, column=0, padx=5, pady=5, sticky="ew")
+        
+        # Minimum duration (s) and maximum age of the study (days)
+        min_duration = customtkinter.CTkEntry(window, 
+                                          placeholder_text="Min duration (s)")
+        min_duration.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+        
+        max_age = customtkinter.CTkEntry(window, 
+                                           placeholder_text="Last days")
+        max_age.grid(row=0, column=2, padx=5, pady=5, sticky="ew")
+        
+        results_text = customtkinter.CTkLabel(window, text=' ')
+        results_text.grid(row=1, column=0, columnspan=4, sticky="w", padx=5)
+        
+        results_list = Listbox(window, font = (" ",10))
+        results_list.grid(row=2, column=0, columnspan=4, padx=5, pady=5, 
+                                                                sticky="nsew")
+        results = []
+        
+        def search():
+            modified_after = None
+            if max_age.get().strip():
+                modified_after = time.time() - 86400*float(max_age.get())
+            
+            results[:] = self.catalog.query(
+                category = None if category.get() == 'All' else category.get(),
+                min_duration_ms = 1000*float(min_duration.get()) 
+                                  if min_duration.get().strip() else None,
+                modified_after = modified_after)
+            
+            results_list.delete(0, 'end')
+            for r in results:
+                results_list.insert('end', 
+                    os.path.basename(r['path']) + '   ' + r['category'] + 
+                    '   ' + self.time_to_string(r['start_ms']) + 
+                    '   ' + f"{r['duration_ms']/1000:.1f} s")
+            results_text.configure(text=str(len(results)) + ' labels')
+        
+        def open_selected(event):
+            selection = results_list.curselection()
+            if selection:
+                r = results[selection[0]]
+                self.open_study(r['path'], r['start_ms'])
+        
+        button_search = customtkinter.CTkButton(window, text="Search", 
+                                                             command=search)
+        button_search.grid(row=0, column=3, padx=5, pady=5, sticky="ew")
+        results_list.bind('<Double-Button-1>', open_selected)
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def time_to_string(self, t):
+        '''
+        Aux function to convert a time (ms) to the hh:mm:ss string.
+        '''
         
-        self.df_ph = self.df_ph.dropna()
-        self.time_ph = self.df_ph['Time_ph(ms)']
+        time_s = t*10**-3
+        ore = int(np.floor(time_s/3600))
+        minutes = int(np.floor((time_s - ore*3600)/60))
+        secondi = int(np.floor(time_s - ore*3600 - minutes*60))
         
-        self.switch_draw = True
+        if ore >= 24:
+            ore = ore-24
+        
+        return f'{ore:02}:{minutes:02}:{secondi:02}'
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def find_similar_labels(self):
+        '''
+        Aux function to search the whole recording for the intervals similar 
+        to a label, selected with a click (template). The ranked candidates 
+        are listed: a double click shows a candidate, "Add labels" labels the 
+        selected candidates (all if none is selected) with the category of 
+        the template. The candidates already labelled are marked with *.
+        '''
+        
+        if not self.switch_update:
+            return
+        
+        # Dectivate each button in the list    
+        for button in self.button_list:
+            button.configure(state="disabled",fg_color="light gray")
+        
+        # Temporary activate the tcross shape of the cursor
+        self.root.config(cursor = "tcross")
         
-        # Define the list of the signals
-        self.time_impedence = self.impedence_df['Time(ms)'].to_list()
-        self.signal_1 = self.impedence_df['Value_1'].to_list()
-        self.signal_2 = self.impedence_df['Value_2'].to_list()
-        self.signal_3 = self.impedence_df['Value_3'].to_list()
-        self.signal_4 = self.impedence_df['Value_4'].to_list()
-        self.signal_5 = self.impedence_df['Value_5'].to_list()
-        self.signal_6 = self.impedence_df['Value_6'].to_list()   
-        
-        if 'labels' in impedence_df_merged.keys():
-            # Import the labelling parameters
-            labelling_df = impedence_df_merged[['labels','intervals',
-                                                                'color_label']]
-            labelling_df = labelling_df.dropna()
+        def identify_template(event):
+            
+            if event.inaxes != self.ax:
+                return
+            
+            self.fig.canvas.mpl_disconnect(self.id)
+            self.root.config(cursor = "arrow")
+            for button in self.button_list:
+                button.configure(state="normal",fg_color="cornflower blue",
+                                               hover_color = "dark slate blue")
+            
+            x = event.xdata
+            selected = [n for n in range(len(self.x_values)) 
+                        if self.x_values[n][0] <= x <= self.x_values[n][1]]
+            if not selected:
+                return
+            n = selected[-1]
+            
+            # The workers read the archives (only their chunks are decoded)
+            parallel = str(self.path_signal).endswith(ARCHIVE_EXTENSION)
+            candidates, scores = find_similar(
+                Study(self.impedence_store, self.ph_store), 
+                self.x_values[n][0], self.x_values[n][1], 
+                n_workers=None if parallel else 1, 
+                path=self.path_signal if parallel else None)
+            self.show_similar(candidates, scores, self.category[n], 
+                                                      self.color_category[n])
+        
+        self.id = self.fig.canvas.mpl_connect('button_press_event',
+                                                            identify_template)
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def show_similar(self, candidates, scores, category, color):
+        '''
+        Aux function to list the candidates of the similarity search.
+        '''
+        
+        window = customtkinter.CTkToplevel(self.root)
+        window.title("Similar to " + category)
+        window.geometry("500x400")
+        window.columnconfigure(list(range(2)), weight = 1)
+        window.rowconfigure(1, weight = 1)
+        
+        results_text = customtkinter.CTkLabel(window, 
+                                 text=str(len(candidates)) + ' candidates')
+        results_text.grid(row=0, column=0, sticky="w", padx=5)
+        
+        results_list = Listbox(window, font = (" ",10), selectmode='extended')
+        results_list.grid(row=1, column=0, columnspan=2, padx=5, pady=5, 
+                                                                sticky="nsew")
+        
+        def labelled(candidate):
+            return any(c == category and x[0] <= candidate[1] and 
+                       x[1] >= candidate[0] 
+                       for c, x in zip(self.category, self.x_values))
+        
+        def fill():
+            results_list.delete(0, 'end')
+            for candidate, score in zip(candidates, scores):
+                results_list.insert('end', 
+                    ('* ' if labelled(candidate) else '  ') + 
+                    self.time_to_string(candidate[0]) + '   ' + 
+                    f"{(candidate[1] - candidate[0])/1000:.1f} s" + '   ' + 
+                    f"{score:.2f}")
+        
+        def show_selected(event):
+            selection = results_list.curselection()
+            if selection:
+                start = candidates[selection[0]][0]
+                self.par_left_time = min(max(start - self.par_time_window/10,
+                    self.par_min_time), self.par_max_time - self.par_time_window)
+                self.request_redraw()
+        
+        def add_labels():
+            selection = results_list.curselection() or \
+                                                    range(len(candidates))
+            for i in selection:
+                if not labelled(candidates[i]):
+                    self.x_values.append(list(candidates[i]))
+                    self.category.append(category)
+                    self.color_category.append(color)
+                    self.label_n = self.label_n + 1
+            fill()
+            self.request_redraw()
+        
+        button_add = customtkinter.CTkButton(window, text="Add labels", 
+                                                           command=add_labels)
+        button_add.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+        results_list.bind('<Double-Button-1>', show_selected)
+        fill()
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def compare_annotations(self):
+        '''
+        Aux function to compare the current labels with the labels of other
+        annotators of the same recording (processed studies). The agreement
+        is printed and the disagreements are shown in the whole time plot.
+        '''
+        
+        if not self.switch_update:
+            return
+        
+        paths = filedialog.askopenfilenames(
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
+        if not paths:
+            return
+        
+        label_sets = [(self.category, self.x_values)] + \
+                                      [read_labels(path)[:2] for path in paths]
+        names = ['current'] + [os.path.basename(path) for path in paths]
+        
+        self.agreement = compare_label_sets(label_sets, names, 
+                                             t_range=self.timeline.bounds())
+        print(summary(self.agreement))
+        
+        self.request_redraw()
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def export_training_set(self):
+        '''
+        Aux function to export the labelled windows of several processed 
+        studies as sharded arrays (with a manifest) to train a model.
+        '''
+        
+        paths = filedialog.askopenfilenames(
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
+        if not paths:
+            return
+        
+        out_dir = filedialog.askdirectory()
+        if not out_dir:
+            return
+        
+        manifest = export_training_set(list(paths), out_dir)
+        print("Exported windows: ", manifest['n_windows'], 
+                                     " (labelled: ", manifest['n_positives'], ")")
+    ###########################################################################        
+            
+            
+          
+    ###########################################################################    
+    def export_label_features(self):
+        '''
+        Aux function to write the table of the features of the labels (one 
+        row per label and impedance channel) of several processed studies.
+        '''
+        
+        paths = filedialog.askopenfilenames(
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
+        if not paths:
+            return
+        
+        out_dir = filedialog.askdirectory()
+        if not out_dir:
+            return
+        
+        extract_features(list(paths), out_dir)
+    ###########################################################################        
+            
+            
+          
+    ###########################################################################    
+    def event_gallery(self):
+        '''
+        Aux function to render a thumbnail of every labelled interval of 
+        several processed studies, with an index page opened in the browser.
+        '''
+        
+        paths = filedialog.askopenfilenames(
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
+        if not paths:
+            return
+        
+        out_dir = filedialog.askdirectory()
+        if not out_dir:
+            return
+        
+        index = render_gallery(list(paths), out_dir)
+        webbrowser.open('file://' + os.path.abspath(index))
+    ###########################################################################        
+            
+            
+          
+    ###########################################################################    
+    def print_report(self):
+        '''
+        Aux function to print a whole processed study as pages of strips of 
+        the current time window (PDF, or PNG pages in a folder).
+        '''
+        
+        path = filedialog.askopenfilename(
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
+        if not path:
+            return
+        
+        out_path = filedialog.asksaveasfilename(
+                                          filetypes = (("PDF Files","*.pdf"),
+                                                       ("PNG pages","*")))
+        if not out_path:
+            return
+        
+        # Strips of the shown time window (default window if none is shown)
+        render_report(path, out_path, getattr(self, 'par_time_window', 
+                                                             REPORT_WINDOW_MS))
+    ###########################################################################        
+            
+            
+          
+    ###########################################################################    
+    def event_average_view(self):
+        '''
+        Aux function to show the windows of all the channels aligned to the 
+        onsets of the labels of a category (mean and percentile band), for 
+        the current study or streaming several processed studies.
+        '''
+        
+        window = customtkinter.CTkToplevel(self.root)
+        window.title("Event-triggered average")
+        window.geometry("700x700")
+        window.columnconfigure(list(range(3)), weight = 1)
+        window.rowconfigure(1, weight = 1)
+        
+        category = customtkinter.CTkOptionMenu(window, values = CATEGORIES)
+        category.grid(row=0, column=0, padx=5, pady=5, sticky="ew")
+        
+        fig, axes = plt.subplots(7, 1, sharex=True, figsize=(7, 7))
+        plt.close(fig)
+        canvas = FigureCanvasTkAgg(fig, master=window)
+        canvas.get_tk_widget().grid(row=1, column=0, columnspan=3, 
+                                                 padx=5, pady=5, sticky="nsew")
+        
+        def show(studies):
+            average = event_average(studies, category.get())
+            
+            for ax in axes:
+                ax.cla()
+            
+            if average is None:
+                axes[0].set_title('No ' + category.get() + ' labels', 
+                                                     fontsize = self.fontsize)
+            else:
+                bands = list(average['percentiles'].values())
+                for k, ax in enumerate(axes[:len(average['names'])]):
+                    ax.fill_between(average['time'], bands[0][k], bands[-1][k], 
+                                         color = self.colors[k], alpha = 0.3)
+                    ax.plot(average['time'], average['mean'][k], 
+                                                       color = self.colors[k])
+                    ax.axvline(0, color = 'grey', linestyle = 'dashed')
+                    ax.set_ylabel(average['names'][k], fontsize = self.fontsize)
+                    ax.tick_params(labelsize = self.fontsize)
                     
-            self.category = labelling_df['labels'].to_list() 
-            self.x_values = []
-            tmp_intervals = labelling_df['intervals'].to_list()
-            self.color_category = []
-            tmp_color = labelling_df['color_label'].to_list()            
-            
-            
-            # Convert to correct datatype
-            for i in tmp_intervals:
-                self.x_values.append([
-                                   int(float(i.split(",")[0].replace('[',''))),
-                                  int(float(i.split(",")[1].replace(']','')))])
-                
-            for i in tmp_color:
-                self.color_category.append(i)
+                axes[0].set_title(category.get() + ': ' + 
+                    str(average['n_events']) + ' events, ' + 
+                    str(average['n_studies']) + ' studies', 
+                                                     fontsize = self.fontsize)
+                axes[-1].set_xlabel('Time from onset (ms)', 
+                                                     fontsize = self.fontsize)
+            canvas.draw_idle()
+        
+        def current_study():
+            if self.switch_update:
+                show([Study(self.impedence_store, self.ph_store, self.category,
+                            self.x_values, self.color_category)])
+        
+        def other_studies():
+            paths = filedialog.askopenfilenames(
+                                          filetypes = (("CSV Files","*.csv"),
+                                   ("Archive Files","*"+ARCHIVE_EXTENSION)))
+            if paths:
+                show(list(paths))
+        
+        button_current = customtkinter.CTkButton(window, text="Current study", 
+                                                       command=current_study)
+        button_current.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+        
+        button_studies = customtkinter.CTkButton(window, text="Studies...", 
+                                                       command=other_studies)
+        button_studies.grid(row=0, column=2, padx=5, pady=5, sticky="ew")
+    ###########################################################################        
+            
+            
+          
+    ###########################################################################    
+    def open_in_browser(self):
+        '''
+        Aux function to serve the current study (signals and labels) on a 
+        local tile server and to open its viewer in the browser.
+        '''
         
-            self.label_n = len(self.category)
-
-        #plot the figure for the first time
-        self.plot_graph()
+        if not self.switch_update:
+            return
+        
+        if self.tile_server is not None:
+            self.tile_server.stop()
+            self.session.unpin(self.tile_server)
+        
+        # The pyramids of the server are counted in the session budget
+        self.tile_server = TileServer(Study(self.impedence_store, 
+                    self.ph_store, self.category, self.x_values, 
+                                            self.color_category), port=0)
+        self.session.pin(self.tile_server)
+        url = self.tile_server.start()
+        print("Tile server: ", url)
+        webbrowser.open(url)
+    ###########################################################################        
+            
+            
+          
+    ###########################################################################    
+    def follow_file(self):
+        '''
+        Aux function to follow a raw export or a processed csv which is still
+        being written: the file is polled and only the appended bytes are 
+        parsed and added to the channel stores.
+        '''
+        
+        path = filedialog.askopenfilename(filetypes = (("Txt Files","*.txt"),
+                                                       ("CSV Files","*.csv")))
+        if not path:
+            return
+        
+        self.stop_follow()
+        self.tailer = StudyTailer(path, self.storage_mode)
+        self.follow_poll()
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################    
+    def follow_poll(self):
+        '''
+        Aux function called periodically in follow mode. The new samples 
+        extend the time bounds and the overview; the view follows the end of 
+        the recording if it was showing it.
+        '''
+        
+        self.follow_id = None
+        ready = self.tailer.study is not None
+        appended = self.tailer.poll()
+        
+        if not ready and self.tailer.study is not None:
+            # First poll with both the signals: show the study (its signals 
+            # are never released by the session)
+            self.add_study(self.tailer.path, self.tailer.study)
+            if not self.switch_update:
+                self.plot_graph()
+            
+        elif ready and any(len(t) for t in appended.values()) and \
+                                    self.session.active == self.tailer.path:
+            at_end = self.par_left_time + self.par_time_window >= \
+                                                             self.par_max_time
+            for name, time_appended in appended.items():
+                self.timeline.extend(name, time_appended)
+            
+            self.par_max_time = self.timeline.bounds('impedence')[1]
+            if at_end:
+                self.par_left_time = max(self.par_max_time - 
+                                   self.par_time_window, self.par_min_time)
+            
+            self.diary = self.tailer.diary
+            self.refresh_tail(min(t[0] for t in appended.values() if len(t)))
+            self.request_redraw()
+        
+        self.follow_id = self.root.after(POLL_MS, self.follow_poll)
+    ###########################################################################        
+    
+    
+    
+    ###########################################################################
+    def refresh_tail(self, t_new):
+        '''
+        Aux function to update the analyses of the followed study with the 
+        samples appended from t_new. The quality problems and the snap 
+        boundaries are scanned again on the tail of the signals (with some 
+        context before t_new: the problems and boundaries of its first half 
+        are kept from the previous scans) and the propagation of the labels 
+        reaching the tail is computed again when shown. The derived channels 
+        need nothing: their cached blocks are keyed by the samples they read.
+        '''
+        
+        entry = self.session.studies.get(self.tailer.path)
+        if entry is None or entry.study is None:
+            return
+        study, state = entry.study, entry.state
+        t_keep = t_new - TAIL_CONTEXT_MS/2
+        tail = tail_study(study, t_new - TAIL_CONTEXT_MS)
+        
+        if study.quality is not None:
+            study.quality = merge_quality(study.quality, scan_study(tail), 
+                                                                     t_keep)
+        if 'snap_index' in state:
+            state['snap_index'] = merge_snap_index(state['snap_index'], 
+                                            build_snap_index(tail), t_keep)
+        propagation = state.get('propagation', {})
+        for x in [x for x in propagation if max(x) >= t_keep]:
+            del propagation[x]
+        
+        if self.session.active == self.tailer.path:
+            self.quality = study.quality
+            self.snap_index = state.get('snap_index')
+    ###########################################################################
+    
+    
+    
+    ###########################################################################    
+    def stop_follow(self):
+        '''
+        Aux function to stop the follow mode.
+        '''
+        
+        if self.follow_id is not None:
+            self.root.after_cancel(self.follow_id)
+            self.follow_id = None
+        self.tailer = None
     ###########################################################################        
             
             
           
 ###############################################################################          
 #%% Start the GUI:
-gui = GUI_generate()
+if __name__ == '__main__':
+    multiprocessing.freeze_support()    # Process pools in the executable
+    gui = GUI_generate()
 ###############################################################################          
\ No newline at end of file
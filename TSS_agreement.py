@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inter-annotator agreement of the Time Series Scribe.
+Several label sets (category and x_values lists) of the same recording are
+compared per category with vectorized operations over the sorted interval
+arrays:
+    - event-level precision/recall/F1, matching the intervals with an IoU
+      threshold;
+    - sample-level Cohen's kappa (pairs of annotators, all the classes and
+      each category against the rest) and Fleiss' kappa (all the
+      annotators) on a regular time grid;
+    - disagreement intervals, where the annotators assign different classes.
+A whole cohort of recordings can be compared in parallel.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from TSS_archive import read_labels
+from TSS_features import gather_ranges
+
+
+
+#%% Parameters
+IOU_THRESHOLD = 0.5                 # Minimum IoU of two matching events
+RESOLUTION_MS = 100                 # Time grid of the sample-level metrics
+
+
+
+#%% Interval operations
+###############################################################################
+def category_intervals(category, x_values):
+    """
+    category: (list) category of each label
+    x_values: (list) [start, end] of each label
+    Returns a dictionary category -> (n, 2) array of intervals sorted by start.
+    """
+
+    category = np.asarray(category, dtype=object)
+    intervals = np.sort(np.array(x_values, dtype=np.float64).reshape(-1, 2),
+                                                                       axis=1)
+    result = {}
+    for name in np.unique(category) if len(category) else []:
+        selected = intervals[category == name]
+        result[str(name)] = selected[np.argsort(selected[:, 0], kind='stable')]
+    return result
+###############################################################################
+
+
+
+###############################################################################
+def overlapping_pairs(a, b):
+    """
+    a, b: ((n, 2) arrays) intervals sorted by start
+    Returns the indices (ia, ib) of all the pairs of overlapping intervals,
+    without building the full n x m matrix: for every interval of a only the
+    candidates of b found by searchsorted are considered.
+    """
+
+    if len(a) == 0 or len(b) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # Running maximum of the ends keeps the array sorted if b overlaps itself
+    b_end = np.maximum.accumulate(b[:, 1])
+    lo = np.searchsorted(b_end, a[:, 0], side='right')
+    hi = np.searchsorted(b[:, 0], a[:, 1], side='left')
+    counts = np.maximum(hi - lo, 0)
+
+    ia = np.repeat(np.arange(len(a)), counts)
+    ib = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                              counts) + np.repeat(lo, counts)
+
+    overlap = (np.minimum(a[ia, 1], b[ib, 1]) -
+                                       np.maximum(a[ia, 0], b[ib, 0])) > 0
+    return ia[overlap], ib[overlap]
+###############################################################################
+
+
+
+###############################################################################
+def interval_iou(a, b, ia, ib):
+    """
+    Returns the IoU of the pairs (a[ia], b[ib]).
+    """
+    intersection = np.minimum(a[ia, 1], b[ib, 1]) - \
+                                              np.maximum(a[ia, 0], b[ib, 0])
+    union = np.maximum(a[ia, 1], b[ib, 1]) - np.minimum(a[ia, 0], b[ib, 0])
+    return np.where(union > 0, intersection/np.where(union > 0, union, 1), 0)
+###############################################################################
+
+
+
+###############################################################################
+def event_agreement(a, b, iou_threshold=IOU_THRESHOLD):
+    """
+    a, b: ((n, 2) arrays) intervals of one category (a is the reference)
+    iou_threshold: (float) minimum IoU of two matching intervals
+    Returns the matched pairs and the event-level precision, recall and F1.
+    Each interval is matched at most once: greedy pass over the pairs by
+    decreasing IoU (only the overlapping pairs above the threshold).
+    """
+
+    ia, ib = overlapping_pairs(a, b)
+    iou = interval_iou(a, b, ia, ib)
+
+    keep = iou >= iou_threshold
+    ia, ib, iou = ia[keep], ib[keep], iou[keep]
+
+    # One-to-one matching: a pair is kept if neither interval is matched yet
+    used_a = np.zeros(len(a), dtype=bool)
+    used_b = np.zeros(len(b), dtype=bool)
+    selected = []
+    for k in np.argsort(-iou, kind='stable'):
+        if not used_a[ia[k]] and not used_b[ib[k]]:
+            used_a[ia[k]] = used_b[ib[k]] = True
+            selected.append(k)
+    selected = np.asarray(selected, dtype=np.int64)
+    selected = selected[np.argsort(ia[selected], kind='stable')]
+    ia, ib, iou = ia[selected], ib[selected], iou[selected]
+
+    tp = len(ia)
+    precision = tp/len(b) if len(b) else float(len(a) == 0)
+    recall = tp/len(a) if len(a) else float(len(b) == 0)
+    f1 = 2*tp/(len(a) + len(b)) if len(a) + len(b) else 1.0
+
+    return {'matches': np.stack([ia, ib], axis=1), 'iou': iou,
+            'tp': tp, 'fp': len(b) - tp, 'fn': len(a) - tp,
+            'precision': precision, 'recall': recall, 'f1': f1}
+###############################################################################
+
+
+
+#%% Sample-level operations
+###############################################################################
+def rasterize(category, x_values, classes, grid):
+    """
+    category: (list) category of each label
+    x_values: (list) [start, end] of each label
+    classes: (list) categories (class = position + 1, 0 is unlabelled)
+    grid: (array) times of the samples
+    Returns the class of every sample of the grid. If two labels overlap the
+    one starting later is kept (an enclosing label still covers its samples
+    after the end of a nested one).
+    """
+
+    raster = np.zeros(len(grid), dtype=np.int16)
+    lookup = {name: c+1 for c, name in enumerate(classes)}
+
+    intervals = np.sort(np.array(x_values, dtype=np.float64).reshape(-1, 2),
+                                                                       axis=1)
+    if len(intervals) == 0:
+        return raster
+
+    codes = np.array([lookup.get(c, 0) for c in category], dtype=np.int16)
+    order = np.argsort(intervals[:, 0], kind='stable')
+    intervals, codes = intervals[order], codes[order]
+
+    # Samples covered by each label: the latest starting label (highest
+    # rank) of each sample is kept
+    i0 = np.searchsorted(grid, intervals[:, 0], side='left')
+    i1 = np.searchsorted(grid, intervals[:, 1], side='right')
+    index, offsets = gather_ranges(i0, i1)
+    rank = np.zeros(len(grid), dtype=np.int64)
+    np.maximum.at(rank, index, np.repeat(np.arange(1, len(intervals)+1),
+                                                         np.diff(offsets)))
+    covered = rank > 0
+    raster[covered] = codes[rank[covered] - 1]
+    return raster
+###############################################################################
+
+
+
+###############################################################################
+def cohen_kappa(r1, r2, n_classes):
+    """
+    r1, r2: (arrays) classes of the samples for two annotators
+    n_classes: (int) number of classes (including the unlabelled one)
+    Returns Cohen's kappa of the two rasters.
+    """
+
+    confusion = np.bincount(r1.astype(np.int64)*n_classes + r2,
+                       minlength=n_classes**2).reshape(n_classes, n_classes)
+    total = confusion.sum()
+    if total == 0:
+        return 1.0
+
+    p_observed = np.trace(confusion)/total
+    p_expected = np.sum(confusion.sum(axis=0)*confusion.sum(axis=1))/total**2
+    if p_expected == 1:
+        return 1.0
+    return float((p_observed - p_expected)/(1 - p_expected))
+###############################################################################
+
+
+
+###############################################################################
+def fleiss_kappa(rasters, n_classes):
+    """
+    rasters: ((annotators, samples) array) classes of the samples
+    n_classes: (int) number of classes (including the unlabelled one)
+    Returns Fleiss' kappa of all the annotators.
+    """
+
+    n_raters, n_samples = rasters.shape
+    if n_raters < 2 or n_samples == 0:
+        return 1.0
+
+    # Number of annotators assigning each class to each sample
+    counts = np.zeros((n_samples, n_classes), dtype=np.int64)
+    for r in rasters:
+        counts[np.arange(n_samples), r] += 1
+
+    p_sample = (np.sum(counts**2, axis=1) - n_raters)/(n_raters*(n_raters-1))
+    p_class = counts.sum(axis=0)/(n_samples*n_raters)
+    p_observed, p_expected = p_sample.mean(), np.sum(p_class**2)
+    if p_expected == 1:
+        return 1.0
+    return float((p_observed - p_expected)/(1 - p_expected))
+###############################################################################
+
+
+
+###############################################################################
+def mask_to_intervals(mask, grid):
+    """
+    mask: (bool array) samples to group
+    grid: (array) times of the samples
+    Returns the (n, 2) array of the [start, end] times of the runs of True.
+    """
+
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    return np.stack([grid[starts], grid[ends]], axis=1).astype(np.float64)
+###############################################################################
+
+
+
+#%% Agreement of several label sets
+###############################################################################
+def compare_label_sets(label_sets, names=None, iou_threshold=IOU_THRESHOLD,
+                          resolution_ms=RESOLUTION_MS, t_range=None):
+    """
+    label_sets: (list) (category, x_values) of each annotator
+    names: (list) names of the annotators
+    iou_threshold: (float) minimum IoU of two matching events
+    resolution_ms: (float) time step of the sample-level grid
+    t_range: (tuple) time interval of the sample-level grid (default: union
+        of all the labels)
+    Returns a dictionary with the event-level metrics for each category and
+    pair of annotators, the pairwise Cohen's kappa (all the classes, and for
+    each category against the rest), Fleiss' kappa and the disagreement
+    intervals.
+    """
+
+    names = ['annotator_' + str(n+1) for n in range(len(label_sets))] \
+                                                    if names is None else names
+    per_annotator = [category_intervals(c, x) for c, x in label_sets]
+    classes = sorted(set().union(*[set(p) for p in per_annotator]))
+
+    # Event-level metrics (first annotator of each pair as reference)
+    events = {}
+    for i, j in combinations(range(len(label_sets)), 2):
+        for name in classes:
+            empty = np.empty((0, 2))
+            events[(names[i], names[j], name)] = event_agreement(
+                        per_annotator[i].get(name, empty),
+                        per_annotator[j].get(name, empty), iou_threshold)
+
+    # Sample-level metrics on a common grid
+    all_x = [np.array(x, dtype=np.float64).reshape(-1, 2) for _, x in
+                                                                 label_sets]
+    all_x = np.concatenate(all_x) if all_x else np.empty((0, 2))
+    if t_range is None:
+        t_range = (all_x.min(), all_x.max()) if len(all_x) else (0, 0)
+
+    grid = np.arange(t_range[0], t_range[1] + resolution_ms, resolution_ms)
+    rasters = np.stack([rasterize(c, x, classes, grid)
+                                             for c, x in label_sets])
+    n_classes = len(classes) + 1
+
+    kappa = {(names[i], names[j]): cohen_kappa(rasters[i], rasters[j],
+                                                                   n_classes)
+                     for i, j in combinations(range(len(label_sets)), 2)}
+
+    # One-vs-rest kappa of each category, from the same rasters
+    category_kappa = {}
+    for i, j in combinations(range(len(label_sets)), 2):
+        for c, name in enumerate(classes):
+            category_kappa[(names[i], names[j], name)] = cohen_kappa(
+                  (rasters[i] == c+1).astype(np.int64),
+                  (rasters[j] == c+1).astype(np.int64), 2)
+
+    disagreement = np.any(rasters != rasters[0], axis=0)
+
+    return {'annotators': names, 'classes': classes, 'events': events,
+            'kappa': kappa, 'category_kappa': category_kappa,
+            'fleiss_kappa': fleiss_kappa(rasters, n_classes),
+            'disagreements': mask_to_intervals(disagreement, grid),
+            'agreement_fraction': float(1 - disagreement.mean())
+                                                      if len(grid) else 1.0}
+###############################################################################
+
+
+
+###############################################################################
+def compare_study_files(paths, iou_threshold=IOU_THRESHOLD,
+                                            resolution_ms=RESOLUTION_MS):
+    """
+    paths: (list) processed studies of the same recording, one per annotator
+    Returns the agreement of their label sets (only the labels are read).
+    """
+
+    label_sets = [read_labels(path)[:2] for path in paths]
+    return compare_label_sets(label_sets, list(paths), iou_threshold,
+                                                                resolution_ms)
+###############################################################################
+
+
+
+###############################################################################
+def compare_cohort(groups, iou_threshold=IOU_THRESHOLD,
+                          resolution_ms=RESOLUTION_MS, n_workers=None):
+    """
+    groups: (list) for each recording, the list of its annotated studies
+    n_workers: (int) number of worker processes (None: number of cores)
+    Compares the annotators of every recording in parallel. Returns the list
+    of the agreement dictionaries (same order of groups).
+    """
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(compare_study_files, groups,
+                                 [iou_threshold]*len(groups),
+                                 [resolution_ms]*len(groups)))
+###############################################################################
+
+
+
+###############################################################################
+def summary(agreement):
+    """
+    Returns a short text summary of the agreement dictionary.
+    """
+
+    lines = ['Fleiss kappa: ' + f"{agreement['fleiss_kappa']:.3f}" +
+             '   agreement: ' + f"{100*agreement['agreement_fraction']:.1f} %"]
+
+    for (a, b), kappa in agreement['kappa'].items():
+        lines.append('Cohen kappa ' + str(a) + ' / ' + str(b) + ': ' +
+                                                             f'{kappa:.3f}')
+
+    for (a, b, name), result in agreement['events'].items():
+        lines.append(name + ' F1 ' + str(a) + ' / ' + str(b) + ': ' +
+                     f"{result['f1']:.3f}" + ' (TP ' + str(result['tp']) +
+                     ', FP ' + str(result['fp']) + ', FN ' +
+                                                    str(result['fn']) + ')' +
+                     '   kappa: ' +
+                     f"{agreement['category_kappa'][(a, b, name)]:.3f}")
+    return '\n'.join(lines)
+###############################################################################
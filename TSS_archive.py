@@ -0,0 +1,830 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chunked compressed archive of the studies processed by the Time Series Scribe.
+Each channel is split in fixed-size blocks of samples, the timestamps are
+delta-encoded, and every block is compressed independently so that any time
+window can be read without decompressing the whole file.
+
+File layout (.tssa):
+    MAGIC + VERSION | compressed blocks | json index | index length | MAGIC
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+import sys
+import json
+import time
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+
+import bz2
+import lzma
+import zlib
+
+import numpy as np
+
+from TSS_storage import (TimeBase, ChannelStore, Study, read_processed_csv,
+         read_processed_labels, IMPEDENCE_COLUMNS, PH_COLUMNS, INT16_NAN)
+from TSS_diary import diary_from_columns
+from TSS_quality import quality_from_columns
+
+
+
+#%% Parameters
+MAGIC = b'TSSA'                     # Magic bytes of the archive
+VERSION = 1                         # Version of the archive layout
+ARCHIVE_EXTENSION = '.tssa'         # Extension of the archive files
+
+BLOCK_SIZE = 32768                  # Samples per block
+CACHE_BYTES = 64*2**20              # Default budget of the block cache
+
+# Available codecs: name -> (compress, decompress). The stdlib codecs are
+# always available, zstd/lz4/blosc only if the corresponding wheel is
+# installed (or the stdlib provides zstd).
+CODECS = {
+    'zlib': (lambda b: zlib.compress(b, 1), zlib.decompress),
+    'bz2': (lambda b: bz2.compress(b, 9), bz2.decompress),
+    'lzma': (lambda b: lzma.compress(b, preset=1), lzma.decompress),
+    }
+
+try:
+    from compression import zstd as _zstd          # Python >= 3.14
+    CODECS['zstd'] = (lambda b: _zstd.compress(b, 3), _zstd.decompress)
+except ImportError:
+    try:
+        import zstandard as _zstd
+        CODECS['zstd'] = (
+                    lambda b: _zstd.ZstdCompressor(level=3).compress(b),
+                    lambda b: _zstd.ZstdDecompressor().decompress(b))
+    except ImportError:
+        pass
+
+try:
+    import lz4.frame as _lz4
+    CODECS['lz4'] = (_lz4.compress, _lz4.decompress)
+except ImportError:
+    pass
+
+try:
+    import blosc as _blosc
+    CODECS['blosc'] = (
+                lambda b: _blosc.compress(b, typesize=1, cname='lz4'),
+                                                          _blosc.decompress)
+except ImportError:
+    pass
+
+# Default codec: fastest available
+DEFAULT_CODEC = [c for c in ('zstd', 'lz4', 'blosc', 'zlib') if c in CODECS][0]
+
+
+
+#%% Block cache
+class BlockCache():
+
+    ###########################################################################
+    def __init__(self, max_bytes=CACHE_BYTES):
+        '''
+        max_bytes: (int) memory budget of the decoded blocks
+        LRU cache of the decoded blocks, bounded by the memory budget. The
+        first item of each key identifies the owner of the block (archive,
+        store, server), so that the blocks of a closed study can be dropped.
+        '''
+
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.blocks = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def get(self, key):
+        """
+        Returns the cached block (or None) and marks it as recently used.
+        """
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+            return block
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def put(self, key, block, nbytes=None):
+        """
+        Adds a block, evicting the least recently used ones over budget.
+        nbytes: (int) size of the block, if it is not an array (e.g. tuple)
+        """
+        with self.lock:
+            if key in self.blocks:
+                del self.blocks[key]
+                self.n_bytes -= self.sizes.pop(key)
+            self.blocks[key] = block
+            self.sizes[key] = block.nbytes if nbytes is None else nbytes
+            self.n_bytes += self.sizes[key]
+            self.evict()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def evict(self):
+        """
+        Drops the least recently used blocks over budget (lock held).
+        """
+        while self.n_bytes > self.max_bytes and len(self.blocks) > 1:
+            key, _ = self.blocks.popitem(last=False)
+            self.n_bytes -= self.sizes.pop(key)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def resize(self, max_bytes):
+        """
+        Changes the memory budget, evicting the blocks over the new one.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def discard(self, owners):
+        """
+        owners: (set) owners (first item of the keys) of the blocks to drop
+        """
+        with self.lock:
+            for key in [k for k in self.blocks if k[0] in owners]:
+                del self.blocks[key]
+                self.n_bytes -= self.sizes.pop(key)
+    ###########################################################################
+
+
+
+# Cache shared by the archives opened in the process
+block_cache = BlockCache()
+
+
+
+#%% Aux functions
+###############################################################################
+def shuffle_bytes(array):
+    """
+    Byte-shuffle of a numeric array (byte k of every item is stored
+    contiguously). It makes the typed values much more compressible.
+    """
+    array = np.ascontiguousarray(array)
+    return array.view(np.uint8).reshape(-1, array.itemsize).T.tobytes()
+###############################################################################
+
+
+
+###############################################################################
+def unshuffle_bytes(buffer, dtype):
+    """
+    Inverse of shuffle_bytes.
+    """
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(buffer, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).ravel()
+###############################################################################
+
+
+
+###############################################################################
+def encode_time(time):
+    """
+    time: (int64 array) timestamps of one block
+    Delta-encodes the timestamps. Returns the first value, the dtype and the
+    differences (int32 if they fit).
+    """
+    delta = np.diff(time)
+    dtype = np.int32 if (len(delta) == 0 or
+        (delta.min() >= np.iinfo(np.int32).min and
+                        delta.max() <= np.iinfo(np.int32).max)) else np.int64
+    return int(time[0]), np.dtype(dtype).str, delta.astype(dtype)
+###############################################################################
+
+
+
+###############################################################################
+def decode_time(first, delta):
+    """
+    Inverse of encode_time.
+    """
+    time = np.empty(len(delta)+1, dtype=np.int64)
+    time[0] = first
+    np.cumsum(delta, out=time[1:])
+    time[1:] += first
+    return time
+###############################################################################
+
+
+
+#%% Writer
+###############################################################################
+def write_archive(path, study, codec=None, block_size=BLOCK_SIZE):
+    """
+    path: (str) path of the archive to write
+    study: (Study) signals and labels to save
+    codec: (str) name of the codec (see CODECS), None for the default one
+    block_size: (int) number of samples of each block
+    Saves the study in the chunked compressed archive format.
+    """
+
+    codec = DEFAULT_CODEC if codec is None else codec
+    if codec not in CODECS:
+        raise ValueError('Codec not available: ' + str(codec))
+    compress = CODECS[codec][0]
+
+    index = {'version': VERSION, 'codec': codec, 'block_size': block_size,
+             'uid': uuid.uuid4().hex, 'stores': {},
+             'labels': {'category': list(study.category),
+                        'x_values': [[float(x[0]), float(x[1])]
+                                                   for x in study.x_values],
+                        'color_category': list(study.color_category)},
+             'diary': None if study.diary is None else
+                                                   study.diary.to_columns(),
+             'quality': None if study.quality is None else
+                                                   study.quality.to_columns()}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as archive:
+        archive.write(MAGIC + struct.pack('<I', VERSION))
+
+        def write_block(buffer):
+            offset = archive.tell()
+            data = compress(buffer)
+            archive.write(data)
+            return [offset, len(data)]
+
+        for name, store, time_name in (
+                          ('impedence', study.impedence, IMPEDENCE_COLUMNS[0]),
+                                      ('ph', study.ph, PH_COLUMNS[0])):
+            n = len(store)
+            starts = list(range(0, n, block_size))
+            raw_dtype = store.raw(0, 0, 1).dtype.str if n > 0 else \
+                                                     np.dtype(store.mode).str
+
+            entry = {'n': n, 'mode': store.mode, 'names': store.names,
+                     'time_name': time_name, 'dtype': raw_dtype,
+                     'scale': None if store.scale is None else
+                                         [float(s) for s in store.scale],
+                     'offset': None if store.offset is None else
+                                         [float(s) for s in store.offset],
+                     'time': None, 'time_blocks': [],
+                     'channels': [[] for _ in range(store.n_channels)]}
+
+            # Time: start and interval if regular, else delta-encoded blocks
+            if store.time.is_regular():
+                entry['time'] = {'start': store.time.start,
+                                                   'step': store.time.step}
+            else:
+                for i0 in starts:
+                    block = store.time[i0:i0+block_size]
+                    first, dtype, delta = encode_time(block)
+                    entry['time_blocks'].append({'i0': i0, 'n': len(block),
+                        'first': first, 'last': int(block[-1]),
+                        'dtype': dtype,
+                        'location': write_block(shuffle_bytes(delta))})
+
+            # Values: one compressed block per channel and time block
+            for k in range(store.n_channels):
+                for i0 in starts:
+                    entry['channels'][k].append(write_block(
+                        shuffle_bytes(store.raw(k, i0, i0+block_size))))
+
+            index['stores'][name] = entry
+
+        index_bytes = json.dumps(index).encode('utf-8')
+        archive.write(index_bytes)
+        archive.write(struct.pack('<Q', len(index_bytes)) + MAGIC)
+
+    os.replace(tmp_path, path)
+###############################################################################
+
+
+
+#%% Reader
+class ArchiveReader():
+
+    ###########################################################################
+    def __init__(self, path, cache=None):
+        '''
+        path: (str) path of the archive
+        cache: (BlockCache) cache of the decoded blocks (shared by default)
+        Reads the index of the archive. The blocks are read and decompressed
+        only when requested.
+        '''
+
+        self.path = path
+        self.cache = block_cache if cache is None else cache
+        self.lock = threading.Lock()
+        self.file = open(path, 'rb')
+
+        if self.file.read(4) != MAGIC:
+            raise ValueError(str(path) + ' is not a Time Series Scribe archive')
+
+        self.file.seek(-12, os.SEEK_END)
+        index_length = struct.unpack('<Q', self.file.read(8))[0]
+        if self.file.read(4) != MAGIC:
+            raise ValueError(str(path) + ' is truncated')
+
+        self.file.seek(-12-index_length, os.SEEK_END)
+        self.index = json.loads(self.file.read(index_length).decode('utf-8'))
+        self.decompress = CODECS[self.index['codec']][1] \
+            if self.index['codec'] in CODECS else None
+        self.block_size = self.index['block_size']
+        self.uid = self.index['uid']        # Identifies the blocks in cache
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def read_block(self, location, dtype, key):
+        """
+        location: (list) offset and length of the compressed block
+        dtype: (str) dtype of the decoded values
+        key: (tuple) key of the block in the cache
+        Returns the decoded block, reading it only if not already cached.
+        """
+
+        block = self.cache.get(key)
+        if block is not None:
+            return block
+
+        if self.decompress is None:
+            raise ValueError('Codec not available: ' + self.index['codec'])
+
+        with self.lock:
+            self.file.seek(location[0])
+            data = self.file.read(location[1])
+
+        block = unshuffle_bytes(self.decompress(data), dtype)
+        block.setflags(write=False)
+        self.cache.put(key, block)
+        return block
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def store(self, name):
+        """
+        Returns the ArchiveStore of the store name ('impedence' or 'ph').
+        """
+        return ArchiveStore(self, name)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def study(self):
+        """
+        Returns the Study with lazily decoded channels and the labels.
+        """
+        labels = self.index['labels']
+        diary = self.index.get('diary')
+        quality = self.index.get('quality')
+        return Study(self.store('impedence'), self.store('ph'),
+                     labels['category'],
+                     [[int(x[0]), int(x[1])] for x in labels['x_values']],
+                     labels['color_category'], path=self.path,
+                     diary=None if diary is None else diary_from_columns(diary),
+                     quality=None if quality is None else
+                                               quality_from_columns(quality))
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def close(self):
+        self.file.close()
+    ###########################################################################
+
+
+
+#%% Lazily decoded time base
+class ArchiveTimeBase():
+
+    ###########################################################################
+    def __init__(self, reader, name):
+        '''
+        reader: (ArchiveReader) archive to read
+        name: (str) name of the store
+        Time base decoded block by block. It exposes the same methods of
+        TimeBase.
+        '''
+
+        self.reader = reader
+        self.name = name
+        self.entry = reader.index['stores'][name]
+        self.n = self.entry['n']
+        self.blocks = self.entry['time_blocks']
+
+        # Per-block first/last time to locate the block of any time value
+        self.first = np.array([b['first'] for b in self.blocks], dtype=np.int64)
+        self.last = np.array([b['last'] for b in self.blocks], dtype=np.int64)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return self.n
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def time_block(self, b):
+        """
+        Returns the decoded timestamps of block b.
+        """
+        key = (self.reader.uid, self.name, 'time', b)
+        block = self.reader.cache.get(key)
+        if block is None:
+            entry = self.blocks[b]
+            delta = self.reader.read_block(entry['location'], entry['dtype'],
+                                  (self.reader.uid, self.name, 'delta', b))
+            block = decode_time(entry['first'], delta)
+            block.setflags(write=False)
+            self.reader.cache.put(key, block)
+        return block
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __getitem__(self, key):
+        '''
+        Returns a single time (int) or an int64 array for a slice or an
+        array of indices (only the blocks of the indices are decoded).
+        '''
+
+        block_size = self.reader.block_size
+
+        if not isinstance(key, slice) and np.ndim(key) > 0:
+            index = np.asarray(key, dtype=np.int64)
+            index = np.where(index < 0, index + self.n, index)
+            if np.any((index < 0) | (index >= self.n)):
+                raise IndexError('time index out of range')
+            result = np.empty(index.shape, dtype=np.int64)
+            blocks = index//block_size
+            for b in np.unique(blocks):
+                select = blocks == b
+                result[select] = self.time_block(int(b))[index[select] -
+                                                              b*block_size]
+            return result
+
+        if isinstance(key, slice):
+            i0, i1, di = key.indices(self.n)
+            if i1 <= i0:
+                return np.empty(0, dtype=np.int64)
+            parts = [self.time_block(b)[max(i0-b*block_size, 0):
+                                                      i1-b*block_size]
+                  for b in range(i0//block_size, (i1-1)//block_size + 1)]
+            return np.concatenate(parts)[::di]
+
+        key = int(key)
+        if key < 0:
+            key = key + self.n
+        if key < 0 or key >= self.n:
+            raise IndexError('time index out of range')
+        return int(self.time_block(key//block_size)[key % block_size])
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def is_regular(self):
+        return False
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def searchsorted(self, t, side='left'):
+        """
+        t: (float or array) time values (ms)
+        side: 'left' or 'right' as in numpy.searchsorted
+        Returns the insertion indices of t, decoding only the blocks where t
+        falls.
+        """
+
+        t_array = np.atleast_1d(np.asarray(t))
+        index = np.empty(len(t_array), dtype=np.int64)
+
+        # Block containing each value (from the per-block last time)
+        blocks = np.searchsorted(self.last, t_array, side=side)
+
+        for n, (value, b) in enumerate(zip(t_array, blocks)):
+            if b >= len(self.blocks):
+                index[n] = self.n
+            else:
+                index[n] = self.blocks[b]['i0'] + np.searchsorted(
+                                     self.time_block(b), value, side=side)
+
+        return int(index[0]) if np.ndim(t) == 0 else index
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def min(self):
+        return int(self.first.min()) if self.n > 0 else 0
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def max(self):
+        return int(self.last.max()) if self.n > 0 else 0
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def to_array(self):
+        return self[0:self.n]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        return self.first.nbytes + self.last.nbytes
+    ###########################################################################
+
+
+
+#%% Lazily decoded channel store
+class ArchiveStore():
+
+    ###########################################################################
+    def __init__(self, reader, name):
+        '''
+        reader: (ArchiveReader) archive to read
+        name: (str) name of the store ('impedence' or 'ph')
+        Channel store decoded block by block. It exposes the same methods of
+        ChannelStore.
+        '''
+
+        self.reader = reader
+        self.name = name
+        self.entry = reader.index['stores'][name]
+
+        self.mode = self.entry['mode']
+        self.names = self.entry['names']
+        self.dtype = self.entry['dtype']
+        self.scale = None if self.entry['scale'] is None else \
+                           np.array(self.entry['scale'], dtype=np.float32)
+        self.offset = None if self.entry['offset'] is None else \
+                           np.array(self.entry['offset'], dtype=np.float32)
+
+        if self.entry['time'] is not None:
+            self.time = TimeBase.from_regular(self.entry['time']['start'],
+                                self.entry['time']['step'], self.entry['n'])
+        else:
+            self.time = ArchiveTimeBase(reader, name)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return self.entry['n']
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def n_channels(self):
+        return len(self.names)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def raw(self, k, i0=0, i1=None):
+        """
+        k: (int) index of the channel
+        i0, i1: (int) slice of samples to return
+        Returns the stored values (codes for int16) of channel k in [i0, i1),
+        decoding only the blocks overlapping the slice.
+        """
+
+        i0, i1, _ = slice(i0, i1).indices(len(self))
+        if i1 <= i0:
+            return np.empty(0, dtype=self.dtype)
+
+        block_size = self.reader.block_size
+        parts = []
+        for b in range(i0//block_size, (i1-1)//block_size + 1):
+            block = self.reader.read_block(self.entry['channels'][k][b],
+                          self.dtype, (self.reader.uid, self.name, k, b))
+            parts.append(block[max(i0-b*block_size, 0):i1-b*block_size])
+
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def channel(self, k, i0=0, i1=None):
+        """
+        Returns the values of the channel k in [i0, i1) as float array.
+        """
+
+        raw = self.raw(k, i0, i1)
+        if self.mode != 'int16':
+            return raw
+
+        decoded = raw.astype(np.float32)*self.scale[k] + self.offset[k]
+        decoded[raw == INT16_NAN] = np.nan
+        return decoded
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def block(self, i0=0, i1=None):
+        """
+        Returns all the channels in [i0, i1) as a (n_channels, n) float array.
+        """
+        return np.stack([self.channel(k, i0, i1)
+                                             for k in range(self.n_channels)])
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        """
+        Resident memory of the store (the decoded blocks live in the cache).
+        """
+        return self.time.nbytes
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def to_dataframe(self, time_name):
+        """
+        Returns the store as a DataFrame with the time and channels columns.
+        """
+        return ChannelStore(self.time.to_array(), self.block(), self.names,
+                      'float64' if self.mode == 'float64' else 'float32'
+                                                 ).to_dataframe(time_name)
+    ###########################################################################
+
+
+
+###############################################################################
+def read_archive(path):
+    """
+    path: (str) path of the archive
+    Returns the Study of the archive, with channels decoded on demand.
+    """
+    return ArchiveReader(path).study()
+###############################################################################
+
+
+
+###############################################################################
+def read_study(path, mode='float32'):
+    """
+    path: (str) path of a processed csv or of an archive
+    mode: (str) storage mode of the channels read from csv
+    Returns the Study saved in the processed csv or in the archive.
+    """
+    if path.endswith(ARCHIVE_EXTENSION):
+        return read_archive(path)
+    return read_processed_csv(path, mode)
+###############################################################################
+
+
+
+###############################################################################
+def read_labels(path):
+    """
+    path: (str) path of a processed csv or of an archive
+    Returns the category, x_values and color_category lists of the labels
+    without loading the signals.
+    """
+
+    if path.endswith(ARCHIVE_EXTENSION):
+        reader = ArchiveReader(path)
+        labels = reader.index['labels']
+        reader.close()
+        return (labels['category'],
+                [[int(x[0]), int(x[1])] for x in labels['x_values']],
+                labels['color_category'])
+
+    return read_processed_labels(path)
+###############################################################################
+
+
+
+#%% Benchmark
+###############################################################################
+def benchmark_archive(csv_path, codecs=None, n_seeks=100,
+                                                   block_size=BLOCK_SIZE):
+    """
+    csv_path: (str) path of a processed csv
+    codecs: (list) codecs to compare (all the available ones by default)
+    n_seeks: (int) number of random windows read from each archive
+    block_size: (int) number of samples of each block
+    Compares the load time of the processed csv with the size, the write
+    time, the full decompression throughput and the random seek time of the
+    archive. Returns a list of dictionaries, one per format.
+    """
+
+    codecs = sorted(CODECS) if codecs is None else codecs
+    results = []
+
+    start = time.perf_counter()
+    study = read_processed_csv(csv_path)
+    csv_time = time.perf_counter() - start
+    raw_bytes = study.impedence.values.nbytes + study.ph.values.nbytes
+
+    results.append({'format': 'csv', 'size_MB': os.path.getsize(csv_path)/2**20,
+                    'write_s': None, 'load_s': csv_time,
+                    'throughput_MB_s': raw_bytes/2**20/csv_time,
+                    'seek_ms': None})
+
+    rng = np.random.default_rng(0)
+    window = 2*60*1000                                  # Default view: 2 min
+    t_min, t_max = study.impedence.time.min(), study.impedence.time.max()
+    lefts = rng.uniform(t_min, max(t_max - window, t_min), n_seeks)
+
+    for codec in codecs:
+        archive_path = os.path.splitext(csv_path)[0] + '_' + codec + \
+                                                          ARCHIVE_EXTENSION
+        start = time.perf_counter()
+        write_archive(archive_path, study, codec, block_size)
+        write_time = time.perf_counter() - start
+
+        # Full decompression (empty cache)
+        cache = BlockCache(0)
+        start = time.perf_counter()
+        reader = ArchiveReader(archive_path, cache)
+        for store in (reader.store('impedence'), reader.store('ph')):
+            store.time.to_array()
+            store.block()
+        load_time = time.perf_counter() - start
+
+        # Random windows (empty cache)
+        store = reader.store('impedence')
+        start = time.perf_counter()
+        for left in lefts:
+            i0 = store.time.searchsorted(left)
+            i1 = store.time.searchsorted(left + window)
+            store.block(i0, i1)
+        seek_time = (time.perf_counter() - start)/n_seeks
+        reader.close()
+
+        results.append({'format': codec,
+                        'size_MB': os.path.getsize(archive_path)/2**20,
+                        'write_s': write_time, 'load_s': load_time,
+                        'throughput_MB_s': raw_bytes/2**20/load_time,
+                        'seek_ms': 1000*seek_time})
+        os.remove(archive_path)
+
+    return results
+###############################################################################
+
+
+
+#%% Benchmark from the command line: python TSS_archive.py study.csv
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python TSS_archive.py processed_study.csv [codec ...]')
+        sys.exit(1)
+
+    print(f"{'format':>8} {'size MB':>9} {'write s':>8} {'load s':>8}"
+          f" {'MB/s':>8} {'seek ms':>8}")
+    for result in benchmark_archive(sys.argv[1], sys.argv[2:] or None):
+        print(f"{result['format']:>8} {result['size_MB']:9.2f}"
+              f" {result['write_s'] or 0:8.3f} {result['load_s']:8.3f}"
+              f" {result['throughput_MB_s']:8.1f}"
+              f" {result['seek_ms'] or 0:8.3f}")
+###############################################################################
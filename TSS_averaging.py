@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Event-triggered averaging of the Time Series Scribe.
+The windows of all the channels around the onsets of the labels of one
+category are gathered at once (index arithmetic on the channel array) and
+reduced to the mean and percentile bands of each channel. Many studies are
+streamed one at a time: the mean is exact, the percentiles are computed on a
+bounded reservoir sample of the windows.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import numpy as np
+
+from TSS_archive import read_study
+from TSS_timeline import TimelineIndex
+from TSS_export import sample_interval
+
+
+
+#%% Parameters
+PRE_MS = 2000                       # Time shown before the onsets (ms)
+POST_MS = 8000                      # Time shown after the onsets (ms)
+PERCENTILES = (10, 90)              # Percentile band of the plot
+MAX_EVENTS = 5000                   # Windows kept for the percentiles
+
+
+
+#%% Aux functions
+###############################################################################
+def onset_windows(study, category, pre_ms=PRE_MS, post_ms=POST_MS):
+    """
+    study: (Study) labelled study
+    category: (str) category of the labels
+    pre_ms, post_ms: (int) time before and after each onset (ms)
+    Returns the windows (n, channels, samples) aligned to the onsets of the
+    labels of the category (impedance channels plus the pH resampled on the
+    impedance grid), the sample interval (ms) and the names of the channels.
+    The windows crossing the borders of the recording are discarded.
+    """
+
+    time = study.impedence.time
+    n_time = len(time)
+    step = sample_interval(time)
+    n_pre = int(round(pre_ms/step))
+    n_samples = n_pre + int(round(post_ms/step))
+    names = list(study.impedence.names) + list(study.ph.names)
+
+    onsets = np.array([x[0] for c, x in zip(study.category, study.x_values)
+                                       if c == category], dtype=np.float64)
+    starts = np.asarray(time.searchsorted(onsets), dtype=np.int64) - n_pre
+    starts = starts[(starts >= 0) & (starts + n_samples <= n_time)]
+
+    if len(starts) == 0:
+        return (np.empty((0, len(names), n_samples), dtype=np.float32), step,
+                                                                        names)
+
+    # Single gather over the window indices (only the needed span is read)
+    s0, s1 = int(starts.min()), int(starts.max()) + n_samples
+    index = (starts - s0)[:, None] + np.arange(n_samples)[None, :]
+
+    timeline = TimelineIndex({'impedence': study.impedence, 'ph': study.ph})
+    channels = np.concatenate([study.impedence.block(s0, s1),
+        np.stack([timeline.resample('ph', k, 'impedence', s0, s1)
+                                          for k in range(study.ph.n_channels)])
+                                                   ]).astype(np.float32)
+
+    return channels[:, index].transpose(1, 0, 2), step, names
+###############################################################################
+
+
+
+#%% Streaming accumulator
+class EventAverage():
+
+    ###########################################################################
+    def __init__(self, max_events=MAX_EVENTS, seed=0):
+        '''
+        max_events: (int) windows kept (reservoir sample) for the percentiles
+        seed: (int) seed of the reservoir sampling
+        Accumulates the windows of one or more studies: exact sum and sum of
+        squares for the mean and the standard deviation, and a bounded
+        uniform sample of the windows for the percentile bands.
+        '''
+
+        self.max_events = max_events
+        self.rng = np.random.default_rng(seed)
+        self.n_events = 0
+        self.n_studies = 0
+        self.sum = None
+        self.sum_sq = None
+        self.reservoir = None
+        self.step = None
+        self.names = None
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def add(self, windows, step, names):
+        """
+        windows: ((n, channels, samples) array) windows of one study
+        step: (float) sample interval of the windows (ms)
+        names: (list) names of the channels
+        """
+
+        if self.sum is None:
+            shape = windows.shape[1:]
+            self.sum = np.zeros(shape, dtype=np.float64)
+            self.sum_sq = np.zeros(shape, dtype=np.float64)
+            self.reservoir = np.empty((self.max_events,) + shape,
+                                                            dtype=np.float32)
+            self.step = step
+            self.names = list(names)
+        elif windows.shape[1:] != self.sum.shape:
+            raise ValueError('Windows of shape ' + str(windows.shape[1:]) +
+                             ' instead of ' + str(self.sum.shape) +
+                             ' (different channels or sampling)')
+
+        self.n_studies = self.n_studies + 1
+        n = len(windows)
+        if n == 0:
+            return
+
+        self.sum += windows.sum(axis=0, dtype=np.float64)
+        self.sum_sq += np.square(windows, dtype=np.float64).sum(axis=0)
+
+        # Reservoir sampling: event i is kept with probability max_events/i
+        count = self.n_events + np.arange(1, n+1)
+        slots = np.where(count <= self.max_events, count - 1,
+                              (self.rng.random(n)*count).astype(np.int64))
+        keep = slots < self.max_events
+        self.reservoir[slots[keep]] = windows[keep]
+
+        self.n_events = self.n_events + n
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def result(self, pre_ms=PRE_MS, percentiles=PERCENTILES):
+        """
+        pre_ms: (int) time before the onsets (ms)
+        percentiles: (tuple) percentiles of the bands
+        Returns a dictionary with the time axis relative to the onset (ms),
+        the mean, the standard deviation and the percentiles of each channel
+        ((channels, samples) arrays), the names and the number of events.
+        """
+
+        if self.n_events == 0:
+            return None
+
+        mean = self.sum/self.n_events
+        std = np.sqrt(np.maximum(self.sum_sq/self.n_events - mean**2, 0))
+        sample = self.reservoir[:min(self.n_events, self.max_events)]
+
+        # nanpercentile only if needed (missing int16 samples), it is slower
+        percentile = np.nanpercentile if np.isnan(sample).any() else \
+                                                                np.percentile
+
+        n_samples = self.sum.shape[1]
+        return {'time': np.arange(n_samples)*self.step - pre_ms,
+                'mean': mean.astype(np.float32),
+                'std': std.astype(np.float32),
+                'percentiles': dict(zip(percentiles, percentile(
+                            sample, percentiles, axis=0).astype(np.float32))),
+                'names': self.names,
+                'n_events': self.n_events,
+                'n_studies': self.n_studies}
+    ###########################################################################
+
+
+
+###############################################################################
+def event_average(studies, category, pre_ms=PRE_MS, post_ms=POST_MS,
+                    percentiles=PERCENTILES, max_events=MAX_EVENTS):
+    """
+    studies: (list) Study objects or paths of processed studies
+    category: (str) category of the labels
+    pre_ms, post_ms: (int) time before and after each onset (ms)
+    percentiles: (tuple) percentiles of the bands
+    max_events: (int) windows kept for the percentiles
+    Returns the event-triggered average (EventAverage.result) of the labels
+    of the category. The paths are loaded one at a time.
+    """
+
+    average = EventAverage(max_events)
+
+    for study in studies:
+        if isinstance(study, str):
+            study = read_study(study)
+        average.add(*onset_windows(study, category, pre_ms, post_ms))
+
+    return average.result(pre_ms, percentiles)
+###############################################################################
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory and latency regression harness of the Time Series Scribe.
+The core paths of the GUI are run headless (no window: inert widgets, Agg
+canvas, scripted file dialogs) on generated raw recordings of increasing
+length: raw import (import_signal_raw), processed load (import_signal), a
+scripted sequence of pans and zooms drawn by update_graph, and save
+(save_processed_signal). Each operation is measured in a fresh process:
+latency and peak resident memory in one run, peak of the Python allocations
+(tracemalloc, which slows the operations) in another one. The run fails if
+an operation exceeds its declared budget or grows super-linearly with the
+length of the recording.
+
+Usage: python TSS_benchmark.py [hours of the recordings, e.g. 1 2 4]
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+import gc
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+
+#%% Parameters
+HOURS = (1, 2, 4)                   # Lengths of the generated recordings (h)
+IMPEDENCE_HZ = 50                   # Sampling rate of the impedance (Hz)
+PH_HZ = 1                           # Sampling rate of the pH (Hz)
+T_START = 8*3600*1000               # Start of the recordings (ms, 08:00)
+
+OPERATIONS = ['import_raw', 'import_processed', 'navigate', 'save']
+
+# Budgets of each operation: fixed part plus part per impedance sample
+# (peak traced allocations in bytes, latency in seconds)
+BUDGETS = {
+    'import_raw':       {'bytes': (64*2**20, 400), 'seconds': (5, 2e-5)},
+    'import_processed': {'bytes': (64*2**20, 400), 'seconds': (5, 2e-5)},
+    'navigate':         {'bytes': (64*2**20, 100), 'seconds': (10, 5e-6)},
+    'save':             {'bytes': (64*2**20, 400), 'seconds': (5, 2e-5)},
+    }
+RSS_BUDGET = (512*2**20, 400)       # Peak resident memory of a whole run
+
+MAX_EXPONENT = 1.3                  # Maximum growth exponent with the length
+MIN_LENGTHS = 3                     # Lengths needed to fit the exponent
+TIMING_RUNS = 3                     # Timed runs (fastest kept: less noise)
+MIN_SECONDS = 1.0                   # Latency below which growth is noise
+MIN_BYTES = 16*2**20                # Allocations below which growth is noise
+
+# Scripted navigation: pans of the window and zooms (slider, minutes)
+N_PANS = 10
+ZOOMS = [0.5, 5, 10, 2]
+
+
+
+#%% Headless GUI
+class HeadlessWidget():
+
+    ###########################################################################
+    def __init__(self, *args, value=None, **kwargs):
+        '''
+        Stand-in of the widgets, of the Tk variables and of the windows:
+        every call is accepted and get/set keep a value.
+        '''
+
+        self.value = value
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+    def after(self, delay, function, *args):
+        return None                         # The harness calls the redraws
+
+    def mainloop(self):
+        return None
+
+    def __call__(self, *args, **kwargs):
+        return HeadlessWidget(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return HeadlessWidget()
+    ###########################################################################
+
+
+
+class ScriptedDialog():
+
+    ###########################################################################
+    def __init__(self):
+        '''
+        Stand-in of the file dialogs: they return the paths queued by the
+        harness, in order.
+        '''
+
+        self.paths = []
+
+    def askopenfilename(self, *args, **kwargs):
+        return self.paths.pop(0)
+
+    def asksaveasfilename(self, *args, **kwargs):
+        return self.paths.pop(0)
+    ###########################################################################
+
+
+
+###############################################################################
+def headless_gui():
+    """
+    Returns the GUI built without window and the scripted file dialog. The
+    figure is drawn on an Agg canvas (draw_idle renders at once).
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import GUI_TimeSeriesScribe as gui
+
+    class HeadlessCanvas(FigureCanvasAgg):
+        def __init__(self, figure, master=None):
+            super().__init__(figure)
+
+        def get_tk_widget(self):
+            return HeadlessWidget()
+
+        def draw_idle(self, *args, **kwargs):
+            self.draw()
+
+    dialog = ScriptedDialog()
+    for name in ('customtkinter', 'Menu', 'StringVar', 'BooleanVar',
+                                                                 'Listbox'):
+        setattr(gui, name, HeadlessWidget())
+    gui.filedialog = dialog
+    gui.FigureCanvasTkAgg = HeadlessCanvas
+
+    return gui.GUI_generate(), dialog
+###############################################################################
+
+
+
+#%% Aux functions
+###############################################################################
+def generate_recording(path, hours, seed=0):
+    """
+    path: (str) path of the raw .txt
+    hours: (float) length of the recording
+    seed: (int) seed of the noise
+    Writes a raw export (pH, impedance and diary sections) with slow waves,
+    noise and impedance drops. Returns the number of impedance samples.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = int(hours*3600*IMPEDENCE_HZ)
+    n_ph = int(hours*3600*PH_HZ)
+    time_impedence = T_START + np.arange(n, dtype=np.int64)*(1000//IMPEDENCE_HZ)
+    time_ph = T_START + np.arange(n_ph, dtype=np.int64)*(1000//PH_HZ)
+
+    ph = 5 + 2*np.sin(time_ph/3e5) + rng.normal(0, 0.1, n_ph)
+    impedence = 3 + np.sin(time_impedence[None, :]/3e4 +
+                    np.arange(6)[:, None]) + rng.normal(0, 0.05, (6, n))
+    for start in rng.integers(0, n - 500, max(n//30000, 1)):
+        impedence[:, start:start + 500] *= 0.3
+
+    with open(path, 'w') as opener:
+        opener.write('Patient\tBenchmark\nStudy\t1\n')
+        opener.write('Ph Array\nTime\tpH\n-\t-\n-\t-\n')
+        pd.DataFrame({0: time_ph, 1: ph}).to_csv(opener, sep='\t',
+                          header=False, index=False, float_format='%.2f')
+        opener.write('\nImpedance Array\nTime\tZ\n-\t-\n-\t-\n')
+        pd.DataFrame(np.column_stack([time_impedence, impedence.T])).astype(
+            {0: np.int64}).to_csv(opener, sep='\t', header=False,
+                                          index=False, float_format='%.3f')
+        opener.write('\nDiary\nTime\tEvent\n')
+        opener.write(str(T_START + 600000) + '\tMeal Start\n' +
+                     str(T_START + 1800000) + '\tMeal End\n' +
+                     str(T_START + 2400000) + '\tSupine\n')
+
+    return n
+###############################################################################
+
+
+
+###############################################################################
+def navigate(gui):
+    """
+    Scripted sequence of pans and zooms, each one drawn by update_graph.
+    """
+
+    for value in ZOOMS:
+        gui.slider_1.set(value)
+        gui.slider_event(value)
+        gui.redraw()
+        for _ in range(N_PANS):
+            gui.right_shift()
+            gui.redraw()
+        gui.minor_left_shift()
+        gui.redraw()
+###############################################################################
+
+
+
+###############################################################################
+def run_operations(args):
+    """
+    args: (tuple) raw recording, working directory and True to trace the
+        allocations
+    Worker: runs the operations on a headless GUI, in order. Returns the
+    latency (s) and the peak traced allocations (bytes, if traced) of each
+    operation, and the peak resident memory of the process (bytes).
+    """
+
+    raw_path, work_dir, trace = args
+    os.chdir(work_dir)                      # Catalog of the run
+    processed = os.path.join(work_dir, 'processed.csv')
+    saved = os.path.join(work_dir, 'saved.csv')
+
+    gui, dialog = headless_gui()
+
+    def import_raw():
+        dialog.paths = [raw_path, processed]    # Saved as processed csv
+        gui.import_signal_raw()
+
+    def import_processed():
+        gui.close_study()
+        dialog.paths = [processed]
+        gui.import_signal()
+
+    def save():
+        dialog.paths = [saved]
+        gui.save_processed_signal()
+
+    steps = {'import_raw': import_raw, 'import_processed': import_processed,
+             'navigate': lambda: navigate(gui), 'save': save}
+
+    results = {}
+    for name in OPERATIONS:
+        gc.collect()
+        if trace:
+            tracemalloc.start()
+        t0 = time.perf_counter()
+        steps[name]()
+        latency = time.perf_counter() - t0
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = {'seconds': latency, 'bytes': peak}
+
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['rss'] = rss if sys.platform == 'darwin' else rss*1024
+
+    return results
+###############################################################################
+
+
+
+###############################################################################
+def measure(raw_path, work_dir):
+    """
+    Returns the latency (fastest of the timed runs) and the traced
+    allocations of the operations on a recording, each run in a fresh
+    process.
+    """
+
+    results = {name: {'seconds': np.inf} for name in OPERATIONS}
+    results['rss'] = 0
+    for trace in [False]*TIMING_RUNS + [True]:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            run = executor.submit(run_operations,
+                                  (raw_path, work_dir, trace)).result()
+        for name in OPERATIONS:
+            if trace:
+                results[name]['bytes'] = run[name]['bytes']
+            else:
+                results[name]['seconds'] = min(results[name]['seconds'],
+                                                      run[name]['seconds'])
+        if not trace:
+            results['rss'] = max(results['rss'], run['rss'])
+
+    return results
+###############################################################################
+
+
+
+###############################################################################
+def check(sizes, results):
+    """
+    sizes: (list) impedance samples of the recordings
+    results: (list) measures of each recording (measure)
+    Returns the failures: budgets exceeded and super-linear growth (least
+    squares exponent across the recordings measured above the noise floor,
+    at least MIN_LENGTHS).
+    """
+
+    failures = []
+
+    for n, result in zip(sizes, results):
+        for name in OPERATIONS:
+            for metric, (fixed, per_sample) in BUDGETS[name].items():
+                budget = fixed + per_sample*n
+                if result[name][metric] > budget:
+                    failures.append(name + ' ' + metric + ' ' +
+                        format_value(metric, result[name][metric]) + ' > ' +
+                        format_value(metric, budget) + ' (' + str(n) +
+                                                               ' samples)')
+        budget = RSS_BUDGET[0] + RSS_BUDGET[1]*n
+        if result['rss'] > budget:
+            failures.append('peak RSS ' + format_value('bytes',
+                  result['rss']) + ' > ' + format_value('bytes', budget) +
+                                               ' (' + str(n) + ' samples)')
+
+    if len(sizes) < MIN_LENGTHS:
+        return failures
+
+    # Growth exponent: slope of the log-log line through the recordings
+    # measured above the noise floor (at least MIN_LENGTHS of them)
+    floors = {'seconds': MIN_SECONDS, 'bytes': MIN_BYTES}
+    log_sizes = np.log(sizes)
+    for name in OPERATIONS:
+        for metric, floor in floors.items():
+            values = np.array([result[name][metric] for result in results])
+            above = values >= floor
+            if np.count_nonzero(above) < MIN_LENGTHS:
+                continue
+            exponent = np.polyfit(log_sizes[above], np.log(values[above]),
+                                                                       1)[0]
+            if exponent > MAX_EXPONENT:
+                failures.append(name + ' ' + metric + ' grows as n^' +
+                                f'{exponent:.2f}' + ' (max ' +
+                                                   str(MAX_EXPONENT) + ')')
+
+    return failures
+###############################################################################
+
+
+
+###############################################################################
+def format_value(metric, value):
+    """
+    Returns a measure as text (s or MB).
+    """
+    if metric == 'seconds':
+        return f'{value:.2f} s'
+    return f'{value/2**20:.1f} MB'
+###############################################################################
+
+
+
+###############################################################################
+def run_benchmark(hours=HOURS, work_dir=None):
+    """
+    hours: (list) lengths of the generated recordings, increasing (doubled
+        up to MIN_LENGTHS lengths)
+    work_dir: (str) directory of the recordings (None: temporary)
+    Measures the operations on every recording, prints the table and the
+    failures. Returns the failures.
+    """
+
+    hours = list(hours)
+    while len(hours) < MIN_LENGTHS:
+        hours.append(2*hours[-1])
+
+    temporary = work_dir is None
+    work_dir = tempfile.mkdtemp() if temporary else work_dir
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    sizes, results = [], []
+    try:
+        for h in hours:
+            run_dir = os.path.join(work_dir, str(h) + 'h')
+            os.makedirs(run_dir, exist_ok=True)
+            raw_path = os.path.join(run_dir, 'raw.txt')
+            sizes.append(generate_recording(raw_path, h))
+            results.append(measure(raw_path, run_dir))
+
+            print(f'{h:g} h ({sizes[-1]} samples), peak RSS ' +
+                                    format_value('bytes', results[-1]['rss']))
+            for name in OPERATIONS:
+                print(f'    {name:<18}' +
+                      f"{format_value('seconds', results[-1][name]['seconds']):>10}" +
+                      f"{format_value('bytes', results[-1][name]['bytes']):>12}")
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    failures = check(sizes, results)
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if not failures:
+        print('All the operations within budget')
+
+    return failures
+###############################################################################
+
+
+
+#%% Run the harness
+if __name__ == "__main__":
+    hours = [float(h) for h in sys.argv[1:]] or HOURS
+    sys.exit(1 if run_benchmark(sorted(hours)) else 0)
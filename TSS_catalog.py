@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cross-study annotation catalog of the Time Series Scribe.
+A local SQLite database keeps the metadata of every saved or imported study
+and all its labelled intervals (category, start, end, duration, colour), with
+indexes on category and duration, so that the labels of thousands of studies
+can be queried without opening the studies.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+import time
+import sqlite3
+
+import numpy as np
+
+
+
+#%% Parameters
+CATALOG_NAME = 'TSS_catalog.sqlite'     # Default name of the database
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS studies (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT,
+    start_ms INTEGER,
+    end_ms INTEGER,
+    n_samples INTEGER,
+    n_labels INTEGER,
+    modified REAL,
+    indexed REAL
+);
+CREATE TABLE IF NOT EXISTS labels (
+    id INTEGER PRIMARY KEY,
+    study_id INTEGER NOT NULL REFERENCES studies(id) ON DELETE CASCADE,
+    category TEXT NOT NULL,
+    start_ms REAL NOT NULL,
+    end_ms REAL NOT NULL,
+    duration_ms REAL NOT NULL,
+    color TEXT
+);
+CREATE INDEX IF NOT EXISTS labels_category ON labels(category, duration_ms);
+CREATE INDEX IF NOT EXISTS labels_duration ON labels(duration_ms);
+CREATE INDEX IF NOT EXISTS labels_study ON labels(study_id);
+CREATE INDEX IF NOT EXISTS studies_modified ON studies(modified);
+'''
+
+
+
+#%% Catalog
+class AnnotationCatalog():
+
+    ###########################################################################
+    def __init__(self, path=None):
+        '''
+        path: (str) path of the SQLite database (created if missing)
+        '''
+
+        self.path = os.path.join(os.getcwd(), CATALOG_NAME) if path is None \
+                                                                      else path
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def register_study(self, path, study):
+        """
+        path: (str) path of the saved/imported study
+        study: (Study) signals and labels of the study
+        Adds (or replaces) the study and all its labels in the catalog.
+        """
+
+        path = os.path.abspath(path)
+        modified = os.path.getmtime(path) if os.path.exists(path) else None
+        time_base = study.impedence.time
+
+        intervals = np.array(study.x_values, dtype=np.float64).reshape(-1, 2)
+        rows = [(str(c), float(x[0]), float(x[1]), float(x[1]-x[0]), str(col))
+                for c, x, col in zip(study.category, intervals,
+                                                      study.color_category)]
+
+        with self.connection:
+            self.connection.execute('DELETE FROM studies WHERE path = ?',
+                                                                     (path,))
+            cursor = self.connection.execute(
+                'INSERT INTO studies (path, name, start_ms, end_ms, '
+                'n_samples, n_labels, modified, indexed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, os.path.basename(path), time_base.min(),
+                 time_base.max(), len(time_base), len(rows), modified,
+                                                                 time.time()))
+            study_id = cursor.lastrowid
+
+            self.connection.executemany(
+                'INSERT INTO labels (study_id, category, start_ms, end_ms, '
+                'duration_ms, color) VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(study_id,) + row for row in rows])
+        return study_id
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def remove_study(self, path):
+        """
+        Removes the study (and its labels) from the catalog.
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM studies WHERE path = ?',
+                                                     (os.path.abspath(path),))
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def query(self, category=None, min_duration_ms=None, max_duration_ms=None,
+                              modified_after=None, modified_before=None,
+                                                                   limit=None):
+        """
+        category: (str) category of the labels (None for all)
+        min_duration_ms, max_duration_ms: (float) bounds of the duration
+        modified_after, modified_before: (float) bounds of the modification
+            time of the studies (seconds since the epoch)
+        limit: (int) maximum number of returned labels
+        Returns the matching labels as a list of dictionaries with the path of
+        the study, the category, start, end, duration and colour.
+        """
+
+        conditions, parameters = [], []
+        for column, operator, value in (
+                                ('l.category', '=', category),
+                                ('l.duration_ms', '>=', min_duration_ms),
+                                ('l.duration_ms', '<=', max_duration_ms),
+                                ('s.modified', '>=', modified_after),
+                                ('s.modified', '<=', modified_before)):
+            if value is not None:
+                conditions.append(column + ' ' + operator + ' ?')
+                parameters.append(value)
+
+        sql = ('SELECT s.path, l.category, l.start_ms, l.end_ms, '
+               'l.duration_ms, l.color FROM labels l '
+               'JOIN studies s ON s.id = l.study_id')
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY s.path, l.start_ms'
+        if limit is not None:
+            sql += ' LIMIT ' + str(int(limit))
+
+        keys = ('path', 'category', 'start_ms', 'end_ms', 'duration_ms',
+                                                                     'color')
+        return [dict(zip(keys, row))
+                            for row in self.connection.execute(sql, parameters)]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def categories(self):
+        """
+        Returns the categories present in the catalog.
+        """
+        return [row[0] for row in self.connection.execute(
+                   'SELECT DISTINCT category FROM labels ORDER BY category')]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def studies(self):
+        """
+        Returns the metadata of the catalogued studies.
+        """
+        keys = ('path', 'name', 'start_ms', 'end_ms', 'n_samples', 'n_labels',
+                                                        'modified', 'indexed')
+        return [dict(zip(keys, row)) for row in self.connection.execute(
+                    'SELECT ' + ', '.join(keys) + ' FROM studies ORDER BY path')]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def close(self):
+        self.connection.close()
+    ###########################################################################
+
+
+
+###############################################################################
+def index_directory(directory, catalog, read_study, extensions=('.csv',)):
+    """
+    directory: (str) folder with the processed studies
+    catalog: (AnnotationCatalog) catalog to fill
+    read_study: (function) loader of the studies (path -> Study)
+    extensions: (tuple) extensions of the studies to index
+    Adds to the catalog the studies not indexed yet (or modified since).
+    Returns the number of indexed studies.
+    """
+
+    indexed = {s['path']: s['modified'] for s in catalog.studies()}
+    count = 0
+
+    for name in sorted(os.listdir(directory)):
+        path = os.path.abspath(os.path.join(directory, name))
+        if not name.endswith(tuple(extensions)):
+            continue
+        if indexed.get(path) == os.path.getmtime(path):
+            continue
+
+        catalog.register_study(path, read_study(path))
+        count = count + 1
+
+    return count
+###############################################################################
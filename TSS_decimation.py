@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decimation of the traces plotted by the Time Series Scribe.
+A trace with more samples than the pixels of the figure is reduced to the
+minimum and the maximum of each bin, in their time order, so that the peaks
+are preserved while the number of plotted points stays bounded.
+The same reduction is computed at decreasing resolutions (pyramid), so
+that a tile of any time range is read at a bounded cost. The levels are
+computed when first read and then kept by the pyramid (never evicted: a
+level is computed from the whole recording).
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import numpy as np
+
+
+
+#%% Parameters
+N_POINTS = 2000                     # Default number of bins of a trace
+FACTOR = 4                          # Reduction between pyramid levels
+TILE_SIZE = 1024                    # Bins of each tile of the pyramid
+CHUNK_SIZE = 2**20                  # Samples read at once (pyramid build)
+
+
+
+#%% Aux functions
+###############################################################################
+def decimate_minmax(time, values, n_bins=N_POINTS):
+    """
+    time: (array) time of the samples
+    values: (array) values of the samples
+    n_bins: (int) maximum number of bins
+    Returns the decimated time and values: for every bin the minimum and the
+    maximum sample (in time order). Traces shorter than 2*n_bins samples are
+    returned unchanged.
+    """
+
+    time = np.asarray(time)
+    values = np.asarray(values)
+    n = len(values)
+
+    if n <= 2*n_bins:
+        return time, values
+
+    k = int(np.ceil(n/n_bins))              # Samples per bin
+    m = n//k                                # Number of full bins
+
+    binned = values[:m*k].reshape(m, k)
+    finite = np.isfinite(binned)
+    i_min = np.argmin(np.where(finite, binned, np.inf), axis=1)
+    i_max = np.argmax(np.where(finite, binned, -np.inf), axis=1)
+
+    # Keep the time order of the minimum and the maximum of each bin
+    first = np.minimum(i_min, i_max) + k*np.arange(m)
+    second = np.maximum(i_min, i_max) + k*np.arange(m)
+    index = np.stack([first, second], axis=1).ravel()
+
+    # Remaining samples of the last (partial) bin
+    index = np.concatenate([index, np.arange(m*k, n)])
+    return time[index], values[index]
+###############################################################################
+
+
+
+#%% Decimation pyramid
+class MinMaxPyramid():
+
+    ###########################################################################
+    def __init__(self, store, factor=FACTOR, tile_size=TILE_SIZE,
+                                                     chunk_size=CHUNK_SIZE):
+        '''
+        store: (channel store) channels of a study
+        factor: (int) reduction between consecutive levels
+        tile_size: (int) number of bins of each tile
+        chunk_size: (int) samples read at once to build the first level
+        Min/max pyramid of the channels: level 0 is the store itself, level l
+        holds the minimum and maximum of each run of factor**l samples. Any
+        tile (level, index) is read in O(tile_size), whatever the zoom.
+        The levels are computed when first read and kept (nbytes: memory to
+        count in the budget of the session).
+        '''
+
+        self.store = store
+        self.factor = factor
+        self.tile_size = tile_size
+        self.chunk_size = max(chunk_size//factor, 1)*factor
+        self.levels = {}                    # Computed levels (>= 1)
+
+        # Number of bins of each level, until a level fits in a tile
+        self.lengths = [len(store)]
+        while self.lengths[-1] > tile_size:
+            self.lengths.append(-(-self.lengths[-1]//factor))
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def n_levels(self):
+        return len(self.lengths)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        """
+        Memory of the computed levels.
+        """
+        return sum(a.nbytes for data in self.levels.values() for a in data)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def level_length(self, level):
+        """
+        Returns the number of bins of the level.
+        """
+        return self.lengths[level]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def level(self, level):
+        """
+        Returns the time (start of each bin), the minimum and the maximum
+        ((n_channels, bins) arrays) of a level >= 1, computed when first
+        read (level 1 streamed from the store, chunk by chunk, the higher
+        levels from the previous one).
+        """
+
+        data = self.levels.get(level)
+        if data is not None:
+            return data
+
+        if level == 1:
+            n = len(self.store)
+            times, mins, maxs = [], [], []
+            for i0 in range(0, n, self.chunk_size):
+                i1 = min(i0 + self.chunk_size, n)
+                values = self.store.block(i0, i1)
+                starts = np.arange(0, i1 - i0, self.factor)
+                times.append(self.store.time[i0:i1][starts])
+                mins.append(np.fmin.reduceat(values, starts, axis=1))
+                maxs.append(np.fmax.reduceat(values, starts, axis=1))
+            data = (np.concatenate(times),
+                    np.concatenate(mins, axis=1).astype(np.float32),
+                    np.concatenate(maxs, axis=1).astype(np.float32))
+        else:
+            time, lower, upper = self.level(level - 1)
+            starts = np.arange(0, len(time), self.factor)
+            data = (time[starts], np.fmin.reduceat(lower, starts, axis=1),
+                                  np.fmax.reduceat(upper, starts, axis=1))
+
+        self.levels[level] = data
+        return data
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def level_time(self, level):
+        """
+        Returns the time (start of each bin) of the level.
+        """
+        return self.store.time if level == 0 else self.level(level)[0]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def level_for(self, t_min, t_max, n_points):
+        """
+        t_min, t_max: (float) time range (ms)
+        n_points: (int) number of bins to show
+        Returns the finest level with at most n_points bins in the range.
+        """
+
+        time = self.store.time
+        count = int(time.searchsorted(t_max)) - int(time.searchsorted(t_min))
+        level = 0
+        while level < self.n_levels - 1 and count > n_points:
+            count = count/self.factor
+            level = level + 1
+        return level
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def tile_range(self, level, t_min, t_max):
+        """
+        Returns the indices of the tiles of the level covering [t_min, t_max].
+        """
+
+        time = self.level_time(level)
+        i0 = max(int(time.searchsorted(t_min, side='right')) - 1, 0)
+        i1 = max(int(time.searchsorted(t_max)), i0 + 1)
+        return range(i0//self.tile_size, (i1 - 1)//self.tile_size + 1)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def tile(self, level, index):
+        """
+        level: (int) level of the pyramid
+        index: (int) index of the tile in the level
+        Returns the time (start of each bin), the minimum and the maximum
+        ((n_channels, bins) arrays) of the tile.
+        """
+
+        i0 = index*self.tile_size
+        i1 = min(i0 + self.tile_size, self.level_length(level))
+
+        if level == 0:
+            values = self.store.block(i0, i1)
+            return self.store.time[i0:i1], values, values
+
+        time, lower, upper = self.level(level)
+        return time[i0:i1], lower[:, i0:i1], upper[:, i0:i1]
+    ###########################################################################
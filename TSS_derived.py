@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Derived channels of the Time Series Scribe.
+A derived channel is declared as a vectorized function of some stored
+channels (baseline impedance, moving average, first derivative, cross-channel
+minimum, ...). It is computed lazily, only for the blocks of samples that are
+shown, and each block is memoized in a bounded cache keyed by
+(channel, parameters, block).
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import numpy as np
+
+from TSS_archive import block_cache
+
+
+
+#%% Parameters
+BLOCK_SIZE = 16384                  # Samples per computed block
+
+
+
+#%% Vectorized functions of the channels
+###############################################################################
+def moving_average(values, time, window=50):
+    """
+    values: ((n_sources, n) array) source channels (the first one is used)
+    time: (array) time of the samples
+    window: (int) number of samples of the centred window
+    Centred moving average computed with the cumulative sum.
+    """
+
+    x = np.asarray(values[0], dtype=np.float64)
+    window = max(int(window), 1)
+    padded = np.pad(x, (window//2, window - 1 - window//2), mode='edge')
+    cumsum = np.concatenate([[0], np.cumsum(padded)])
+    return ((cumsum[window:] - cumsum[:-window])/window).astype(np.float32)
+###############################################################################
+
+
+
+###############################################################################
+def baseline(values, time, window=1500, at=None):
+    """
+    values: ((n_sources, n) array) source channels (the first one is used)
+    time: (array) time of the samples
+    window: (int) number of samples of each segment
+    at: (int array) samples where the baseline is returned (None: all)
+    Baseline impedance: median of consecutive segments of the channel,
+    linearly interpolated between the segment centres.
+    """
+
+    x = np.asarray(values[0], dtype=np.float32)
+    n = len(x)
+    window = max(min(int(window), n), 1)
+    m = int(np.ceil(n/window))
+
+    padded = np.full(m*window, np.nan, dtype=np.float32)
+    padded[:n] = x
+    segments = padded.reshape(m, window)
+    
+    # nanmedian only for the segments with missing samples (and the padded
+    # last one), it is much slower
+    medians = np.median(segments, axis=1)
+    missing = np.isnan(medians)
+    if np.any(missing):
+        medians[missing] = np.nanmedian(segments[missing], axis=1)
+    centres = np.minimum(np.arange(m)*window + window//2, n-1)
+
+    return np.interp(np.arange(n) if at is None else at, centres, 
+                                                   medians).astype(np.float32)
+###############################################################################
+
+
+
+###############################################################################
+def derivative(values, time):
+    """
+    values: ((n_sources, n) array) source channels (the first one is used)
+    time: (array) time of the samples (ms)
+    First derivative of the channel (units per second).
+    """
+    if len(time) < 2:
+        return np.zeros(len(time), dtype=np.float32)
+    return (1000*np.gradient(np.asarray(values[0], dtype=np.float64),
+                                   np.asarray(time, dtype=np.float64))
+                                                          ).astype(np.float32)
+###############################################################################
+
+
+
+###############################################################################
+def channel_minimum(values, time):
+    """
+    values: ((n_sources, n) array) source channels
+    time: (array) time of the samples
+    Minimum across the source channels, sample by sample.
+    """
+    return np.nanmin(values, axis=0).astype(np.float32)
+###############################################################################
+
+
+
+#%% Derived channel
+class DerivedChannel():
+
+    ###########################################################################
+    def __init__(self, name, function, sources, params=None, margin=0,
+                                   align=1, row=None, offset=0, gain=1):
+        '''
+        name: (str) name of the derived channel
+        function: (function) f(values, time, **params) -> values, vectorized
+            over the samples of the source channels
+        sources: (list) indices of the source channels in the store
+        params: (dict) parameters of the function
+        margin: (int) samples needed before/after each block (e.g. half the
+            window of a moving average)
+        align: (int) the samples read for each block start and end on
+            multiples of align (e.g. the segments of the baseline, so that
+            every block sees the segments of the whole recording)
+        row: (int) source channel whose row of the plot shows the trace
+        offset: (float) vertical offset of the trace inside the row
+        gain: (float) scale of the trace in the plot
+        '''
+
+        self.name = name
+        self.function = function
+        self.sources = list(sources)
+        self.params = {} if params is None else dict(params)
+        self.margin = int(margin)
+        self.align = max(int(align), 1)
+        self.row = self.sources[0] if row is None else row
+        self.offset = offset
+        self.gain = gain
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def key(self):
+        """
+        Identifies the channel and its parameters in the block cache.
+        """
+        return (self.name, self.function.__name__, tuple(self.sources),
+                                        tuple(sorted(self.params.items())))
+    ###########################################################################
+
+
+
+#%% Derived channels of a store
+class DerivedChannels():
+
+    ###########################################################################
+    def __init__(self, store, block_size=BLOCK_SIZE, cache=None):
+        '''
+        store: (channel store) stored channels of a study
+        block_size: (int) samples of each computed block
+        cache: (BlockCache) cache of the computed blocks (shared by default)
+        '''
+
+        self.store = store
+        self.block_size = block_size
+        self.cache = block_cache if cache is None else cache
+        self.channels = {}                  # name -> DerivedChannel
+        self.active = []                    # names of the shown channels
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def add(self, derived, active=False):
+        """
+        Declares a derived channel (optionally shown).
+        """
+        self.channels[derived.name] = derived
+        if active and derived.name not in self.active:
+            self.active.append(derived.name)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def set_active(self, name, active):
+        """
+        Shows (or hides) the derived channel name.
+        """
+        if active and name not in self.active:
+            self.active.append(name)
+        elif not active and name in self.active:
+            self.active.remove(name)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def block_range(self, derived, b):
+        """
+        Returns the samples [i0, i1) of the block b of the derived channel and
+        the samples [j0, j1) read to compute it: the block plus the margin of
+        the function, extended to multiples of its alignment.
+        """
+
+        n = len(self.store)
+        align = derived.align
+        i0 = b*self.block_size
+        i1 = min(i0 + self.block_size, n)
+        j0 = max((i0 - derived.margin)//align*align, 0)
+        j1 = min(-(-(i1 + derived.margin)//align)*align, n)
+        return i0, i1, j0, j1
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def compute_block(self, derived, b):
+        """
+        Computes the block b of the derived channel, reading the source
+        channels on the block plus the margin of the function.
+        """
+
+        i0, i1, j0, j1 = self.block_range(derived, b)
+
+        values = np.stack([self.store.channel(k, j0, j1)
+                                                  for k in derived.sources])
+        result = derived.function(values, self.store.time[j0:j1],
+                                                          **derived.params)
+        block = np.ascontiguousarray(result[i0-j0:i1-j0], dtype=np.float32)
+        block.setflags(write=False)
+        return block
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def channel(self, name, i0=0, i1=None):
+        """
+        name: (str) name of the derived channel
+        i0, i1: (int) slice of samples to return
+        Returns the derived channel in [i0, i1), computing (and caching) only
+        the blocks not already computed.
+        """
+
+        derived = self.channels[name]
+        i0, i1, _ = slice(i0, i1).indices(len(self.store))
+        if i1 <= i0:
+            return np.empty(0, dtype=np.float32)
+
+        parts = []
+        for b in range(i0//self.block_size, (i1-1)//self.block_size + 1):
+            # The samples read by the block are part of the key, so that the 
+            # last blocks are recomputed when the store grows
+            end = self.block_range(derived, b)[3]
+            key = (id(self.store), derived.key, b, end)
+            block = self.cache.get(key)
+            if block is None:
+                block = self.compute_block(derived, b)
+                self.cache.put(key, block)
+            parts.append(block[max(i0-b*self.block_size, 0):
+                                                   i1-b*self.block_size])
+
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+    ###########################################################################
+
+
+
+###############################################################################
+def default_derived_channels(store, sample_ms=20):
+    """
+    store: (channel store) impedance channels of a study
+    sample_ms: (float) sample interval of the store (ms)
+    Returns the DerivedChannels of the store with the standard traces: per
+    channel baseline (30 s median), moving average (1 s), first derivative
+    (shown as change per sample), and the minimum across all the channels.
+    """
+
+    derived = DerivedChannels(store)
+    n_channels = store.n_channels
+    mavg = max(int(round(1000/sample_ms)), 1)
+    base = max(int(round(30000/sample_ms)), 1)
+
+    for k in range(n_channels):
+        derived.add(DerivedChannel('Baseline ' + str(k+1), baseline, [k],
+                        {'window': base}, margin=base, align=base))
+        derived.add(DerivedChannel('Moving average ' + str(k+1),
+                  moving_average, [k], {'window': mavg}, margin=mavg))
+        derived.add(DerivedChannel('Derivative ' + str(k+1), derivative, [k],
+                             margin=1, offset=3.5, gain=sample_ms/1000))
+
+    derived.add(DerivedChannel('Minimum', channel_minimum,
+                                          list(range(n_channels)), row=0))
+    return derived
+###############################################################################
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Diary of the recordings of the Time Series Scribe.
+The Diary section of the raw export (meals, body position, symptoms) is
+parsed in a typed, time-sorted event table. The table gives the next and
+previous event with searchsorted and the meal/supine periods, which can be
+used as label candidates.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import re
+
+import numpy as np
+
+
+
+#%% Parameters
+# Types of the diary events and keywords identifying them (lower case)
+DIARY_TYPES = ['Meal', 'Meal end', 'Supine', 'Upright', 'Symptom', 'Other']
+DIARY_KEYWORDS = [
+    ('Meal end', ('meal end', 'end meal', 'meal stop', 'stop meal',
+                                             'meal off', 'end of meal')),
+    ('Meal', ('meal', 'eat', 'food', 'drink', 'breakfast', 'lunch',
+                                                                'dinner')),
+    ('Upright', ('upright', 'stand', 'sitting', 'wake')),
+    ('Supine', ('supine', 'lying', 'recumbent', 'sleep', 'bed')),
+    ('Symptom', ('heartburn', 'regurgitation', 'cough', 'pain', 'symptom',
+                  'reflux', 'belch', 'burp', 'nausea', 'vomit', 'acid')),
+    ]
+
+# Colors of the diary markers in the whole time plot
+DIARY_COLORS = {'Meal': '#cc78bc', 'Meal end': '#cc78bc', 'Supine': '#0173b2',
+                'Upright': '#029e73', 'Symptom': '#d55e00', 'Other': '#949494'}
+
+MEAL_DURATION_MS = 30*60*1000       # Meal duration if the end is missing
+DAY_MS = 24*3600*1000               # Duration of a day (ms)
+
+# Columns of the diary in the processed csv
+DIARY_COLUMNS = ['diary_time','diary_type','diary_text']
+
+
+
+#%% Diary table
+class DiaryTable():
+
+    ###########################################################################
+    def __init__(self, time, kind, text):
+        '''
+        time: (array-like) time of the events (ms)
+        kind: (array-like) type of the events (names in DIARY_TYPES)
+        text: (array-like) original text of the events
+        The events are sorted by time.
+        '''
+
+        time = np.asarray(time, dtype=np.int64).ravel()
+        codes = np.array([DIARY_TYPES.index(k) if k in DIARY_TYPES else
+                          DIARY_TYPES.index('Other') for k in kind],
+                                                             dtype=np.int8)
+        text = np.array(list(text), dtype=object).ravel()
+
+        order = np.argsort(time, kind='stable')
+        self.time = time[order]
+        self.codes = codes[order] if len(codes) else codes
+        self.text = text[order] if len(text) else text
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return len(self.time)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def kind(self):
+        """
+        Type of each event (names in DIARY_TYPES).
+        """
+        return [DIARY_TYPES[c] for c in self.codes]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def next_event(self, t):
+        """
+        Returns the index of the first event after t (None if there is none).
+        """
+        i = int(np.searchsorted(self.time, t, side='right'))
+        return i if i < len(self.time) else None
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def previous_event(self, t):
+        """
+        Returns the index of the last event before t (None if there is none).
+        """
+        i = int(np.searchsorted(self.time, t, side='left')) - 1
+        return i if i >= 0 else None
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def periods(self, start_kind, end_kinds, max_duration_ms=None):
+        """
+        start_kind: (str) type of the events starting a period
+        end_kinds: (tuple) types of the events ending a period
+        max_duration_ms: (int) duration of the periods without end (None:
+            until the end of the diary)
+        Returns the (n, 2) array of the [start, end] times of the periods: each
+        start event is closed by the first following end event.
+        """
+
+        start_code = DIARY_TYPES.index(start_kind)
+        end_codes = [DIARY_TYPES.index(k) for k in end_kinds]
+
+        starts = self.time[self.codes == start_code]
+        ends = self.time[np.isin(self.codes, end_codes)]
+
+        i = np.searchsorted(ends, starts, side='right')
+        last = self.time[-1] if len(self.time) else 0
+        default = starts + max_duration_ms if max_duration_ms is not None \
+                              else np.full(len(starts), last, dtype=np.int64)
+        closed = np.where(i < len(ends), ends[np.minimum(i, len(ends)-1)]
+                                         if len(ends) else default, default)
+
+        # A period also stops at the next start of the same type
+        following = np.append(starts[1:], np.iinfo(np.int64).max)
+        closed = np.minimum(closed, following)
+
+        periods = np.stack([starts, closed], axis=1)
+        return periods[periods[:, 1] > periods[:, 0]]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def meal_periods(self):
+        """
+        Returns the [start, end] times of the meals.
+        """
+        return self.periods('Meal', ('Meal end',), MEAL_DURATION_MS)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def supine_periods(self):
+        """
+        Returns the [start, end] times of the supine periods.
+        """
+        return self.periods('Supine', ('Upright',))
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def to_columns(self):
+        """
+        Returns the diary as a dictionary of columns (DIARY_COLUMNS).
+        """
+        return {DIARY_COLUMNS[0]: self.time.tolist(),
+                DIARY_COLUMNS[1]: self.kind,
+                DIARY_COLUMNS[2]: [str(t) for t in self.text]}
+    ###########################################################################
+
+
+
+#%% Aux functions
+###############################################################################
+def classify_event(text):
+    """
+    text: (str) description of the diary event
+    Returns the type of the event (one of DIARY_TYPES).
+    """
+    text = text.lower()
+    for kind, keywords in DIARY_KEYWORDS:
+        # Keywords match the beginning of a word ('eat' matches 'eating')
+        if any(re.search(r'\b' + keyword, text) for keyword in keywords):
+            return kind
+    return 'Other'
+###############################################################################
+
+
+
+###############################################################################
+def parse_time(field, t_start=None):
+    """
+    field: (str) time of the event, in ms or as hh:mm(:ss)
+    t_start: (int) start of the recording (ms), to place clock times after
+        midnight on the following day
+    Returns the time in ms (None if the field is not a time).
+    """
+
+    field = field.strip()
+    if re.fullmatch(r'-?\d+', field):
+        return int(field)
+
+    match = re.fullmatch(r'(\d{1,2}):(\d{2})(?::(\d{2}))?(?:\.(\d+))?', field)
+    if match is None:
+        return None
+
+    ore, minutes, secondi = (int(match.group(1)), int(match.group(2)),
+                                             int(match.group(3) or 0))
+    t = 1000*(3600*ore + 60*minutes + secondi)
+    if t_start is not None and t < t_start - DAY_MS/2:
+        t = t + DAY_MS
+    return t
+###############################################################################
+
+
+
+###############################################################################
+def parse_diary_lines(lines, t_start=None):
+    """
+    lines: (list) lines of the Diary section (after the 'Diary' line)
+    t_start: (int) start of the recording (ms)
+    Returns the DiaryTable of the events. Each event line holds a time (in ms
+    or as clock time) and a description, separated by tabs; the other lines
+    (headers) are skipped.
+    """
+
+    time, kind, text = [], [], []
+
+    for line in lines:
+        fields = [f.strip() for f in line.rstrip('\n').split('\t')]
+        fields = [f for f in fields if f]
+        if len(fields) < 2:
+            continue
+
+        # First field holding a time, the rest is the description
+        for n, field in enumerate(fields):
+            t = parse_time(field, t_start)
+            if t is not None:
+                break
+        if t is None:
+            continue
+
+        description = ' '.join(fields[:n] + fields[n+1:])
+        time.append(t)
+        kind.append(classify_event(description))
+        text.append(description)
+
+    return DiaryTable(time, kind, text)
+###############################################################################
+
+
+
+###############################################################################
+def read_diary(path, start_line, t_start=None):
+    """
+    path: (str) path of the raw .txt file
+    start_line: (int) index of the 'Diary' line
+    t_start: (int) start of the recording (ms)
+    Returns the DiaryTable of the Diary section.
+    """
+    with open(path, 'r') as opener:
+        lines = [line for n, line in enumerate(opener) if n > start_line]
+    return parse_diary_lines(lines, t_start)
+###############################################################################
+
+
+
+###############################################################################
+def diary_from_columns(columns):
+    """
+    columns: (dict or DataFrame) diary columns (DIARY_COLUMNS)
+    Returns the DiaryTable saved with the processed study.
+    """
+    time = np.asarray(columns[DIARY_COLUMNS[0]], dtype=np.float64)
+    valid = np.isfinite(time)
+    return DiaryTable(time[valid].astype(np.int64),
+                      np.asarray(columns[DIARY_COLUMNS[1]], dtype=object)[valid],
+                      np.asarray(columns[DIARY_COLUMNS[2]], dtype=object)[valid])
+###############################################################################
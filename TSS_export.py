@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Training-set exporter of the Time Series Scribe.
+Fixed-length windows are cut from the labelled processed studies: positives
+centred on the labelled intervals (x_values/category) and negatives sampled
+away from any label. Each window holds the 6 impedance channels plus the pH
+resampled on the impedance grid.
+The windows are either streamed by a generator (to feed a training loop) or
+written in sharded .npy arrays with a json manifest, processing the studies
+in parallel (one study at a time per worker to bound the memory).
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from TSS_archive import read_study
+from TSS_timeline import TimelineIndex
+
+
+
+#%% Parameters
+# Categories of the labelling buttons (class 0 is the background)
+CATEGORIES = ['Reflux', 'Mixed Reflux', 'Erutation', 'Swallow', 'Meal']
+
+WINDOW_MS = 10000                   # Length of each window (ms)
+GATHER_SAMPLES = 2**19              # Span of samples read at once (windows)
+SHARD_SIZE = 4096                   # Windows per shard
+MANIFEST_NAME = 'manifest.json'     # Name of the manifest file
+
+
+
+#%% Aux functions
+###############################################################################
+def sample_interval(time):
+    """
+    time: (TimeBase) time base of a store
+    Returns the (median) sample interval in ms.
+    """
+    if time.is_regular():
+        return time.step
+    return float(np.median(np.diff(time[0:min(len(time), 100000)])))
+###############################################################################
+
+
+
+###############################################################################
+def study_windows(study, window_ms=WINDOW_MS, categories=CATEGORIES,
+                                       negatives_per_positive=1, seed=0):
+    """
+    study: (Study) labelled study
+    window_ms: (int) length of each window (ms)
+    categories: (list) categories exported (class = position + 1)
+    negatives_per_positive: (float) number of background windows per label
+    seed: (int) seed of the negative sampling
+    Returns the windows (n, channels, samples) as float32, the classes (n,)
+    and the start time of each window. The windows are gathered by index
+    arithmetic on spans of at most GATHER_SAMPLES samples (windows sorted by
+    start), so the memory does not depend on the length of the recording.
+    """
+
+    time = study.impedence.time
+    n_time = len(time)
+    n_samples = int(round(window_ms/sample_interval(time)))
+    n_channels = study.impedence.n_channels + study.ph.n_channels
+
+    empty = (np.empty((0, n_channels, n_samples), dtype=np.float32),
+             np.empty(0, dtype=np.int16), np.empty(0, dtype=np.int64))
+    if n_time < n_samples:
+        return empty
+
+    # Positives: windows centred on the labelled intervals
+    classes = {name: c+1 for c, name in enumerate(categories)}
+    keep = [n for n, name in enumerate(study.category) if name in classes]
+    intervals = np.array([study.x_values[n] for n in keep],
+                                           dtype=np.float64).reshape(-1, 2)
+    y_pos = np.array([classes[study.category[n]] for n in keep],
+                                                              dtype=np.int16)
+
+    centres = time.searchsorted(intervals.mean(axis=1))
+    starts_pos = np.clip(np.asarray(centres) - n_samples//2, 0,
+                                                n_time - n_samples)
+
+    # Negatives: random windows not overlapping any label
+    rng = np.random.default_rng(seed)
+    n_neg = int(round(negatives_per_positive*max(len(keep), 1)))
+
+    label_i0 = np.asarray(time.searchsorted(
+                           np.array(study.x_values, dtype=np.float64
+                                        ).reshape(-1, 2)[:, 0]), dtype=np.int64)
+    label_i1 = np.asarray(time.searchsorted(
+                           np.array(study.x_values, dtype=np.float64
+                                        ).reshape(-1, 2)[:, 1]), dtype=np.int64)
+
+    candidates = rng.integers(0, n_time - n_samples + 1, size=4*n_neg)
+    if len(label_i0) > 0:
+        overlap = np.any((candidates[:, None] < label_i1[None, :]) &
+                         (candidates[:, None] + n_samples > label_i0[None, :]),
+                                                                      axis=1)
+        candidates = candidates[~overlap]
+    starts_neg = candidates[:n_neg]
+
+    starts = np.concatenate([starts_pos, starts_neg]).astype(np.int64)
+    y = np.concatenate([y_pos, np.zeros(len(starts_neg), dtype=np.int16)])
+    if len(starts) == 0:
+        return empty
+
+    # Gather of the windows, span by span (the negatives are spread over the
+    # whole recording: only the span of each group of windows is read)
+    timeline = TimelineIndex({'impedence': study.impedence, 'ph': study.ph})
+    n_impedence = study.impedence.n_channels
+    order = np.argsort(starts, kind='stable')
+    sorted_starts = starts[order]
+    X = np.empty((len(starts), n_channels, n_samples), dtype=np.float32)
+    t = np.empty(len(starts), dtype=np.int64)
+    span = max(GATHER_SAMPLES - n_samples, 0)
+
+    i = 0
+    while i < len(starts):
+        j = max(int(np.searchsorted(sorted_starts, sorted_starts[i] + span,
+                                                     side='right')), i + 1)
+        s0, s1 = int(sorted_starts[i]), int(sorted_starts[j-1]) + n_samples
+        index = (sorted_starts[i:j] - s0)[:, None] + \
+                                           np.arange(n_samples)[None, :]
+        windows = order[i:j]
+
+        X[windows, :n_impedence] = study.impedence.block(s0, s1)[:, index
+                                                          ].transpose(1, 0, 2)
+        for k in range(study.ph.n_channels):
+            X[windows, n_impedence + k] = timeline.resample('ph', k,
+                                             'impedence', s0, s1)[index]
+        t[windows] = time[s0:s1][sorted_starts[i:j] - s0]
+        i = j
+
+    return X, y, t
+###############################################################################
+
+
+
+#%% Generator API
+###############################################################################
+def iter_windows(paths, window_ms=WINDOW_MS, categories=CATEGORIES,
+                          negatives_per_positive=1, batch_size=None, seed=0):
+    """
+    paths: (list) processed studies (csv or archive)
+    window_ms: (int) length of each window (ms)
+    categories: (list) categories exported (class = position + 1)
+    negatives_per_positive: (float) number of background windows per label
+    batch_size: (int) windows per yielded batch, None for one study per batch
+    seed: (int) seed of the negative sampling
+    Streams the windows study by study: yields (X, y, info) with X of shape
+    (n, channels, samples), the classes y and info with the study path and
+    the start time of each window. Only one study is loaded at a time.
+    """
+
+    for n, path in enumerate(paths):
+        X, y, t = study_windows(read_study(path), window_ms, categories,
+                                       negatives_per_positive, seed + n)
+        step = len(y) if batch_size is None else batch_size
+
+        for i in range(0, len(y), max(step, 1)):
+            yield X[i:i+step], y[i:i+step], {'path': path,
+                                                   'start_ms': t[i:i+step]}
+###############################################################################
+
+
+
+#%% Sharded exporter
+###############################################################################
+def export_study(args):
+    """
+    args: (tuple) study index, path, output directory and parameters
+    Worker: writes the windows of one study in shards of .npy arrays.
+    Returns the manifest entries of the written shards.
+    """
+
+    (n, path, out_dir, window_ms, categories, negatives_per_positive,
+                                                        shard_size, seed) = args
+
+    X, y, t = study_windows(read_study(path), window_ms, categories,
+                                       negatives_per_positive, seed + n)
+    shards = []
+
+    for k, i in enumerate(range(0, len(y), shard_size)):
+        name = 'shard_' + str(n).zfill(5) + '_' + str(k).zfill(3)
+        np.save(os.path.join(out_dir, name + '_X.npy'), X[i:i+shard_size])
+        np.save(os.path.join(out_dir, name + '_y.npy'), y[i:i+shard_size])
+        np.save(os.path.join(out_dir, name + '_t.npy'), t[i:i+shard_size])
+
+        shards.append({'study': path, 'X': name + '_X.npy',
+                       'y': name + '_y.npy', 't': name + '_t.npy',
+                       'n': int(len(y[i:i+shard_size])),
+                       'positives': int(np.sum(y[i:i+shard_size] > 0))})
+
+    return shards
+###############################################################################
+
+
+
+###############################################################################
+def export_training_set(paths, out_dir, window_ms=WINDOW_MS,
+                    categories=CATEGORIES, negatives_per_positive=1,
+                    shard_size=SHARD_SIZE, n_workers=None, seed=0):
+    """
+    paths: (list) processed studies (csv or archive)
+    out_dir: (str) output directory of the shards and of the manifest
+    window_ms: (int) length of each window (ms)
+    categories: (list) categories exported (class = position + 1)
+    negatives_per_positive: (float) number of background windows per label
+    shard_size: (int) maximum number of windows per shard
+    n_workers: (int) number of worker processes (None: number of cores)
+    seed: (int) seed of the negative sampling
+    Exports the windows of all the studies on a process pool, each worker
+    holding one study at a time. Returns the manifest (also saved as json).
+    """
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    tasks = [(n, path, out_dir, window_ms, list(categories),
+              negatives_per_positive, shard_size, seed)
+                                               for n, path in enumerate(paths)]
+
+    shards = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for n, study_shards in enumerate(executor.map(export_study, tasks)):
+            shards.extend(study_shards)
+            print("Exported studies: ", n+1, '/', len(tasks))
+
+    first = np.load(os.path.join(out_dir, shards[0]['X']), mmap_mode='r') \
+                                                        if shards else None
+    manifest = {'window_ms': window_ms,
+                'classes': ['Background'] + list(categories),
+                'channels': ['Value_1', 'Value_2', 'Value_3', 'Value_4',
+                             'Value_5', 'Value_6', 'Value_ph'],
+                'samples': None if first is None else int(first.shape[2]),
+                'dtype': 'float32',
+                'n_windows': int(sum(s['n'] for s in shards)),
+                'n_positives': int(sum(s['positives'] for s in shards)),
+                'studies': list(paths),
+                'shards': shards}
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'w') as opener:
+        json.dump(manifest, opener, indent=1)
+
+    return manifest
+###############################################################################
+
+
+
+###############################################################################
+def iter_shards(out_dir, batch_size=256, mmap=True):
+    """
+    out_dir: (str) directory written by export_training_set
+    batch_size: (int) windows per yielded batch
+    mmap: (bool) memory-map the shards instead of loading them
+    Streams (X, y) batches from the exported shards.
+    """
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'r') as opener:
+        manifest = json.load(opener)
+
+    for shard in manifest['shards']:
+        X = np.load(os.path.join(out_dir, shard['X']),
+                                          mmap_mode='r' if mmap else None)
+        y = np.load(os.path.join(out_dir, shard['y']))
+        for i in range(0, len(y), batch_size):
+            yield np.asarray(X[i:i+batch_size]), y[i:i+batch_size]
+###############################################################################
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-label features of the Time Series Scribe.
+For every labelled interval (x_values) a feature vector is computed for each
+impedance channel: duration, minimum impedance, nadir time, drop from the
+baseline, area under the baseline, pH change and overlap with acid exposure
+(pH below 4). The samples of all the labels are gathered at once from the
+precomputed index ranges and every feature is a segment reduction
+(ufunc.reduceat) over them, with no loop on the labels. Each study gives a
+typed table (one row per label and channel), written as csv; the studies of
+a cohort are processed in parallel.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from TSS_archive import read_study
+from TSS_derived import baseline
+from TSS_export import sample_interval
+
+
+
+#%% Parameters
+PH_THRESHOLD = 4                    # Acid exposure: pH below 4
+BASELINE_MS = 30000                 # Segments of the baseline impedance (ms)
+FEATURES_SUFFIX = '_features.csv'   # Name of the table of each study
+
+# Columns of the table and their types
+FEATURE_DTYPE = np.dtype([('label', np.int32), ('category', 'U32'),
+                          ('start', np.int64), ('end', np.int64),
+                          ('channel', 'U16'), ('duration_ms', np.int64),
+                          ('min_impedence', np.float32),
+                          ('nadir_ms', np.float32),
+                          ('drop_percent', np.float32),
+                          ('area_under_baseline', np.float32),
+                          ('ph_change', np.float32),
+                          ('acid_overlap', np.bool_)])
+
+
+
+#%% Aux functions
+###############################################################################
+def gather_ranges(i0, i1):
+    """
+    i0, i1: (int arrays) first and last (excluded) sample of each range
+    Returns the concatenated indices of the ranges and the offset of each
+    range in them (len(i0) + 1 values).
+    """
+
+    lengths = np.maximum(i1 - i0, 0)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    index = np.arange(offsets[-1]) + np.repeat(i0 - offsets[:-1], lengths)
+    return index, offsets
+###############################################################################
+
+
+
+###############################################################################
+def ph_features(ph, start, end, ph_threshold=PH_THRESHOLD):
+    """
+    ph: (ChannelStore) pH channel
+    start, end: (arrays) labelled intervals (ms)
+    ph_threshold: (float) acid threshold
+    Returns the pH change (pH at the end minus pH at the start) and the
+    overlap with acid exposure of each interval. The pH is held between its
+    samples.
+    """
+
+    if len(ph) == 0:
+        return np.full(len(start), np.nan), np.zeros(len(start), dtype=bool)
+
+    values = ph.channel(0)
+    last = len(ph) - 1
+    j0 = np.clip(np.asarray(ph.time.searchsorted(start, 'right')) - 1, 0, last)
+    j1 = np.clip(np.asarray(ph.time.searchsorted(end, 'right')) - 1, 0, last)
+
+    # Acid samples in [j0, j1]: difference of the cumulative count
+    acid = np.concatenate([[0], np.cumsum(values < ph_threshold)])
+    return values[j1] - values[j0], acid[j1 + 1] - acid[j0] > 0
+###############################################################################
+
+
+
+###############################################################################
+def label_features(study, ph_threshold=PH_THRESHOLD, baseline_ms=BASELINE_MS):
+    """
+    study: (Study) labelled study
+    ph_threshold: (float) acid threshold
+    baseline_ms: (int) segments of the baseline impedance (ms)
+    Returns the typed table (FEATURE_DTYPE structured array) of the features
+    of every label and impedance channel, label by label. Labels without
+    impedance samples have NaN channel features.
+    """
+
+    store = study.impedence
+    intervals = np.array(study.x_values, dtype=np.float64).reshape(-1, 2)
+    start, end = intervals.min(axis=1), intervals.max(axis=1)
+    n_labels, n_channels = len(intervals), store.n_channels
+
+    table = np.zeros(n_labels*n_channels, dtype=FEATURE_DTYPE)
+    table['label'] = np.repeat(np.arange(n_labels), n_channels)
+    table['category'] = np.repeat(np.asarray(study.category, dtype='U32'),
+                                                                  n_channels)
+    table['start'] = np.repeat(start, n_channels)
+    table['end'] = np.repeat(end, n_channels)
+    table['channel'] = np.tile(np.asarray(store.names, dtype='U16'),
+                                                                    n_labels)
+    table['duration_ms'] = table['end'] - table['start']
+
+    change, overlap = ph_features(study.ph, start, end, ph_threshold)
+    table['ph_change'] = np.repeat(change, n_channels)
+    table['acid_overlap'] = np.repeat(overlap, n_channels)
+
+    if n_labels == 0 or len(store) == 0:
+        return table
+
+    # Samples of the labels, with the context of the baseline around them
+    # (on the segment grid of the baseline, as the derived channel)
+    i0 = np.asarray(store.time.searchsorted(start), dtype=np.int64)
+    i1 = np.asarray(store.time.searchsorted(end, 'right'), dtype=np.int64)
+    step = max(sample_interval(store.time), 1)
+    window = max(int(round(baseline_ms/step)), 1)
+    s0 = max((int(i0.min()) - window)//window*window, 0)
+    s1 = min(-(-(int(i1.max()) + window)//window)*window, len(store))
+
+    index, offsets = gather_ranges(i0 - s0, i1 - s0)
+    lengths = np.diff(offsets)
+    full = lengths > 0
+    if not np.any(full):
+        for name in ('min_impedence', 'nadir_ms', 'drop_percent',
+                                                      'area_under_baseline'):
+            table[name] = np.nan
+        return table
+
+    # Samples of the labels and baseline at the same samples
+    block = store.block(s0, s1)
+    time = store.time[s0:s1]
+    values = block[:, index]
+    reference = np.stack([baseline(block[k][None, :], time, window, index)
+                                                    for k in range(n_channels)])
+
+    # Segment reductions (the empty labels do not add samples: the next
+    # offset of a label with samples is its end)
+    segments = offsets[:-1][full]
+
+    minimum = np.fmin.reduceat(values, segments, axis=1)
+    mean_reference = np.add.reduceat(reference, segments, axis=1,
+                                            dtype=np.float64)/lengths[full]
+    area = np.add.reduceat(np.fmax(reference - values, 0), segments, axis=1,
+                                                    dtype=np.float64)*step/1000
+
+    # Nadir: first sample of each label at its minimum
+    position = np.arange(len(index)) - np.repeat(segments, lengths[full])
+    at_minimum = values == np.repeat(minimum, lengths[full], axis=1)
+    first = np.minimum.reduceat(np.where(at_minimum, position, len(index)),
+                                                           segments, axis=1)
+    found = first < len(index)
+    sample = index[segments + np.where(found, first, 0)]
+    nadir = np.where(found, time[sample] - start[full], np.nan)
+
+    # Rows of the labels with samples (label by label, channel by channel)
+    def fill(name, per_channel):
+        column = np.full((n_labels, n_channels), np.nan)
+        column[full] = per_channel.T
+        table[name] = column.ravel()
+
+    fill('min_impedence', minimum)
+    fill('nadir_ms', nadir)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fill('drop_percent', 100*(1 - minimum/mean_reference))
+    fill('area_under_baseline', area)
+
+    return table
+###############################################################################
+
+
+
+###############################################################################
+def write_features(path, table):
+    """
+    Writes the table of the features as csv.
+    """
+    pd.DataFrame(table).to_csv(path, index=False)
+###############################################################################
+
+
+
+###############################################################################
+def read_features(path):
+    """
+    Returns the typed table (FEATURE_DTYPE structured array) of a csv.
+    """
+    df = pd.read_csv(path, keep_default_na=False, na_values=[''])
+    table = np.zeros(len(df), dtype=FEATURE_DTYPE)
+    for name in FEATURE_DTYPE.names:
+        table[name] = df[name].to_numpy()
+    return table
+###############################################################################
+
+
+
+#%% Cohort
+###############################################################################
+def study_features(args):
+    """
+    args: (tuple) path of the study, output directory and parameters
+    Worker: writes the table of the features of one study. Returns the path
+    of the table and the number of labels.
+    """
+
+    path, out_dir, ph_threshold, baseline_ms = args
+
+    study = read_study(path)
+    table = label_features(study, ph_threshold, baseline_ms)
+    out_path = os.path.join(out_dir, os.path.splitext(
+                                 os.path.basename(path))[0] + FEATURES_SUFFIX)
+    write_features(out_path, table)
+
+    return out_path, len(study.x_values)
+###############################################################################
+
+
+
+###############################################################################
+def extract_features(paths, out_dir, ph_threshold=PH_THRESHOLD,
+                                   baseline_ms=BASELINE_MS, n_workers=None):
+    """
+    paths: (list) processed studies (csv or archive)
+    out_dir: (str) output directory of the tables
+    ph_threshold: (float) acid threshold
+    baseline_ms: (int) segments of the baseline impedance (ms)
+    n_workers: (int) number of worker processes (None: number of cores)
+    Writes the table of the features of every study on a process pool, each
+    worker holding one study at a time. Returns the paths of the tables.
+    """
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    tasks = [(path, out_dir, ph_threshold, baseline_ms) for path in paths]
+
+    tables = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for n, (out_path, n_labels) in enumerate(executor.map(study_features,
+                                                                     tasks)):
+            tables.append(out_path)
+            print("Features: ", n+1, '/', len(tasks), ' (', n_labels,
+                                                                ' labels)')
+
+    return tables
+###############################################################################
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Event gallery of the Time Series Scribe.
+A small PNG is rendered for every labelled interval of one or more processed
+studies (all the channels around the label, with its span) and an index page
+links them, for the quality check of the labels.
+The thumbnails are rendered headless on a process pool: each worker holds one
+study and one Agg figure whose artists are created once, and only their data
+are updated for each event.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+import html
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from TSS_archive import read_study, read_labels
+from TSS_decimation import decimate_minmax
+
+
+
+#%% Parameters
+THUMB_SIZE = (4, 3)                 # Size of the thumbnails (inches)
+THUMB_DPI = 60                      # Resolution of the thumbnails
+PAD_FRACTION = 0.5                  # Context shown around the label
+MIN_PAD_MS = 2000                   # Minimum context around the label (ms)
+EVENTS_PER_TASK = 64                # Thumbnails rendered by each task
+INDEX_NAME = 'index.html'           # Name of the index page
+
+# Rows of the channels, as in the main plot: pH (0-9) and 6 impedances (0-7)
+ROWS = np.array([0, 9, 16, 23, 30, 37, 44])
+COLORS = ['#0173b2', '#de8f05', '#029e73', '#d55e00', '#cc78bc', '#ca9161',
+                                                                  '#fbafe4']
+
+# State of each worker process: loaded study and reused figure
+WORKER = {}
+
+
+
+#%% Aux functions
+###############################################################################
+def thumbnail_figure(size=THUMB_SIZE, dpi=THUMB_DPI):
+    """
+    Returns the figure, its canvas, the reused (animated) artists, a single
+    collection with one line per channel and the span of the label, and the
+    background they are drawn on. The caption of the thumbnail is in the index page (text
+    rendering would dominate the cost of a thumbnail).
+    """
+
+    fig = Figure(figsize=size, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()                       # No ticks, labels and spines
+    ax.set_ylim([0, ROWS[-1] + 4])
+
+    lines = LineCollection([np.zeros((0, 2))]*len(COLORS), colors=COLORS,
+                                               linewidths=0.6, animated=True)
+    ax.add_collection(lines)
+    span = ax.axvspan(0, 1, alpha=0.2, animated=True)
+
+    # Static part drawn once, the artists are blitted over it
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    return {'fig': fig, 'canvas': canvas, 'ax': ax, 'lines': lines,
+                                     'span': span, 'background': background}
+###############################################################################
+
+
+
+###############################################################################
+def time_string(t):
+    """
+    Returns the time of the day (hh:mm:ss) of a time in ms.
+    """
+    s = int(t//1000)
+    return f'{(s//3600) % 24:02}:{(s//60) % 60:02}:{s % 60:02}'
+###############################################################################
+
+
+
+###############################################################################
+def render_events(args):
+    """
+    args: (tuple) path of the study, event indices, output directory and
+        name prefix of the thumbnails
+    Worker: renders the thumbnails of the events of a study, reusing the
+    figure of the process (and the study, if it is the last one loaded).
+    Returns the index entries of the rendered thumbnails.
+    """
+
+    path, events, out_dir, prefix = args
+
+    if WORKER.get('path') != path:
+        WORKER['path'] = path
+        WORKER['study'] = read_study(path)
+    if 'figure' not in WORKER:
+        WORKER['figure'] = thumbnail_figure()
+
+    study = WORKER['study']
+    figure = WORKER['figure']
+    n_bins = int(figure['fig'].get_figwidth()*figure['fig'].dpi)
+    entries = []
+
+    for n in events:
+        start, end = study.x_values[n]
+        pad = max(PAD_FRACTION*(end - start), MIN_PAD_MS)
+        t0, t1 = start - pad, end + pad
+
+        # Decoded samples of the window only, decimated to the pixels
+        segments = []
+        for store in (study.ph, study.impedence):
+            i0, i1 = store.time.searchsorted([t0, t1])
+            time = store.time[i0:i1]
+            block = store.block(i0, i1)
+            for k in range(store.n_channels):
+                segments.append(np.column_stack(decimate_minmax(time,
+                                       block[k] + ROWS[len(segments)], n_bins)))
+        figure['lines'].set_segments(segments)
+
+        figure['span'].set_x(start)
+        figure['span'].set_width(end - start)
+        figure['span'].set_color(study.color_category[n])
+        figure['ax'].set_xlim([t0, t1])
+
+        # Only the artists are drawn (no traversal of the whole figure)
+        canvas = figure['canvas']
+        canvas.restore_region(figure['background'])
+        figure['ax'].draw_artist(figure['span'])
+        figure['ax'].draw_artist(figure['lines'])
+
+        name = prefix + '_' + str(n).zfill(5) + '.png'
+        Image.frombuffer('RGBA', canvas.get_width_height(),
+                         canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1).save(
+                         os.path.join(out_dir, name), compress_level=1)
+        entries.append({'file': name, 'event': n,
+                        'category': study.category[n],
+                        'start': int(start), 'end': int(end)})
+
+    return entries
+###############################################################################
+
+
+
+###############################################################################
+def write_index(path, studies):
+    """
+    path: (str) path of the index page
+    studies: (list) (study path, index entries) of the rendered studies
+    Writes the html page with the thumbnails of every study.
+    """
+
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8">'
+             '<title>Event gallery</title><style>body{font-family:Helvetica}'
+             'figure{display:inline-block;margin:4px}figcaption{font-size:'
+             '11px}</style></head><body>']
+
+    for study_path, entries in studies:
+        parts.append('<h3>' + html.escape(study_path) + ' (' +
+                                         str(len(entries)) + ' events)</h3>')
+        for entry in entries:
+            parts.append('<figure><img src="' + html.escape(entry['file']) +
+                         '" loading="lazy"><figcaption>' +
+                         html.escape(entry['category']) + ' ' +
+                         time_string(entry['start']) + ' (' +
+                         str(round((entry['end'] - entry['start'])/1000, 1)) +
+                         ' s)</figcaption></figure>')
+
+    parts.append('</body></html>')
+    with open(path, 'w') as opener:
+        opener.write('\n'.join(parts))
+###############################################################################
+
+
+
+###############################################################################
+def render_gallery(paths, out_dir, n_workers=None,
+                                      events_per_task=EVENTS_PER_TASK):
+    """
+    paths: (list) processed studies (csv or archive)
+    out_dir: (str) output directory of the thumbnails and of the index
+    n_workers: (int) number of worker processes (None: number of cores)
+    events_per_task: (int) thumbnails rendered by each task
+    Renders the thumbnails of all the labelled intervals on a process pool
+    and writes the index page. Returns the path of the index.
+    """
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # Tasks: consecutive events of the same study (only the labels are read)
+    tasks, owners = [], []
+    for s, path in enumerate(paths):
+        n_events = len(read_labels(path)[0])
+        prefix = str(s).zfill(3) + '_' + \
+                             os.path.splitext(os.path.basename(path))[0]
+        for i in range(0, n_events, events_per_task):
+            tasks.append((path, list(range(i, min(i + events_per_task,
+                                                n_events))), out_dir, prefix))
+            owners.append(s)
+
+    studies = [(path, []) for path in paths]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for s, entries in zip(owners, executor.map(render_events, tasks)):
+            studies[s][1].extend(entries)
+
+    index = os.path.join(out_dir, INDEX_NAME)
+    write_index(index, studies)
+    print("Rendered thumbnails: ", sum(len(e) for _, e in studies))
+
+    return index
+###############################################################################
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bolus propagation of the Time Series Scribe.
+The impedance channels are positioned along the oesophagus: the onset of a
+bolus on each channel is the first sample, from a short time before the
+event, below a fraction of the channel baseline (mean of that time before
+the event). The onset times of the channels are fitted against their
+positions: the sign of the slope gives the direction (antegrade: proximal
+channels first, as in a swallow; retrograde: distal channels first, as in a
+reflux) and its inverse the propagation velocity.
+The events (labels or candidates) are processed all at once: their samples
+are gathered from the precomputed index ranges, and the baselines and the
+onsets are segment reductions over the (channels, samples) array; the fits
+of all the events are a few array operations.
+A channel replicating another one (the Digitrapper export has 5 impedance
+columns: the parser copies the fifth in the sixth channel) would add the
+onset of its source at a different position and bias the fit: the replicated
+channels are found on the samples of the events and left out of the fit.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import numpy as np
+
+from TSS_features import gather_ranges
+from TSS_snapping import DROP_FRACTION
+
+
+
+#%% Parameters
+# Position of the impedance channels (cm above the lower oesophageal
+# sphincter): channel 1 is the most proximal one
+CHANNEL_CM = np.array([17, 15, 9, 7, 5, 3], dtype=np.float64)
+
+PRE_MS = 2000                       # Baseline: 2 s before the events
+MIN_CHANNELS = 3                    # Channels with an onset needed for a fit
+MAX_VELOCITY = 100                  # Faster: simultaneous onsets (cm/s)
+
+DIRECTIONS = ['Undetermined', 'Antegrade', 'Retrograde']
+DIRECTION_SYMBOLS = {'Undetermined': '?', 'Antegrade': '↓',
+                                                     'Retrograde': '↑'}
+
+
+
+#%% Aux functions
+###############################################################################
+def replicated_channels(values):
+    """
+    values: ((channels, n) array) samples of the channels
+    Returns the mask of the channels equal to a previous channel (the copy
+    is replicated, its source is kept).
+    """
+
+    replicated = np.zeros(len(values), dtype=bool)
+    for k in range(1, len(values)):
+        replicated[k] = any(np.array_equal(values[k], values[j],
+                                   equal_nan=True) for j in range(k))
+    return replicated
+###############################################################################
+
+
+
+###############################################################################
+def onset_times(store, intervals, pre_ms=PRE_MS,
+                                                 drop_fraction=DROP_FRACTION):
+    """
+    store: (ChannelStore) impedance channels
+    intervals: ((n, 2) array) events (ms)
+    pre_ms: (int) time before each event: baseline of the channels, and
+        start of the search of the onsets (ms)
+    drop_fraction: (float) onset: impedance below this fraction of baseline
+    Returns the (n, channels) onset times (ms, NaN if the channel does not
+    drop during the event or replicates a previous channel).
+    """
+
+    n_events, n_channels = len(intervals), store.n_channels
+    onsets = np.full((n_events, n_channels), np.nan)
+    if n_events == 0 or len(store) == 0:
+        return onsets
+
+    i0 = np.asarray(store.time.searchsorted(intervals[:, 0] - pre_ms),
+                                                              dtype=np.int64)
+    i_start = np.asarray(store.time.searchsorted(intervals[:, 0]),
+                                                              dtype=np.int64)
+    i1 = np.asarray(store.time.searchsorted(intervals[:, 1], 'right'),
+                                                              dtype=np.int64)
+    s0, s1 = int(i0.min()), int(i1.max())
+
+    index, offsets = gather_ranges(i0 - s0, i1 - s0)
+    lengths = np.diff(offsets)
+    full = (lengths > 0) & (i_start > i0)   # Samples and a baseline
+    if not np.any(full):
+        return onsets
+
+    # Samples of the events (the empty ones add none: the next offset of an
+    # event with samples is its end)
+    values = store.block(s0, s1)[:, index]
+    time = store.time[s0:s1]
+    used = lengths > 0
+    segments = offsets[:-1][used]
+    position = np.arange(len(index)) - np.repeat(segments, lengths[used])
+
+    # Baseline: mean of the samples before each event
+    before = (position < np.repeat((i_start - i0)[used], lengths[used])) & \
+                                                         np.isfinite(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        reference = np.add.reduceat(np.where(before, values, 0), segments,
+                   axis=1, dtype=np.float64)/np.add.reduceat(before, segments,
+                                                                      axis=1)
+    below = values < drop_fraction*np.repeat(reference, lengths[used], axis=1)
+
+    # First sample below of each event (segment reduction)
+    first = np.minimum.reduceat(np.where(below, position, len(index)),
+                                                           segments, axis=1)
+    found = first < len(index)
+    sample = index[segments + np.where(found, first, 0)]
+    onsets[used] = np.where(found, time[sample], np.nan).T
+    onsets[~full] = np.nan
+    onsets[:, replicated_channels(values)] = np.nan
+
+    return onsets
+###############################################################################
+
+
+
+###############################################################################
+def fit_propagation(onsets, positions=CHANNEL_CM, min_channels=MIN_CHANNELS,
+                                                  max_velocity=MAX_VELOCITY):
+    """
+    onsets: ((n, channels) array) onset times (ms, NaN: no onset)
+    positions: (array) position of each channel (cm above the sphincter)
+    min_channels: (int) channels with an onset needed for a fit
+    max_velocity: (float) faster propagation is considered simultaneous
+    Returns the direction index (DIRECTIONS) and the velocity (cm/s, NaN if
+    undetermined) of each event, from the least squares line of the onset
+    times against the positions (all the events at once).
+    """
+
+    positions = np.asarray(positions, dtype=np.float64)[:onsets.shape[1]]
+    valid = np.isfinite(onsets)
+    n = valid.sum(axis=1)
+    first = np.where(valid, onsets, np.inf).min(axis=1, keepdims=True)
+    t = np.where(valid, onsets - first, 0)
+    x = np.where(valid, positions[None, :], 0)
+
+    # Slope of the onset time against the position (ms/cm)
+    sx, st = x.sum(axis=1), t.sum(axis=1)
+    sxx, sxt = (x*x).sum(axis=1), (x*t).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n*sxt - sx*st)/(n*sxx - sx**2)
+        velocity = 1000/np.abs(slope)
+
+    determined = (n >= min_channels) & np.isfinite(velocity) & \
+                                                     (velocity <= max_velocity)
+    # Antegrade: the onsets come later on the distal (lower) channels
+    direction = np.where(determined, np.where(slope < 0, 1, 2), 0)
+
+    return direction, np.where(determined, velocity, np.nan)
+###############################################################################
+
+
+
+###############################################################################
+def bolus_propagation(study, intervals=None, positions=CHANNEL_CM,
+                      pre_ms=PRE_MS, drop_fraction=DROP_FRACTION):
+    """
+    study: (Study) imported study
+    intervals: (list or array) events as [start, end] (ms), e.g. the
+        candidates of a detector (None: labels of the study)
+    positions: (array) position of each channel (cm above the sphincter)
+    pre_ms: (int) time before each event: baseline and start of the search
+        of the onsets (ms)
+    drop_fraction: (float) onset: impedance below this fraction of baseline
+    Returns a dictionary with the (n, channels) onset times, the direction
+    (names in DIRECTIONS) and the velocity (cm/s) of each event.
+    """
+
+    intervals = np.array(study.x_values if intervals is None else intervals,
+                                            dtype=np.float64).reshape(-1, 2)
+    intervals = np.sort(intervals, axis=1)
+
+    onsets = onset_times(study.impedence, intervals, pre_ms, drop_fraction)
+    direction, velocity = fit_propagation(onsets, positions)
+
+    return {'onsets': onsets,
+            'direction': [DIRECTIONS[d] for d in direction],
+            'velocity': velocity}
+###############################################################################
+
+
+
+###############################################################################
+def propagation_text(direction, velocity):
+    """
+    Returns the annotation of an event (arrow and velocity).
+    """
+    if direction == 'Undetermined':
+        return DIRECTION_SYMBOLS[direction]
+    return DIRECTION_SYMBOLS[direction] + f' {velocity:.1f} cm/s'
+###############################################################################
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Data-quality scan of the recordings of the Time Series Scribe.
+At import each store is scanned once with vectorized passes: gaps, repeated
+and backwards timestamps of the time base, and missing, saturated and
+flat-lined runs of each channel. The problems are kept as a compact table of
+intervals, shown in the whole time plot and saved with the study. Clipping
+and gap masking can be applied to the plotted traces.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import numpy as np
+
+
+
+#%% Parameters
+# Types of the problems and their colors in the whole time plot
+QUALITY_TYPES = ['Gap', 'Duplicate time', 'Backwards time', 'Missing',
+                 'Saturation', 'Flatline']
+QUALITY_COLORS = {'Gap': 'black', 'Duplicate time': '#fbafe4',
+                  'Backwards time': '#cc78bc', 'Missing': '#949494',
+                  'Saturation': '#de8f05', 'Flatline': '#56b4e9'}
+
+GAP_FACTOR = 3                      # Gap: step larger than 3 sample intervals
+FLAT_MS = 5000                      # Minimum duration of a flatline (ms)
+SATURATION_SAMPLES = 5              # Minimum run at the extreme of a channel
+CLIP_LIMIT = 11                     # Impedance clipping of the plotted traces
+
+# Columns of the problems in the processed csv
+QUALITY_COLUMNS = ['quality_store','quality_channel','quality_type',
+                                              'quality_start','quality_end']
+
+
+
+#%% Quality report
+class QualityReport():
+
+    ###########################################################################
+    def __init__(self, store, channel, kind, start, end):
+        '''
+        store: (array-like) store of each problem ('impedence' or 'ph')
+        channel: (array-like) channel of each problem (-1: time base)
+        kind: (array-like) type of each problem (names in QUALITY_TYPES)
+        start, end: (array-like) time interval of each problem (ms)
+        The problems are sorted by start time.
+        '''
+
+        start = np.asarray(start, dtype=np.int64).ravel()
+        order = np.argsort(start, kind='stable')
+
+        self.start = start[order]
+        self.end = np.asarray(end, dtype=np.int64).ravel()[order]
+        self.store = np.array(list(store), dtype=object).ravel()[order] \
+                                        if len(start) else np.empty(0, object)
+        self.channel = np.asarray(channel, dtype=np.int16).ravel()[order]
+        self.codes = np.array([QUALITY_TYPES.index(k) for k in kind],
+                                                 dtype=np.int8)[order] \
+                                  if len(start) else np.empty(0, np.int8)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return len(self.start)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def kind(self):
+        """
+        Type of each problem (names in QUALITY_TYPES).
+        """
+        return [QUALITY_TYPES[c] for c in self.codes]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def intervals(self, kind):
+        """
+        Returns the (n, 2) [start, end] times of the problems of a type.
+        """
+        select = self.codes == QUALITY_TYPES.index(kind)
+        return np.stack([self.start[select], self.end[select]], axis=1)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def summary(self):
+        """
+        Returns the number of problems of each type.
+        """
+        counts = np.bincount(self.codes, minlength=len(QUALITY_TYPES))
+        return {kind: int(c) for kind, c in zip(QUALITY_TYPES, counts) if c}
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def to_columns(self):
+        """
+        Returns the problems as a dictionary of columns (QUALITY_COLUMNS).
+        """
+        return {QUALITY_COLUMNS[0]: [str(s) for s in self.store],
+                QUALITY_COLUMNS[1]: self.channel.tolist(),
+                QUALITY_COLUMNS[2]: self.kind,
+                QUALITY_COLUMNS[3]: self.start.tolist(),
+                QUALITY_COLUMNS[4]: self.end.tolist()}
+    ###########################################################################
+
+
+
+#%% Aux functions
+###############################################################################
+def runs(mask, min_length=1):
+    """
+    mask: (bool array) samples with a problem
+    min_length: (int) minimum number of consecutive samples
+    Returns the start and (exclusive) end indices of the runs of True.
+    """
+
+    edges = np.flatnonzero(np.diff(np.concatenate([[0],
+                                        mask.astype(np.int8), [0]])))
+    starts, ends = edges[::2], edges[1::2]
+    keep = ends - starts >= min_length
+    return starts[keep], ends[keep]
+###############################################################################
+
+
+
+###############################################################################
+def scan_time(time, gap_factor=GAP_FACTOR):
+    """
+    time: (TimeBase) time base of a store
+    gap_factor: (float) gap threshold in median sample intervals
+    Returns the (kind, start, end) arrays of the gaps, duplicate and
+    backwards timestamps. A regular time base has none.
+    """
+
+    if time.is_regular() or len(time) < 2:
+        return [], [], []
+
+    values = time.to_array()
+    dt = np.diff(values)
+    step = np.median(dt[dt > 0]) if np.any(dt > 0) else 1
+
+    kind, start, end = [], [], []
+    for name, select in (('Gap', dt > gap_factor*step),
+                         ('Duplicate time', dt == 0),
+                         ('Backwards time', dt < 0)):
+        i = np.flatnonzero(select)
+        kind.extend([name]*len(i))
+        start.append(np.minimum(values[i], values[i+1]))
+        end.append(np.maximum(values[i], values[i+1]))
+
+    return kind, np.concatenate(start), np.concatenate(end)
+###############################################################################
+
+
+
+###############################################################################
+def scan_channel(time, values, flat_ms=FLAT_MS,
+                                    saturation_samples=SATURATION_SAMPLES):
+    """
+    time: (int64 array) time of the samples
+    values: (array) values of the channel
+    flat_ms: (int) minimum duration of a flatline (ms)
+    saturation_samples: (int) minimum run at the extreme of the channel
+    Returns the (kind, start, end) arrays of the missing, saturated (runs at
+    the minimum or maximum of the channel) and flat-lined samples.
+    """
+
+    kind, start, end = [], [], []
+    finite = np.isfinite(values)
+    if not np.any(finite):
+        return ['Missing'], [time[0]], [time[-1]]
+
+    # Missing values
+    s, e = runs(~finite)
+    kind.extend(['Missing']*len(s))
+    start.append(time[s])
+    end.append(time[e-1])
+
+    # Runs at the extremes of the channel (clipped acquisition)
+    v_min, v_max = np.min(values[finite]), np.max(values[finite])
+    if v_max > v_min:
+        s, e = runs((values >= v_max) | (values <= v_min), saturation_samples)
+        kind.extend(['Saturation']*len(s))
+        start.append(time[s])
+        end.append(time[e-1])
+
+    # Flatlines: consecutive equal values lasting at least flat_ms
+    s, e = runs(np.diff(values) == 0)
+    long = time[e] - time[s] >= flat_ms
+    kind.extend(['Flatline']*int(np.sum(long)))
+    start.append(time[s[long]])
+    end.append(time[e[long]])
+
+    return kind, np.concatenate(start), np.concatenate(end)
+###############################################################################
+
+
+
+###############################################################################
+def scan_study(study, gap_factor=GAP_FACTOR, flat_ms=FLAT_MS,
+                                    saturation_samples=SATURATION_SAMPLES):
+    """
+    study: (Study) imported study
+    gap_factor: (float) gap threshold in median sample intervals
+    flat_ms: (int) minimum duration of a flatline (ms)
+    saturation_samples: (int) minimum run at the extreme of a channel
+    Returns the QualityReport of the time bases and the channels.
+    """
+
+    store, channel, kind, start, end = [], [], [], [], []
+
+    for name, channels in (('impedence', study.impedence),
+                                                       ('ph', study.ph)):
+        k_time, s_time, e_time = scan_time(channels.time, gap_factor)
+        store.extend([name]*len(k_time))
+        channel.extend([-1]*len(k_time))
+        kind.extend(k_time)
+        start.append(np.asarray(s_time, dtype=np.int64))
+        end.append(np.asarray(e_time, dtype=np.int64))
+
+        if len(channels) == 0:
+            continue
+        time = channels.time.to_array()
+        for k in range(channels.n_channels):
+            k_channel, s_channel, e_channel = scan_channel(time,
+                     channels.channel(k), flat_ms, saturation_samples)
+            store.extend([name]*len(k_channel))
+            channel.extend([k]*len(k_channel))
+            kind.extend(k_channel)
+            start.append(np.asarray(s_channel, dtype=np.int64))
+            end.append(np.asarray(e_channel, dtype=np.int64))
+
+    return QualityReport(store, channel, kind, np.concatenate(start),
+                                                         np.concatenate(end))
+###############################################################################
+
+
+
+###############################################################################
+def quality_from_columns(columns):
+    """
+    columns: (dict or DataFrame) quality columns (QUALITY_COLUMNS)
+    Returns the QualityReport saved with the processed study.
+    """
+    start = np.asarray(columns[QUALITY_COLUMNS[3]], dtype=np.float64)
+    valid = np.isfinite(start)
+    return QualityReport(
+            np.asarray(columns[QUALITY_COLUMNS[0]], dtype=object)[valid],
+            np.asarray(columns[QUALITY_COLUMNS[1]], dtype=np.float64)[valid],
+            np.asarray(columns[QUALITY_COLUMNS[2]], dtype=object)[valid],
+            start[valid],
+            np.asarray(columns[QUALITY_COLUMNS[4]], dtype=np.float64)[valid])
+###############################################################################
+
+
+
+###############################################################################
+def merge_quality(report, tail, t_start):
+    """
+    report: (QualityReport) problems of a study
+    tail: (QualityReport) problems of the last part of the study (e.g. after
+        new samples in follow mode)
+    t_start: (float) the problems starting from t_start are taken from tail
+    Returns the merged QualityReport.
+    """
+    old, new = report.start < t_start, tail.start >= t_start
+    return QualityReport(
+            np.concatenate([report.store[old], tail.store[new]]),
+            np.concatenate([report.channel[old], tail.channel[new]]),
+            [QUALITY_TYPES[c] for c in np.concatenate([report.codes[old],
+                                                      tail.codes[new]])],
+            np.concatenate([report.start[old], tail.start[new]]),
+            np.concatenate([report.end[old], tail.end[new]]))
+###############################################################################
+
+
+
+###############################################################################
+def clip_values(values, limit=CLIP_LIMIT):
+    """
+    Returns the values clipped above limit (plotted traces).
+    """
+    return np.minimum(values, limit)
+###############################################################################
+
+
+
+###############################################################################
+def mask_gaps(time, values, gap_factor=GAP_FACTOR):
+    """
+    time: (array) time of the samples of a trace
+    values: (array) values of the trace
+    gap_factor: (float) gap threshold in median sample intervals
+    Returns the time and values with a NaN inserted in each gap, so that the
+    plotted line is interrupted instead of joining the two sides.
+    """
+
+    if len(time) < 3:
+        return time, values
+
+    dt = np.diff(time)
+    gaps = np.flatnonzero(dt > gap_factor*np.median(dt)) + 1
+    if len(gaps) == 0:
+        return time, values
+
+    return (np.insert(np.asarray(time, dtype=np.float64), gaps, np.nan),
+            np.insert(np.asarray(values, dtype=np.float64), gaps, np.nan))
+###############################################################################
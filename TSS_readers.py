@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Input readers of the Time Series Scribe.
+Each raw format is read by a reader registered by file extension: the
+Digitrapper text export and EDF/EDF+. The EDF files are memory-mapped: the
+16-bit data records are decoded on demand, only for the requested samples,
+so that multi-gigabyte files open without parsing every sample. The EDF+
+annotations are mapped to labels (with duration) and diary events.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+
+import numpy as np
+import pandas as pd
+
+from TSS_storage import (IMPEDENCE_COLUMNS, PH_COLUMNS, TimeBase, Study,
+                                                      read_digitrapper_txt)
+from TSS_diary import DiaryTable, classify_event
+
+
+
+#%% Parameters
+ANNOTATION_LABEL = 'EDF Annotations'    # Label of the EDF+ annotation signal
+N_IMPEDENCE = 6                         # Impedance channels of a study
+
+# Colors of the labelling categories (as the buttons of the GUI)
+LABEL_COLORS = {'Reflux': '#0173b2', 'Mixed Reflux': '#de8f05',
+                'Erutation': '#029e73', 'Swallow': '#d55e00',
+                'Meal': '#cc78bc'}
+OTHER_COLOR = '#949494'                 # Color of the other annotations
+
+
+
+#%% Reader interface
+class SignalReader():
+
+    extensions = ()                     # Extensions read (lower case)
+    description = ''                    # Name of the format (file dialogs)
+
+    ###########################################################################
+    def read(self, path, mode='float32', chunk_rows=1000000):
+        """
+        path: (str) path of the raw file
+        mode: (str) storage mode of the channels (if they are parsed)
+        chunk_rows: (int) number of rows parsed at once (text formats)
+        Returns the Study of the file.
+        """
+        raise NotImplementedError
+    ###########################################################################
+
+
+
+###############################################################################
+class DigitrapperReader(SignalReader):
+
+    extensions = ('.txt',)
+    description = 'Digitrapper export'
+
+    def read(self, path, mode='float32', chunk_rows=1000000):
+        return read_digitrapper_txt(path, mode, chunk_rows)
+###############################################################################
+
+
+
+###############################################################################
+class EDFReader(SignalReader):
+
+    extensions = ('.edf',)
+    description = 'EDF/EDF+'
+
+    def read(self, path, mode='float32', chunk_rows=1000000):
+        return read_edf(path)
+###############################################################################
+
+
+
+# Registered readers (extension -> reader)
+READERS = {}
+
+
+
+###############################################################################
+def register_reader(reader):
+    """
+    reader: (SignalReader) reader to use for its extensions
+    """
+    for extension in reader.extensions:
+        READERS[extension] = reader
+###############################################################################
+
+
+
+register_reader(DigitrapperReader())
+register_reader(EDFReader())
+
+
+
+###############################################################################
+def reader_filetypes():
+    """
+    Returns the filetypes of the registered readers for the file dialogs.
+    """
+    readers = list(dict.fromkeys(READERS.values()))
+    return tuple((r.description, ' '.join('*' + e for e in r.extensions))
+                                                             for r in readers)
+###############################################################################
+
+
+
+###############################################################################
+def read_raw(path, mode='float32', chunk_rows=1000000):
+    """
+    path: (str) path of the raw file
+    mode: (str) storage mode of the parsed channels
+    chunk_rows: (int) number of rows parsed at once (text formats)
+    Returns the Study read by the reader registered for the extension.
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError('No reader for ' + extension + ' files')
+    return READERS[extension].read(path, mode, chunk_rows)
+###############################################################################
+
+
+
+#%% EDF
+class EDFHeader():
+
+    ###########################################################################
+    def __init__(self, path):
+        '''
+        path: (str) path of the EDF/EDF+ file
+        Parses the fixed header and the signal headers.
+        '''
+
+        with open(path, 'rb') as opener:
+            fixed = opener.read(256).decode('latin-1')
+            self.n_signals = int(fixed[252:256])
+            signals = opener.read(256*self.n_signals).decode('latin-1')
+
+        self.header_bytes = int(fixed[184:192])
+        self.reserved = fixed[192:236].strip()
+        self.n_records = int(fixed[236:244])
+        self.record_duration = float(fixed[244:252])        # Seconds
+
+        # Start of the recording: time of the day (ms), as the exports
+        hh, mm, ss = [int(v) for v in fixed[176:184].split('.')]
+        self.start_ms = 1000*(3600*hh + 60*mm + ss)
+
+        def fields(offset, width):
+            base = offset*self.n_signals
+            return [signals[base + i*width: base + (i+1)*width].strip()
+                                              for i in range(self.n_signals)]
+
+        # Signal headers: each field is stored for all the signals in turn
+        self.labels = fields(0, 16)
+        offset = 16 + 80                                    # Transducer
+        self.dimensions = fields(offset, 8)
+        self.physical_min = np.array(fields(offset + 8, 8), dtype=np.float64)
+        self.physical_max = np.array(fields(offset + 16, 8), dtype=np.float64)
+        self.digital_min = np.array(fields(offset + 24, 8), dtype=np.float64)
+        self.digital_max = np.array(fields(offset + 32, 8), dtype=np.float64)
+        self.samples = np.array(fields(offset + 40 + 80, 8), dtype=np.int64)
+
+        # Column of each signal inside a data record
+        self.columns = np.concatenate([[0], np.cumsum(self.samples)])
+
+        # Scale and offset of the physical values
+        self.scale = (self.physical_max - self.physical_min)/ \
+                     np.where(self.digital_max > self.digital_min,
+                              self.digital_max - self.digital_min, 1)
+        self.offset = self.physical_min - self.digital_min*self.scale
+
+        # The number of records can be unknown (-1) in the header
+        if self.n_records < 0:
+            self.n_records = (os.path.getsize(path) - self.header_bytes)// \
+                                                      (2*int(self.columns[-1]))
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def discontinuous(self):
+        return self.reserved.startswith('EDF+D')
+    ###########################################################################
+
+
+
+###############################################################################
+class EDFStore():
+
+    ###########################################################################
+    def __init__(self, records, header, signals, time, names):
+        '''
+        records: (memmap) int16 data records (n_records, record samples)
+        header: (EDFHeader) header of the file
+        signals: (list) indices of the signals of the store (same sampling)
+        time: (TimeBase) time base of the samples
+        names: (list) names of the channels (processed csv columns)
+        Channel store decoding the memory-mapped records on demand.
+        '''
+
+        self.records = records
+        self.signals = list(signals)
+        self.time = time
+        self.names = list(names)[:len(self.signals)]
+        self.labels = [header.labels[s] for s in self.signals]  # EDF labels
+        self.mode = 'int16'
+        self.scale = header.scale[self.signals].astype(np.float32)
+        self.offset = header.offset[self.signals].astype(np.float32)
+        self.per_record = int(header.samples[self.signals[0]])
+        self.first_column = header.columns[self.signals]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return len(self.time)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def n_channels(self):
+        return len(self.signals)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def raw(self, k, i0=0, i1=None):
+        """
+        Returns the int16 samples of channel k in [i0, i1), reading only the
+        data records holding them.
+        """
+
+        i0, i1, _ = slice(i0, i1).indices(len(self))
+        if i1 <= i0:
+            return np.empty(0, dtype=np.int16)
+
+        r0, r1 = i0//self.per_record, (i1-1)//self.per_record + 1
+        c0 = int(self.first_column[k])
+        samples = np.asarray(self.records[r0:r1, c0:c0+self.per_record])
+        return samples.reshape(-1)[i0 - r0*self.per_record:
+                                                 i1 - r0*self.per_record]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def channel(self, k, i0=0, i1=None):
+        """
+        Returns the physical values of channel k in [i0, i1) (float32).
+        """
+        return self.raw(k, i0, i1).astype(np.float32)*self.scale[k] + \
+                                                               self.offset[k]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def block(self, i0=0, i1=None):
+        """
+        Returns all the channels in [i0, i1) as a (n_channels, n) array.
+        """
+        return np.stack([self.channel(k, i0, i1)
+                                             for k in range(self.n_channels)])
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        """
+        Resident memory (the samples stay in the mapped file).
+        """
+        return self.time.nbytes
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def to_dataframe(self, time_name):
+        """
+        Returns the store as a DataFrame with the time and channels columns.
+        """
+        df = pd.DataFrame({time_name: self.time.to_array()})
+        for k, name in enumerate(self.names):
+            df[name] = self.channel(k)
+        return df
+    ###########################################################################
+
+
+
+###############################################################################
+def parse_annotations(raw):
+    """
+    raw: (bytes) content of the annotation signal of a data record
+    Returns the list of (onset s, duration s, text) of the time-stamped
+    annotation lists (TAL). The first TAL of a record, without text, holds
+    the onset of the record.
+    """
+
+    annotations = []
+    for tal in raw.split(b'\x00'):
+        if not tal.strip(b'\x00'):
+            continue
+        parts = tal.split(b'\x14')
+        timing = parts[0].split(b'\x15')
+        try:
+            onset = float(timing[0])
+        except ValueError:
+            continue
+        duration = float(timing[1]) if len(timing) > 1 and timing[1] else 0.
+        texts = [p.decode('utf-8', 'replace') for p in parts[1:]]
+        if not any(texts):
+            annotations.append((onset, None, ''))       # Record onset
+        for text in texts:
+            if text:
+                annotations.append((onset, duration, text))
+    return annotations
+###############################################################################
+
+
+
+###############################################################################
+def read_edf(path):
+    """
+    path: (str) path of the EDF/EDF+ file
+    Returns the Study of the file, with memory-mapped channels. The pH store
+    holds the first signal whose label contains 'ph', the impedance store
+    the first N_IMPEDENCE other signals with the most frequent sampling. The
+    annotations with a duration become labels, the others diary events.
+    """
+
+    header = EDFHeader(path)
+    records = np.memmap(path, dtype='<i2', mode='r', offset=header.header_bytes,
+                        shape=(header.n_records, int(header.columns[-1])))
+
+    # Annotations (EDF+): small, read for all the records at once
+    annotation_signals = [s for s, label in enumerate(header.labels)
+                                               if label == ANNOTATION_LABEL]
+    annotations, record_onsets = [], []
+    for s in annotation_signals:
+        c0, c1 = header.columns[s], header.columns[s+1]
+        raw = np.asarray(records[:, c0:c1]).astype('<i2').tobytes()
+        width = 2*(c1 - c0)
+        for r in range(header.n_records):
+            tals = parse_annotations(raw[r*width:(r+1)*width])
+            if s == annotation_signals[0] and tals and tals[0][1] is None:
+                record_onsets.append(tals[0][0])
+            annotations.extend(t for t in tals if t[1] is not None)
+
+    def time_base(signals):
+        per_record = int(header.samples[signals[0]])
+        step = 1000*header.record_duration/per_record
+        n = header.n_records*per_record
+
+        if not header.discontinuous and float(step).is_integer():
+            return TimeBase.from_regular(header.start_ms, int(step), n)
+
+        # Discontinuous records (EDF+D) or fractional sample interval
+        onsets = np.array(record_onsets, dtype=np.float64) \
+            if header.discontinuous and len(record_onsets) == header.n_records \
+            else header.record_duration*np.arange(header.n_records)
+        time = header.start_ms + 1000*onsets[:, None] + \
+                                          step*np.arange(per_record)[None, :]
+        return TimeBase(np.round(time.ravel()).astype(np.int64))
+
+    # Split the signals between the pH and the impedance stores
+    data_signals = [s for s in range(header.n_signals)
+                                              if s not in annotation_signals]
+    ph_signals = [s for s in data_signals if 'ph' in header.labels[s].lower()]
+    others = [s for s in data_signals if s not in ph_signals]
+    if not others or not ph_signals:
+        raise ValueError('EDF file without pH and impedance signals: ' +
+                                                            ', '.join(header.labels))
+
+    rates = header.samples[others]
+    rate = np.bincount(rates).argmax()
+    impedence_signals = [s for s in others
+                                    if header.samples[s] == rate][:N_IMPEDENCE]
+
+    impedence = EDFStore(records, header, impedence_signals,
+                   time_base(impedence_signals), IMPEDENCE_COLUMNS[1:])
+    ph = EDFStore(records, header, ph_signals[:1], time_base(ph_signals),
+                                                               PH_COLUMNS[1:])
+
+    # Annotations with a duration: labels, without: diary events
+    category, x_values, color_category = [], [], []
+    diary_time, diary_text = [], []
+    for onset, duration, text in annotations:
+        t = header.start_ms + 1000*onset
+        if duration > 0:
+            category.append(text)
+            x_values.append([int(t), int(t + 1000*duration)])
+            color_category.append(LABEL_COLORS.get(text, OTHER_COLOR))
+        else:
+            diary_time.append(int(t))
+            diary_text.append(text)
+
+    diary = DiaryTable(diary_time, [classify_event(t) for t in diary_text],
+                                                                   diary_text)
+
+    return Study(impedence, ph, category, x_values, color_category, path,
+                                                                       diary)
+###############################################################################
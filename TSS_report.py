@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Paginated report of the Time Series Scribe.
+A whole processed study is printed as pages of fixed time windows (several
+strips per page, as the view of the GUI) with the labels overlaid. The pages
+are rendered in parallel worker processes with the decimated plotting path
+and encoded as JPEG by the workers; the pages are then merged, in order and
+one at a time, in a single PDF (or kept as PNG files).
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from TSS_archive import ARCHIVE_EXTENSION, read_study, write_archive
+from TSS_decimation import decimate_minmax
+from TSS_gallery import ROWS, COLORS, time_string
+
+
+
+#%% Parameters
+PAGE_SIZE = (11.69, 8.27)           # A4 landscape (inches)
+PAGE_DPI = 100                      # Resolution of the pages
+WINDOW_MS = 120000                  # Time window of each strip (ms)
+STRIPS_PER_PAGE = 4                 # Strips (time windows) of each page
+PAGES_PER_TASK = 8                  # Pages rendered by each task
+JPEG_QUALITY = 90                   # Quality of the pages in the PDF
+
+# State of each worker process: loaded study and reused page
+WORKER = {}
+
+
+
+#%% Aux functions
+###############################################################################
+def page_figure(strips=STRIPS_PER_PAGE, window_ms=WINDOW_MS, size=PAGE_SIZE,
+                                                              dpi=PAGE_DPI):
+    """
+    Returns the figure of a page, its canvas, the reused (animated) artists
+    of each strip (collection of the channels and time of the strip) and the
+    static background they are drawn on. The strips show the time relative
+    to their start, so that the axes and the ticks are drawn only once.
+    """
+
+    fig = Figure(figsize=size, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    axes = fig.subplots(strips, 1)
+    axes = np.atleast_1d(axes)
+    fig.subplots_adjust(left=0.03, right=0.98, top=0.94, bottom=0.04,
+                                                                  hspace=0.3)
+
+    collections, texts = [], []
+    for ax in axes:
+        ax.set_ylim([0, ROWS[-1] + 4])
+        ax.set_yticks(ROWS)
+        ax.set_yticklabels(['pH', 'Z1', 'Z2', 'Z3', 'Z4', 'Z5', 'Z6'],
+                                                                  fontsize=6)
+        ax.set_xlim([0, window_ms])
+        ticks = np.linspace(0, window_ms, 7)
+        ax.set_xticks(ticks)
+        ax.set_xticklabels(['+' + str(round(t/1000)) + ' s' for t in ticks],
+                                                                  fontsize=6)
+        collections.append(LineCollection([np.zeros((0, 2))]*len(COLORS),
+                               colors=COLORS, linewidths=0.4, animated=True))
+        ax.add_collection(collections[-1])
+        texts.append(ax.text(0, 1.02, '', fontsize=7, transform=ax.transAxes,
+                                                               animated=True))
+
+    title = fig.suptitle('', fontsize=8, animated=True)
+
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    return {'fig': fig, 'canvas': canvas, 'axes': axes, 'texts': texts,
+            'collections': collections, 'title': title,
+                                                     'background': background}
+###############################################################################
+
+
+
+###############################################################################
+def render_pages(args):
+    """
+    args: (tuple) path of the study (archive), its name, page numbers, first
+        time of the study, window of the strips (ms), strips per page,
+        output directory and format of the pages ('jpeg' or 'png')
+    Worker: renders the pages of the study, reusing the figure of the
+    process. Only the samples of each strip are decoded. Returns the paths
+    and the pixel sizes of the written pages.
+    """
+
+    path, name, pages, t_start, window_ms, strips, out_dir, fmt = args
+
+    if WORKER.get('path') != path:
+        WORKER['path'] = path
+        WORKER['study'] = read_study(path)
+    if WORKER.get('layout') != (strips, window_ms):
+        WORKER['layout'] = (strips, window_ms)
+        WORKER['figure'] = page_figure(strips, window_ms)
+
+    study = WORKER['study']
+    figure = WORKER['figure']
+    canvas = figure['canvas']
+    n_bins = int(figure['axes'][0].get_window_extent().width)
+    intervals = np.array(study.x_values, dtype=np.float64).reshape(-1, 2)
+    written = []
+
+    for page in pages:
+        canvas.restore_region(figure['background'])
+
+        for s, ax in enumerate(figure['axes']):
+            t0 = t_start + (page*strips + s)*window_ms
+            t1 = t0 + window_ms
+
+            # Decoded samples of the strip, decimated to its pixels
+            segments = []
+            for store in (study.ph, study.impedence):
+                i0, i1 = store.time.searchsorted([t0, t1])
+                time = store.time[i0:i1] - t0
+                block = store.block(i0, i1)
+                for k in range(store.n_channels):
+                    segments.append(np.column_stack(decimate_minmax(time,
+                                 block[k] + ROWS[len(segments)], n_bins)))
+            figure['collections'][s].set_segments(segments)
+
+            # Labels overlapping the strip
+            for n in np.flatnonzero((intervals[:, 1] >= t0) &
+                                                  (intervals[:, 0] <= t1)):
+                span = ax.axvspan(intervals[n, 0] - t0, intervals[n, 1] - t0,
+                      color=study.color_category[n], alpha=0.2, animated=True)
+                ax.draw_artist(span)
+                span.remove()
+
+            figure['texts'][s].set_text(time_string(t0) + ' - ' +
+                                                          time_string(t1))
+            ax.draw_artist(figure['collections'][s])
+            ax.draw_artist(figure['texts'][s])
+
+        figure['title'].set_text(name + '   page ' + str(page + 1))
+        figure['fig'].draw_artist(figure['title'])
+
+        page_path = os.path.join(out_dir, 'page_' + str(page).zfill(5) +
+                                        ('.jpg' if fmt == 'jpeg' else '.png'))
+        image = Image.frombuffer('RGBA', canvas.get_width_height(),
+                        canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1).convert('RGB')
+        if fmt == 'jpeg':
+            image.save(page_path, quality=JPEG_QUALITY)
+        else:
+            image.save(page_path, compress_level=1)
+        written.append((page_path,) + canvas.get_width_height())
+
+    return written
+###############################################################################
+
+
+
+###############################################################################
+def write_pdf(path, pages, dpi=PAGE_DPI):
+    """
+    path: (str) path of the PDF
+    pages: (iterable) (jpeg path, width, height) of the pages, in order
+    dpi: (int) resolution of the pages
+    Writes a PDF with one JPEG image per page. The JPEG data are copied as
+    they are (DCTDecode), one page at a time.
+    """
+
+    offsets = []
+
+    def start_object(pdf):
+        offsets.append(pdf.tell())
+        pdf.write(str(len(offsets)).encode() + b' 0 obj\n')
+
+    with open(path, 'wb') as pdf:
+        pdf.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets.extend([0, 0])              # Catalog and pages, written last
+        kids = []
+
+        for page_path, width, height in pages:
+            with open(page_path, 'rb') as opener:
+                data = opener.read()
+            w, h = width*72/dpi, height*72/dpi
+
+            start_object(pdf)
+            pdf.write(('<< /Type /XObject /Subtype /Image /Width ' +
+                       str(width) + ' /Height ' + str(height) +
+                       ' /ColorSpace /DeviceRGB /BitsPerComponent 8'
+                       ' /Filter /DCTDecode /Length ' + str(len(data)) +
+                       ' >>\nstream\n').encode())
+            pdf.write(data + b'\nendstream\nendobj\n')
+            image = len(offsets)
+
+            content = ('q ' + f'{w:.2f}' + ' 0 0 ' + f'{h:.2f}' +
+                       ' 0 0 cm /Im0 Do Q').encode()
+            start_object(pdf)
+            pdf.write(b'<< /Length ' + str(len(content)).encode() +
+                      b' >>\nstream\n' + content + b'\nendstream\nendobj\n')
+
+            start_object(pdf)
+            pdf.write(('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 ' +
+                       f'{w:.2f} {h:.2f}' + '] /Resources << /XObject << '
+                       '/Im0 ' + str(image) + ' 0 R >> >> /Contents ' +
+                       str(image + 1) + ' 0 R >>\nendobj\n').encode())
+            kids.append(len(offsets))
+
+        offsets[0] = pdf.tell()
+        pdf.write(b'1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n')
+        offsets[1] = pdf.tell()
+        pdf.write(('2 0 obj\n<< /Type /Pages /Kids [' +
+                   ' '.join(str(k) + ' 0 R' for k in kids) + '] /Count ' +
+                   str(len(kids)) + ' >>\nendobj\n').encode())
+
+        xref = pdf.tell()
+        pdf.write(('xref\n0 ' + str(len(offsets) + 1) +
+                   '\n0000000000 65535 f \n').encode())
+        pdf.write(''.join(f'{o:010} 00000 n \n' for o in offsets).encode())
+        pdf.write(('trailer\n<< /Size ' + str(len(offsets) + 1) +
+                   ' /Root 1 0 R >>\nstartxref\n' + str(xref) +
+                   '\n%%EOF\n').encode())
+###############################################################################
+
+
+
+###############################################################################
+def render_report(path, out_path, window_ms=WINDOW_MS,
+                  strips=STRIPS_PER_PAGE, n_workers=None,
+                                              pages_per_task=PAGES_PER_TASK):
+    """
+    path: (str) processed study (csv or archive)
+    out_path: (str) PDF of the report, or directory of the PNG pages
+    window_ms: (int) time window of each strip (ms)
+    strips: (int) strips per page
+    n_workers: (int) number of worker processes (None: number of cores)
+    pages_per_task: (int) pages rendered by each task
+    Renders the whole study (union of the time ranges of the impedance and
+    of the pH) as pages of consecutive time windows on a process pool. The
+    workers read the study from an archive, decoding only the blocks of
+    their strips: a csv is converted once. The PDF is written under a
+    temporary name and moved in place only when complete. Returns the number
+    of pages.
+    """
+
+    study = read_study(path)
+    stores = [store for store in (study.impedence, study.ph) if len(store)]
+    t_start = min(store.time.min() for store in stores)
+    t_end = max(store.time.max() for store in stores)
+    n_pages = max(int(np.ceil((t_end - t_start)/(window_ms*strips))), 1)
+
+    work_dir = tempfile.mkdtemp()
+    source = path
+    if not path.endswith(ARCHIVE_EXTENSION):
+        source = os.path.join(work_dir, 'study' + ARCHIVE_EXTENSION)
+        write_archive(source, study)
+    del study, stores
+
+    pdf = out_path.lower().endswith('.pdf')
+    out_dir = work_dir if pdf else out_path
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    partial = out_path + '.part'
+
+    tasks = [(source, os.path.basename(path),
+              list(range(i, min(i + pages_per_task, n_pages))), t_start,
+              window_ms, strips, out_dir, 'jpeg' if pdf else 'png')
+                                     for i in range(0, n_pages, pages_per_task)]
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # The pages are merged in order while the next ones are rendered
+            pages = (page for written in executor.map(render_pages, tasks)
+                                                       for page in written)
+            if pdf:
+                write_pdf(partial, pages)
+                os.replace(partial, out_path)
+            else:
+                for _ in pages:
+                    pass
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("Report pages: ", n_pages)
+    return n_pages
+###############################################################################
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local tile server of the Time Series Scribe.
+A small asyncio HTTP service (run on localhost) serves a processed study to
+a browser: decimated min/max tiles of the signals (time range x zoom level),
+read from a decimation pyramid and kept in the shared LRU block cache, as
+JSON or compact binary, the labelled intervals and a minimal static HTML
+viewer.
+
+Endpoints:
+    /                                          HTML viewer
+    /info                                      channels, bounds, levels
+    /window?store=&t0=&t1=&width=              level and tiles of a view
+    /tile/<store>/<level>/<index>.json|.bin    one tile
+    /labels?t0=&t1=                            labelled intervals
+
+Binary tiles (little endian): uint32 n_channels, uint32 n_bins, int64
+time[n_bins], float32 min[n_channels, n_bins], float32 max[n_channels, n_bins].
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import sys
+import json
+import uuid
+import asyncio
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from TSS_archive import block_cache, read_study
+from TSS_decimation import MinMaxPyramid
+
+
+
+#%% Parameters
+HOST = '127.0.0.1'                  # Local only
+PORT = 8765                         # Default port
+
+VIEWER_HTML = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Time Series Scribe</title>
+<style>body{font-family:Helvetica;margin:10px} canvas{border:1px solid #ccc}
+</style></head><body>
+<div><button id="ll">&lt;&lt;</button><button id="l">&lt;</button>
+<button id="zi">+</button><button id="zo">-</button>
+<button id="r">&gt;</button><button id="rr">&gt;&gt;</button>
+<span id="status"></span></div>
+<canvas id="plot" width="1200" height="600"></canvas>
+<script>
+const colors = ['#0173b2','#de8f05','#029e73','#d55e00','#cc78bc','#ca9161',
+                '#fbafe4'];
+let info = null, t0 = 0, span = 120000;
+const canvas = document.getElementById('plot');
+const ctx = canvas.getContext('2d');
+
+async function getJSON(url) { return (await fetch(url)).json(); }
+
+async function tiles(store) {
+  const w = await getJSON('/window?store=' + store + '&t0=' + t0 + '&t1=' +
+                          (t0 + span) + '&width=' + canvas.width);
+  return Promise.all(w.tiles.map(i =>
+    getJSON('/tile/' + store + '/' + w.level + '/' + i + '.json')));
+}
+
+function draw(tileList, rows, row0, scale) {
+  const h = canvas.height / rows;
+  for (const tile of tileList) {
+    tile.min.forEach((lower, k) => {
+      const upper = tile.max[k], base = (rows - row0 - k) * h;
+      ctx.strokeStyle = colors[(row0 + k) % colors.length];
+      ctx.beginPath();
+      tile.time.forEach((t, i) => {
+        const x = (t - t0) / span * canvas.width;
+        ctx.moveTo(x, base - lower[i] * scale * h);
+        ctx.lineTo(x + 0.5, base - upper[i] * scale * h);
+      });
+      ctx.stroke();
+    });
+  }
+}
+
+async function render() {
+  const [imp, ph, labels] = await Promise.all([tiles('impedence'),
+    tiles('ph'), getJSON('/labels?t0=' + t0 + '&t1=' + (t0 + span))]);
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  for (const label of labels) {
+    ctx.fillStyle = label.color; ctx.globalAlpha = 0.2;
+    ctx.fillRect((label.start - t0) / span * canvas.width, 0,
+                 (label.end - label.start) / span * canvas.width,
+                 canvas.height);
+  }
+  ctx.globalAlpha = 1;
+  const rows = info.stores.impedence.names.length + 1;
+  draw(ph, rows, 0, 1 / 9);
+  draw(imp, rows, 1, 1 / 7);
+  document.getElementById('status').textContent =
+    new Date(t0).toISOString().substr(11, 8) + ' + ' + span / 1000 + ' s';
+}
+
+function move(f) {
+  t0 = Math.min(Math.max(t0 + f * span, info.t_min), info.t_max - span);
+  render();
+}
+document.getElementById('ll').onclick = () => move(-1);
+document.getElementById('l').onclick = () => move(-0.1);
+document.getElementById('r').onclick = () => move(0.1);
+document.getElementById('rr').onclick = () => move(1);
+document.getElementById('zi').onclick = () => { span /= 2; render(); };
+document.getElementById('zo').onclick = () => {
+  span = Math.min(span * 2, info.t_max - info.t_min); render(); };
+
+getJSON('/info').then(i => { info = i; t0 = i.t_min; render(); });
+</script></body></html>
+'''
+
+
+
+#%% Tile server
+class TileServer():
+
+    ###########################################################################
+    def __init__(self, study, host=HOST, port=PORT, cache=None):
+        '''
+        study: (Study) study to serve (as loaded by import_signal)
+        host, port: (str, int) address of the server (localhost by default)
+        cache: (BlockCache) cache of the encoded tiles (shared by default)
+        '''
+
+        self.study = study
+        self.uid = uuid.uuid4().hex         # Owner of the tiles in the cache
+        self.host = host
+        self.port = port
+        self.stores = {'impedence': study.impedence, 'ph': study.ph}
+        self.cache = block_cache if cache is None else cache
+        self.pyramids = {name: MinMaxPyramid(store)
+                                       for name, store in self.stores.items()}
+        self.server = None
+        self.loop = None
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def info(self):
+        """
+        Returns the description of the served study.
+        """
+        stores = {name: {'names': list(store.names), 'n': len(store),
+                         'levels': self.pyramids[name].n_levels,
+                         'tile_size': self.pyramids[name].tile_size,
+                         't_min': int(store.time.min()),
+                         't_max': int(store.time.max())}
+                  for name, store in self.stores.items()}
+        return {'stores': stores,
+                't_min': max(s['t_min'] for s in stores.values()),
+                't_max': min(s['t_max'] for s in stores.values()),
+                'n_labels': len(self.study.category)}
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def window(self, store, t_min, t_max, width):
+        """
+        Returns the level and the tiles covering the time range with about
+        width bins.
+        """
+        pyramid = self.pyramids[store]
+        level = pyramid.level_for(t_min, t_max, width)
+        return {'level': level,
+                'tiles': list(pyramid.tile_range(level, t_min, t_max))}
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        """
+        Memory of the levels of the pyramids (the tiles are in the cache).
+        """
+        return sum(pyramid.nbytes for pyramid in self.pyramids.values())
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def tile(self, store, level, index, binary=False):
+        """
+        Returns the encoded tile (JSON or binary), from the LRU cache if it
+        has already been requested.
+        """
+
+        key = (self.uid, store, level, index, binary)
+        encoded = self.cache.get(key)
+        if encoded is not None:
+            return encoded.tobytes()
+
+        pyramid = self.pyramids[store]
+        if not (0 <= level < pyramid.n_levels) or index < 0 or \
+                index*pyramid.tile_size >= pyramid.level_length(level):
+            raise KeyError('No tile ' + str(key))
+
+        time, lower, upper = pyramid.tile(level, index)
+        if binary:
+            payload = (np.array(lower.shape, dtype='<u4').tobytes() +
+                       np.asarray(time, dtype='<i8').tobytes() +
+                       np.asarray(lower, dtype='<f4').tobytes() +
+                       np.asarray(upper, dtype='<f4').tobytes())
+        else:
+            payload = json.dumps({'level': level, 'index': index,
+                    'time': np.asarray(time).tolist(),
+                    'min': np.round(lower.astype(np.float64), 3).tolist(),
+                    'max': np.round(upper.astype(np.float64), 3).tolist()}
+                                  ).replace('NaN', 'null').encode()
+
+        self.cache.put(key, np.frombuffer(payload, dtype=np.uint8))
+        return payload
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def labels(self, t_min=-np.inf, t_max=np.inf):
+        """
+        Returns the labelled intervals overlapping the time range.
+        """
+        return [{'category': c, 'start': float(x[0]), 'end': float(x[1]),
+                 'color': color}
+                for c, x, color in zip(self.study.category,
+                               self.study.x_values, self.study.color_category)
+                if x[1] >= t_min and x[0] <= t_max]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def route(self, target):
+        """
+        target: (str) path and query of the request
+        Returns the status, the content type and the body of the response.
+        """
+
+        url = urlsplit(target)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split('/') if p]
+
+        if not parts:
+            return 200, 'text/html; charset=utf-8', VIEWER_HTML.encode()
+
+        if parts == ['info']:
+            body = self.info()
+        elif parts == ['window']:
+            body = self.window(query.get('store', 'impedence'),
+                               float(query['t0']), float(query['t1']),
+                               int(query.get('width', 1000)))
+        elif parts == ['labels']:
+            body = self.labels(float(query.get('t0', -np.inf)),
+                               float(query.get('t1', np.inf)))
+        elif len(parts) == 4 and parts[0] == 'tile':
+            index, extension = parts[3].rsplit('.', 1)
+            binary = extension == 'bin'
+            payload = self.tile(parts[1], int(parts[2]), int(index), binary)
+            return 200, ('application/octet-stream' if binary else
+                                               'application/json'), payload
+        else:
+            raise KeyError(url.path)
+
+        return 200, 'application/json', json.dumps(body).encode()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    async def handle(self, reader, writer):
+        """
+        Serves one HTTP request (GET only). The tiles are computed in the
+        default executor, so that concurrent requests are not serialized.
+        """
+
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass                                    # Skip the headers
+
+            if len(request) < 2 or request[0] != 'GET':
+                status, content, body = 405, 'text/plain', b'GET only'
+            else:
+                try:
+                    status, content, body = await \
+                        asyncio.get_running_loop().run_in_executor(
+                                                  None, self.route, request[1])
+                except (KeyError, ValueError) as error:
+                    status, content, body = 404, 'text/plain', \
+                                                          str(error).encode()
+
+            reason = {200: 'OK', 404: 'Not Found',
+                                         405: 'Method Not Allowed'}[status]
+            writer.write(('HTTP/1.1 ' + str(status) + ' ' + reason + '\r\n'
+                          'Content-Type: ' + content + '\r\n'
+                          'Content-Length: ' + str(len(body)) + '\r\n'
+                          'Access-Control-Allow-Origin: *\r\n'
+                          'Connection: close\r\n\r\n').encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    async def serve(self):
+        """
+        Runs the server until it is stopped.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, self.host,
+                                                                    self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        async with self.server:
+            await self.server.serve_forever()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def start(self):
+        """
+        Starts the server in a background (daemon) thread, e.g. from the GUI.
+        Returns the url of the viewer.
+        """
+
+        started = threading.Event()
+
+        def run():
+            async def main():
+                task = asyncio.ensure_future(self.serve())
+                while self.server is None and not task.done():
+                    await asyncio.sleep(0.01)
+                started.set()
+                await task
+            try:
+                asyncio.run(main())
+            except asyncio.CancelledError:
+                pass
+            finally:
+                started.set()
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return 'http://' + self.host + ':' + str(self.port) + '/'
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def stop(self):
+        """
+        Stops the server started with start() and drops its tiles from the
+        cache.
+        """
+        if self.server is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.cache.discard({self.uid})
+    ###########################################################################
+
+
+
+#%% Serve a study from the command line: python TSS_server.py study.tssa
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python TSS_server.py processed_study [port]')
+        sys.exit(1)
+
+    tile_server = TileServer(read_study(sys.argv[1]),
+                        port=int(sys.argv[2]) if len(sys.argv) > 2 else PORT)
+    print('Serving ' + sys.argv[1] + ' on http://' + HOST + ':' +
+                                                      str(tile_server.port))
+    asyncio.run(tile_server.serve())
+###############################################################################
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-study session of the Time Series Scribe.
+Several studies are kept open at once. The decoded archive blocks, the
+derived channels and the tiles of all the studies live in the block cache
+of the process, and the session shares one memory budget between that cache,
+the signals held in memory (studies loaded from csv) and the pinned objects
+that cannot be evicted (the decimation pyramids of a tile server): when the
+budget is exceeded, the signals of the least recently used studies are
+released (their labels and view are kept) and loaded again when the study
+is shown.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import os
+from collections import OrderedDict
+
+from TSS_archive import block_cache
+
+
+
+#%% Parameters
+SESSION_BYTES = 1024*2**20          # Memory budget of the session
+MIN_CACHE_BYTES = 32*2**20          # Minimum budget of the block cache
+
+
+
+#%% Open study
+class SessionStudy():
+
+    ###########################################################################
+    def __init__(self, key, study, loader=None):
+        '''
+        key: (str) identifier of the study (path of its file)
+        study: (Study) loaded study
+        loader: (function) loader(key) -> Study, to load the signals again
+            (None: the signals cannot be released, e.g. in follow mode)
+        '''
+
+        self.key = key
+        self.study = study
+        self.loader = loader
+        self.state = {}                     # View and analyses of the GUI
+        self.kept = None                    # Labels of a released study
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def name(self):
+        return os.path.basename(self.key)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        """
+        Memory of the signals held by the study (0 if released).
+        """
+        return 0 if self.study is None else self.study.nbytes
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def release(self):
+        """
+        Releases the signals, keeping the labels, the diary and the quality
+        report of the study.
+        """
+        study = self.study
+        self.kept = {'category': study.category, 'x_values': study.x_values,
+                     'color_category': study.color_category,
+                     'diary': study.diary, 'quality': study.quality}
+        self.study = None
+        return study
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def load(self):
+        """
+        Returns the study, loading its signals again if they were released.
+        """
+        if self.study is None:
+            self.study = self.loader(self.key)
+            for name, value in self.kept.items():
+                setattr(self.study, name, value)
+            self.kept = None
+        return self.study
+    ###########################################################################
+
+
+
+#%% Session
+class StudySession():
+
+    ###########################################################################
+    def __init__(self, max_bytes=SESSION_BYTES, cache=None,
+                                           min_cache_bytes=MIN_CACHE_BYTES):
+        '''
+        max_bytes: (int) memory budget of the signals and of the cache
+        cache: (BlockCache) cache shared by the studies (process-wide by
+            default)
+        min_cache_bytes: (int) minimum budget left to the cache
+        '''
+
+        self.max_bytes = max_bytes
+        self.min_cache_bytes = min_cache_bytes
+        self.cache = block_cache if cache is None else cache
+        self.studies = OrderedDict()        # Least recently used first
+        self.order = []                     # Keys in opening order (tabs)
+        self.pinned = []                    # Resident objects (nbytes)
+        self.active = None
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return len(self.studies)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def resident_bytes(self):
+        """
+        Memory of the signals held by the open studies and of the pinned
+        objects.
+        """
+        return sum(entry.nbytes for entry in self.studies.values()) + \
+                                  sum(item.nbytes for item in self.pinned)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        """
+        Memory of the session (signals and block cache).
+        """
+        return self.resident_bytes + self.cache.n_bytes
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def open(self, key, study, loader=None):
+        """
+        Adds (or replaces) a study and makes it the active one.
+        Returns the SessionStudy.
+        """
+        if key in self.studies:
+            self.close(key)
+        self.studies[key] = SessionStudy(key, study, loader)
+        self.order.append(key)
+        return self.activate(key)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def activate(self, key):
+        """
+        Makes a study the active (most recently used) one, loading its
+        signals if they were released. Returns the SessionStudy.
+        """
+        entry = self.studies[key]
+        self.studies.move_to_end(key)
+        self.active = key
+        entry.load()
+        self.enforce_budget()
+        return entry
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def pin(self, item):
+        """
+        Counts a resident object (with nbytes, e.g. a tile server and its
+        pyramids) in the budget of the session.
+        """
+        self.pinned.append(item)
+        self.enforce_budget()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def unpin(self, item):
+        """
+        Stops counting a pinned object.
+        """
+        if item in self.pinned:
+            self.pinned.remove(item)
+        self.enforce_budget()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def close(self, key):
+        """
+        Closes a study, drops its blocks from the cache and closes its
+        archive. Returns the key of the study to show next (most recently
+        used) or None.
+        """
+        entry = self.studies.pop(key)
+        self.order.remove(key)
+        if entry.study is not None:
+            self.cache.discard(cache_owners(entry.study))
+            close_readers(entry.study)
+        if self.active == key:
+            self.active = next(reversed(self.studies), None)
+        return self.active
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def enforce_budget(self):
+        """
+        Releases the signals of the least recently used (inactive) studies
+        until they fit in the budget, and gives the rest of the budget to
+        the block cache (the cache evicts its least recently used blocks,
+        whatever their study). The archives of the released studies are
+        closed (the loader opens them again); the studies served by a pinned
+        object are kept.
+        """
+
+        served = [item.study.impedence for item in self.pinned
+                                                   if hasattr(item, 'study')]
+        for key, entry in self.studies.items():
+            if self.resident_bytes <= self.max_bytes - self.min_cache_bytes:
+                break
+            if key != self.active and entry.study is not None and \
+                  entry.loader is not None and \
+                  not any(store is entry.study.impedence for store in served):
+                study = entry.release()
+                self.cache.discard(cache_owners(study))
+                close_readers(study)
+
+        self.cache.resize(max(self.max_bytes - self.resident_bytes,
+                                                        self.min_cache_bytes))
+    ###########################################################################
+
+
+
+#%% Aux functions
+###############################################################################
+def cache_owners(study):
+    """
+    Returns the owners of the cached blocks of a study (archive uid and
+    identity of the stores).
+    """
+    owners = set()
+    for store in (study.impedence, study.ph):
+        owners.add(id(store))
+        if hasattr(store, 'reader'):
+            owners.add(store.reader.uid)
+    return owners
+###############################################################################
+
+
+
+###############################################################################
+def close_readers(study):
+    """
+    Closes the archive files of a study (the stores read from an archive
+    share the same reader).
+    """
+    for store in (study.impedence, study.ph):
+        if hasattr(store, 'reader') and not store.reader.file.closed:
+            store.reader.close()
+###############################################################################
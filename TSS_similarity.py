@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Query-by-example search of the Time Series Scribe.
+A labelled interval is used as template and compared with every position of
+the whole recording by normalized cross-correlation of the impedance
+channels (mean of the channels). The correlations are computed with the FFT
+on chunks of the recording, each split in overlapping segments of a few
+templates (overlap-save, all the segments and channels in one batched FFT),
+so the memory is bounded by the chunk size; the window statistics come from
+cumulative sums.
+Each chunk is reduced to the best position of each block of half a template,
+and the best non-overlapping positions are returned as ranked candidate
+intervals. The chunks can be spread on a process pool.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from TSS_archive import read_study
+
+
+
+#%% Parameters
+CHUNK_SAMPLES = 2**18               # Samples of each chunk
+SEGMENT_FACTOR = 4                  # FFT segments: 4 templates (power of 2)
+MAX_CANDIDATES = 50                 # Candidates returned by the search
+MIN_SCORE = 0.6                     # Minimum correlation of the candidates
+MIN_TEMPLATE_SAMPLES = 4            # Shorter templates are not searched
+CHUNKS_PER_TASK = 4                 # Chunks scored by each task
+
+# State of each worker process: loaded study
+WORKER = {}
+
+
+
+#%% Aux functions
+###############################################################################
+def template_block(store, start, end):
+    """
+    store: (ChannelStore) impedance channels
+    start, end: (float) labelled interval (ms)
+    Returns the template (n_channels, m) with zero mean channels, the weight
+    of each channel (1 if the channel varies in the template, 0 otherwise)
+    and its first sample.
+    """
+
+    i0, i1 = store.time.searchsorted([start, end])
+    i1 = max(int(i1), int(i0) + 1)
+    if i1 - i0 < MIN_TEMPLATE_SAMPLES:
+        raise ValueError('the template has less than ' +
+                                 str(MIN_TEMPLATE_SAMPLES) + ' samples')
+
+    template = np.nan_to_num(np.asarray(store.block(i0, i1),
+                                                      dtype=np.float64))
+    template -= template.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.sum(template**2, axis=1))
+    weights = (norms > 1e-9*max(np.max(norms), 1e-300)).astype(np.float64)
+    template /= np.where(weights > 0, norms, 1)[:, None]
+
+    return template, weights, int(i0)
+###############################################################################
+
+
+
+###############################################################################
+def chunk_scores(block, template_fft, weights, m, fft_size):
+    """
+    block: ((n_channels, n) array) samples of a chunk
+    template_fft: (array) conjugated FFT of the normalized template (size
+        of the FFT segments)
+    weights: (array) weight of each channel
+    m: (int) samples of the template
+    fft_size: (int) size of the FFT segments
+    Returns the normalized cross-correlation (mean of the channels) of the
+    n - m + 1 positions of the chunk.
+    """
+
+    n_channels, n = block.shape
+    n_out = n - m + 1
+    seg_step = fft_size - m + 1
+    n_seg = int(np.ceil(n_out/seg_step))
+
+    # Centred chunk (same correlations, accurate cumulative sums), padded to
+    # whole segments
+    padded = np.zeros((n_channels, n_seg*seg_step + m - 1))
+    x = padded[:, :n]
+    x[:] = block
+    x[np.isnan(x)] = 0
+    x -= x.mean(axis=1, keepdims=True)
+
+    # Sums of the template by the chunk (the template has zero mean), on
+    # overlapping segments: each one gives fft_size - m + 1 positions
+    segments = np.lib.stride_tricks.sliding_window_view(padded, fft_size,
+                                                      axis=1)[:, ::seg_step]
+    products = np.fft.irfft(np.fft.rfft(segments, axis=2)*
+                            template_fft[:, None, :], fft_size, axis=2)
+    products = products[:, :, :seg_step].reshape(n_channels, -1)[:, :n_out]
+
+    # Standard deviation (times sqrt(m)) of the windows of the chunk
+    sums = np.zeros((n_channels, n + 1))
+    np.cumsum(x, axis=1, out=sums[:, 1:])
+    spread = sums[:, m:] - sums[:, :-m]
+    spread *= spread/m
+    np.cumsum(x*x, axis=1, out=sums[:, 1:])
+    spread -= sums[:, m:]
+    spread += sums[:, :-m]
+    np.negative(spread, out=spread)
+    np.sqrt(np.maximum(spread, 0, out=spread), out=spread)
+
+    ncc = np.zeros_like(products)
+    np.divide(products, spread, out=ncc, where=spread > 1e-9)
+
+    return (weights @ np.clip(ncc, -1, 1)/np.sum(weights)).astype(np.float32)
+###############################################################################
+
+
+
+###############################################################################
+def chunk_peaks(store, template, weights, starts, step, block_size):
+    """
+    store: (ChannelStore) impedance channels
+    template: ((n_channels, m) array) normalized template
+    weights: (array) weight of each channel
+    starts: (list) first position of each chunk
+    step: (int) positions of each chunk (multiple of block_size)
+    block_size: (int) positions of each block
+    Returns the best position and score of each block of the chunks.
+    """
+
+    m = template.shape[1]
+    fft_size = 1 << int(np.ceil(np.log2(SEGMENT_FACTOR*m)))
+    # Correlation: product with the conjugated FFT of the template
+    template_fft = np.conj(np.fft.rfft(template, fft_size, axis=1))
+
+    n_time = len(store)
+    positions, scores = [], []
+    for i0 in starts:
+        i1 = min(i0 + step + m - 1, n_time)
+        score = chunk_scores(store.block(i0, i1), template_fft, weights, m,
+                                                                      fft_size)
+
+        # Best position of each block (the last block is padded)
+        n_blocks = int(np.ceil(len(score)/block_size))
+        padded = np.full(n_blocks*block_size, -np.inf, dtype=np.float32)
+        padded[:len(score)] = score
+        best = np.argmax(padded.reshape(n_blocks, block_size), axis=1)
+        positions.append(i0 + np.arange(n_blocks)*block_size + best)
+        scores.append(padded.reshape(n_blocks, block_size)[
+                                                np.arange(n_blocks), best])
+
+    return np.concatenate(positions), np.concatenate(scores)
+###############################################################################
+
+
+
+###############################################################################
+def score_chunks(args):
+    """
+    args: (tuple) path of the study, template, weights, chunk starts, step
+        and block size
+    Worker: chunk_peaks of the impedance channels of the study (loaded once
+    by each process).
+    """
+
+    path, template, weights, starts, step, block_size = args
+    if WORKER.get('path') != path:
+        WORKER['path'] = path
+        WORKER['study'] = read_study(path)
+
+    return chunk_peaks(WORKER['study'].impedence, template, weights, starts,
+                                                            step, block_size)
+###############################################################################
+
+
+
+###############################################################################
+def select_candidates(positions, scores, m, max_candidates=MAX_CANDIDATES,
+                                      min_score=MIN_SCORE, exclude=None):
+    """
+    positions, scores: (array) best position and score of each block
+    m: (int) samples of the template
+    max_candidates: (int) maximum number of candidates
+    min_score: (float) minimum score of the candidates
+    exclude: (int) first sample of the template (its position is skipped)
+    Returns the positions and scores of the best non-overlapping candidates,
+    by decreasing score.
+    """
+
+    keep = scores >= min_score
+    positions, scores = positions[keep], scores[keep]
+    order = np.argsort(-scores, kind='stable')
+
+    taken = [] if exclude is None else [exclude]
+    selected = []
+    for i in order:
+        if len(selected) >= max_candidates:
+            break
+        if taken and np.min(np.abs(np.asarray(taken) - positions[i])) < m:
+            continue
+        taken.append(positions[i])
+        selected.append(i)
+
+    selected = np.asarray(selected, dtype=np.int64)
+    return positions[selected], scores[selected]
+###############################################################################
+
+
+
+###############################################################################
+def find_similar(study, start, end, max_candidates=MAX_CANDIDATES,
+                 min_score=MIN_SCORE, chunk_samples=CHUNK_SAMPLES,
+                                                    n_workers=1, path=None):
+    """
+    study: (Study) imported study
+    start, end: (float) labelled interval used as template (ms)
+    max_candidates: (int) maximum number of candidates
+    min_score: (float) minimum normalized cross-correlation (-1 to 1)
+    chunk_samples: (int) samples of each FFT chunk (bounds the memory)
+    n_workers: (int) worker processes (1: in this process, None: number of
+        cores); the workers load the study from path
+    path: (str) processed study (csv or archive), needed by the workers
+    Returns the candidate intervals ([start, end] in ms, as x_values) and
+    their scores, by decreasing score. The template itself is excluded.
+    """
+
+    store = study.impedence
+    template, weights, first = template_block(store, start, end)
+    m = template.shape[1]
+    n_positions = len(store) - m + 1
+    if n_positions < 1:
+        return [], np.empty(0, dtype=np.float32)
+
+    # Chunks of whole blocks of positions (half a template per block)
+    block_size = max(m//2, 1)
+    step = max(chunk_samples - m + 1, block_size)//block_size*block_size
+    starts = list(range(0, n_positions, step))
+
+    def task_starts():
+        for i in range(0, len(starts), CHUNKS_PER_TASK):
+            yield starts[i:i+CHUNKS_PER_TASK]
+
+    if n_workers == 1 or path is None or len(starts) == 1:
+        results = [chunk_peaks(store, template, weights, s, step, block_size)
+                                                       for s in task_starts()]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(score_chunks,
+                    [(path, template, weights, s, step, block_size)
+                                                   for s in task_starts()]))
+
+    positions = np.concatenate([r[0] for r in results])
+    scores = np.concatenate([r[1] for r in results])
+    positions, scores = select_candidates(positions, scores, m,
+                                     max_candidates, min_score, exclude=first)
+
+    x_values = [[int(store.time[i]), int(store.time[i + m - 1])]
+                                                             for i in positions]
+    return x_values, scores
+###############################################################################
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Snapping of the label boundaries of the Time Series Scribe.
+At import the candidate boundaries of the labels are computed once with
+vectorized threshold passes: onsets and recoveries of the impedance drops of
+each channel (impedance below a fraction of its baseline) and crossings of
+the pH threshold. They are kept in a single sorted index, so that each click
+is snapped to the nearest candidate with one searchsorted lookup.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import numpy as np
+
+from TSS_derived import baseline, moving_average
+from TSS_export import sample_interval
+
+
+
+#%% Parameters
+DROP_FRACTION = 0.5                 # Drop: impedance below 50% of baseline
+BASELINE_MS = 30000                 # Segments of the baseline impedance (ms)
+SMOOTH_MS = 200                     # Moving average before the thresholds
+PH_THRESHOLD = 4                    # Acid exposure: pH below 4
+MIN_DROP_MS = 250                   # Shorter drops are ignored (ms)
+SNAP_FRACTION = 0.02                # Snapping distance (fraction of window)
+
+# Kinds of the candidate boundaries
+SNAP_KINDS = ['Drop onset', 'Drop recovery', 'pH fall', 'pH rise']
+
+
+
+#%% Snapping index
+class SnapIndex():
+
+    ###########################################################################
+    def __init__(self, time, kind, channel):
+        '''
+        time: (array) time of the candidate boundaries (ms)
+        kind: (array) index of the kind of each boundary (SNAP_KINDS)
+        channel: (array) channel of each boundary
+        '''
+
+        order = np.argsort(time, kind='stable')
+        self.time = np.asarray(time, dtype=np.int64)[order]
+        self.kind = np.asarray(kind, dtype=np.int8)[order]
+        self.channel = np.asarray(channel, dtype=np.int8)[order]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return len(self.time)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def nearest(self, x):
+        """
+        x: (float or array) clicked time(s)
+        Returns the position(s) in the index of the nearest candidates.
+        """
+
+        i = np.clip(np.searchsorted(self.time, x), 1, len(self.time) - 1)
+        left = np.abs(np.asarray(x) - self.time[i-1]) <= \
+                                          np.abs(self.time[i] - np.asarray(x))
+        return np.where(left, i-1, i)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def snap(self, x, max_distance=np.inf):
+        """
+        x: (float) clicked time
+        max_distance: (float) maximum distance of the candidate (ms)
+        Returns the time of the nearest candidate boundary, or x itself if no
+        candidate is closer than max_distance.
+        """
+
+        if len(self.time) < 2:
+            return x if len(self.time) == 0 or \
+                      abs(self.time[0] - x) > max_distance else self.time[0]
+
+        candidate = self.time[self.nearest(x)]
+        return int(candidate) if abs(candidate - x) <= max_distance else x
+    ###########################################################################
+
+
+
+#%% Aux functions
+###############################################################################
+def crossings(below, time, min_samples=1):
+    """
+    below: (bool array) samples below the threshold
+    time: (array) time of the samples
+    min_samples: (int) minimum length of the runs below the threshold
+    Returns the times of the falls below and of the rises above the
+    threshold of the runs lasting at least min_samples.
+    """
+
+    edges = np.diff(below.astype(np.int8))
+    falls = np.flatnonzero(edges == 1) + 1
+    rises = np.flatnonzero(edges == -1) + 1
+
+    # Pair each fall with the next rise (the borders close the open runs)
+    if below[0]:
+        falls = np.concatenate([[0], falls])
+    if below[-1]:
+        rises = np.concatenate([rises, [len(below) - 1]])
+    keep = rises - falls >= min_samples
+
+    return time[falls[keep]], time[rises[keep]]
+###############################################################################
+
+
+
+###############################################################################
+def merge_snap_index(index, tail, t_start):
+    """
+    index: (SnapIndex) candidate boundaries of a study
+    tail: (SnapIndex) boundaries of the last part of the study (e.g. after
+        new samples in follow mode)
+    t_start: (float) the boundaries from t_start on are taken from tail
+    Returns the merged SnapIndex.
+    """
+    old, new = index.time < t_start, tail.time >= t_start
+    return SnapIndex(np.concatenate([index.time[old], tail.time[new]]),
+                     np.concatenate([index.kind[old], tail.kind[new]]),
+                     np.concatenate([index.channel[old], tail.channel[new]]))
+###############################################################################
+
+
+
+###############################################################################
+def build_snap_index(study, drop_fraction=DROP_FRACTION,
+                     ph_threshold=PH_THRESHOLD, baseline_ms=BASELINE_MS,
+                          smooth_ms=SMOOTH_MS, min_drop_ms=MIN_DROP_MS):
+    """
+    study: (Study) imported study
+    drop_fraction: (float) impedance drop threshold (fraction of baseline)
+    ph_threshold: (float) pH threshold
+    baseline_ms, smooth_ms: (int) baseline segments and smoothing (ms)
+    min_drop_ms: (int) minimum duration of the impedance drops (ms)
+    Returns the SnapIndex of the candidate boundaries of the study.
+    """
+
+    times, kinds, channels = [], [], []
+
+    def add(time, kind, channel):
+        times.append(time)
+        kinds.append(np.full(len(time), kind, dtype=np.int8))
+        channels.append(np.full(len(time), channel, dtype=np.int8))
+
+    # Impedance drops below a fraction of the baseline of each channel
+    store = study.impedence
+    if len(store) > 1:
+        step = max(sample_interval(store.time), 1)
+        time = store.time.to_array()
+        for k in range(store.n_channels):
+            values = store.channel(k)[None, :]
+            smooth = moving_average(values, time,
+                                    max(int(round(smooth_ms/step)), 1))
+            reference = baseline(values, time,
+                                    max(int(round(baseline_ms/step)), 1))
+            onsets, recoveries = crossings(smooth < drop_fraction*reference,
+                            time, max(int(round(min_drop_ms/step)), 1))
+            add(onsets, 0, k)
+            add(recoveries, 1, k)
+
+    # Crossings of the pH threshold
+    store = study.ph
+    if len(store) > 1:
+        falls, rises = crossings(store.channel(0) < ph_threshold,
+                                                       store.time.to_array())
+        add(falls, 2, -1)
+        add(rises, 3, -1)
+
+    if not times:
+        return SnapIndex([], [], [])
+    return SnapIndex(np.concatenate(times), np.concatenate(kinds),
+                                                    np.concatenate(channels))
+###############################################################################
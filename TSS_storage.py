@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact storage of the channels used by the Time Series Scribe.
+The time base is kept as int64 (or as a start plus a constant sample interval
+when the sampling is regular) and the values as float32 or as scaled int16
+with a per-channel scale/offset. The float64 mode keeps the original precision.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import numpy as np
+import pandas as pd
+
+from TSS_diary import DIARY_COLUMNS, read_diary, diary_from_columns
+from TSS_quality import QUALITY_COLUMNS, quality_from_columns
+
+
+
+#%% Parameters
+STORAGE_MODES = ('float64', 'float32', 'int16')     # Available storage modes
+
+# Columns of the processed csv
+IMPEDENCE_COLUMNS = ['Time(ms)','Value_1','Value_2','Value_3','Value_4',
+                                                         'Value_5','Value_6']
+PH_COLUMNS = ['Time_ph(ms)','Value_ph']
+LABEL_COLUMNS = ['labels','color_label','intervals']
+
+INT16_NAN = -32768              # int16 code reserved to missing values
+INT16_MAX = 32767               # Maximum absolute int16 code used
+
+
+
+#%% Time base
+class TimeBase():
+
+    ###########################################################################
+    def __init__(self, time):
+        '''
+        time: (array-like) time values (ms)
+        Stores the time values as int64. If the sampling is regular only the
+        start, the sample interval and the number of samples are kept.
+        '''
+
+        time = np.asarray(time, dtype=np.int64)
+
+        self.n = len(time)                  # Number of samples
+        self.start = int(time[0]) if self.n > 0 else 0
+        self.step = None                    # Sample interval (if regular)
+        self.values = None                  # Explicit time values
+
+        if self.n > 1:
+            step = int(time[1] - time[0])
+            if step > 0 and time[-1] - time[0] == step*(self.n-1) and \
+                                        np.all(np.diff(time) == step):
+                self.step = step
+
+        if self.step is None and self.n > 1:
+            self.values = time
+            self.buffer = time              # Storage of the values (append)
+        elif self.n <= 1:
+            self.step = 1
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @classmethod
+    def from_regular(cls, start, step, n):
+        """
+        start: (int) first time value (ms)
+        step: (int) sample interval (ms)
+        n: (int) number of samples
+        Returns the regular time base without building the time values.
+        """
+        time_base = cls(np.empty(0, dtype=np.int64))
+        time_base.start, time_base.step, time_base.n = int(start), int(step), n
+        return time_base
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return self.n
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __getitem__(self, key):
+        '''
+        Returns a single time (int) or an int64 array for a slice.
+        '''
+
+        if self.values is not None:
+            return self.values[key]
+
+        if isinstance(key, slice):
+            i0, i1, di = key.indices(self.n)
+            return self.start + self.step*np.arange(i0, i1, di, dtype=np.int64)
+
+        key = np.asarray(key)
+        if key.ndim == 0:
+            key = int(key)
+            if key < 0:
+                key = key + self.n
+            if key < 0 or key >= self.n:
+                raise IndexError('time index out of range')
+            return self.start + self.step*key
+
+        key = np.where(key < 0, key + self.n, key)
+        return self.start + self.step*key.astype(np.int64)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def is_regular(self):
+        """
+        True if the time base is stored as start plus sample interval.
+        """
+        return self.values is None
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def searchsorted(self, t, side='left'):
+        """
+        t: (float or array) time values (ms)
+        side: 'left' or 'right' as in numpy.searchsorted
+        Returns the insertion indices of t in the (sorted) time base.
+        """
+
+        if self.values is not None:
+            return np.searchsorted(self.values, t, side=side)
+
+        position = (np.asarray(t, dtype=np.float64) - self.start)/self.step
+        if side == 'left':
+            index = np.ceil(position)
+        else:
+            index = np.floor(position) + 1
+
+        index = np.clip(index, 0, self.n).astype(np.int64)
+        return int(index) if index.ndim == 0 else index
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def min(self):
+        """
+        Minimum time value.
+        """
+        if self.values is not None:
+            return int(np.min(self.values))
+        return self.start
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def max(self):
+        """
+        Maximum time value.
+        """
+        if self.values is not None:
+            return int(np.max(self.values))
+        return self.start + self.step*(self.n-1)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def to_array(self):
+        """
+        Returns the whole time base as an int64 array.
+        """
+        return self[0:self.n]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def append(self, time):
+        """
+        time: (array-like) time values (ms) following the last one
+        Appends the values: a regular time base stays regular if the new
+        values continue the sampling, otherwise the values are kept in a 
+        buffer grown by doubling (amortized cost of the new values only).
+        """
+
+        time = np.asarray(time, dtype=np.int64).ravel()
+        m = len(time)
+        if m == 0:
+            return
+
+        if self.values is None:
+            if self.n == 0:
+                self.start = int(time[0])
+                self.step = int(time[1] - time[0]) if m > 1 else 1
+            expected = self.start + self.step*np.arange(self.n, self.n + m,
+                                                             dtype=np.int64)
+            if self.step > 0 and np.array_equal(time, expected):
+                self.n = self.n + m
+                return
+            # The sampling is no longer regular: explicit values
+            self.buffer = self[0:self.n]
+            self.values = self.buffer
+
+        self.buffer = grow_buffer(self.buffer, self.n, self.n + m)
+        self.buffer[self.n:self.n + m] = time
+        self.n = self.n + m
+        self.values = self.buffer[:self.n]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        return 0 if self.values is None else self.values.nbytes
+    ###########################################################################
+
+
+
+#%% Channel store
+class ChannelStore():
+
+    ###########################################################################
+    def __init__(self, time, values, names, mode='float32'):
+        '''
+        time: (array-like or TimeBase) time values (ms)
+        values: (2D array-like) values with shape (n_channels, n_samples)
+        names: (list) names of the channels (csv columns)
+        mode: (str) storage mode, one of STORAGE_MODES
+        '''
+
+        if mode not in STORAGE_MODES:
+            raise ValueError('Unknown storage mode: ' + str(mode))
+
+        self.mode = mode
+        self.names = list(names)
+        self.time = time if isinstance(time, TimeBase) else TimeBase(time)
+
+        values = np.atleast_2d(np.asarray(values))
+        self.scale = None               # Per-channel scale (int16 only)
+        self.offset = None              # Per-channel offset (int16 only)
+
+        if mode == 'int16':
+            self.values, self.scale, self.offset = quantize_int16(values)
+        else:
+            self.values = np.ascontiguousarray(values, dtype=mode)
+        self.buffer = self.values           # Storage of the values (append)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def append(self, time, values):
+        """
+        time: (array-like) time values (ms) of the new samples
+        values: (2D array-like) new values with shape (n_channels, n)
+        Appends samples at the end of the store (e.g. a file still being 
+        written). The buffer grows by doubling, so the cost depends only on 
+        the new samples. In int16 mode the new values are quantized with the 
+        existing scale and offset; if they exceed the range of the codes the 
+        store is widened to float32 once (rare), so the stored samples are 
+        never quantized again.
+        """
+
+        values = np.atleast_2d(np.asarray(values))
+        n, m = len(self), values.shape[1]
+        if m == 0:
+            return
+
+        if self.mode == 'int16':
+            self.widen_int16(values)
+        if self.mode == 'int16':
+            values = quantize_with(values, self.scale, self.offset)
+
+        self.buffer = grow_buffer(self.buffer, n, n + m, axis=1)
+        self.buffer[:, n:n + m] = values
+        self.values = self.buffer[:, :n + m]
+        self.time.append(time)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def __len__(self):
+        return len(self.time)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def n_channels(self):
+        return self.values.shape[0]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def raw(self, k, i0=0, i1=None):
+        """
+        Returns the stored values (codes for int16) of channel k in [i0, i1).
+        """
+        return self.values[k, i0:i1]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def channel(self, k, i0=0, i1=None):
+        """
+        k: (int) index of the channel
+        i0, i1: (int) slice of samples to return
+        Returns the values of the channel k in [i0, i1) as float array.
+        """
+
+        raw = self.raw(k, i0, i1)
+
+        if self.mode != 'int16':
+            return raw
+
+        decoded = raw.astype(np.float32)*self.scale[k] + self.offset[k]
+        decoded[raw == INT16_NAN] = np.nan
+        return decoded
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def block(self, i0=0, i1=None):
+        """
+        Returns all the channels in [i0, i1) as a (n_channels, n) float array.
+        """
+
+        if self.mode != 'int16':
+            return self.values[:, i0:i1]
+
+        return np.stack([self.channel(k, i0, i1)
+                                             for k in range(self.n_channels)])
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def widen_int16(self, values):
+        """
+        values: (2D array) new values of the channels
+        If the new values are out of the range of the int16 codes, decodes
+        the stored values once and switches the store to float32 (widening
+        the codes instead would quantize the stored values again at every
+        widening, losing precision each time, with an O(n) cost).
+        """
+
+        finite = np.where(np.isfinite(values), values, np.nan)
+        with np.errstate(all='ignore'):
+            v_min = np.nanmin(finite, axis=1)
+            v_max = np.nanmax(finite, axis=1)
+
+        lower = self.offset - self.scale*INT16_MAX
+        upper = self.offset + self.scale*INT16_MAX
+        if not np.any((v_min < lower) | (v_max > upper)):
+            return
+
+        n = len(self)
+        decoded = np.empty(self.buffer.shape, dtype=np.float32)
+        decoded[:, :n] = self.block(0, n)
+        self.mode = 'float32'
+        self.scale, self.offset = None, None
+        self.buffer = decoded
+        self.values = decoded[:, :n]
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        """
+        Resident memory of the stored time and values (bytes).
+        """
+        return self.time.nbytes + self.values.nbytes
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def to_dataframe(self, time_name):
+        """
+        time_name: (str) name of the time column
+        Returns the store as a DataFrame with the time and channels columns.
+        """
+
+        df = pd.DataFrame({time_name: self.time.to_array()})
+        for k, name in enumerate(self.names):
+            df[name] = self.channel(k)
+        return df
+    ###########################################################################
+
+
+
+#%% Study
+class Study():
+
+    ###########################################################################
+    def __init__(self, impedence, ph, category=None, x_values=None,
+                  color_category=None, path=None, diary=None, quality=None):
+        '''
+        impedence: (ChannelStore) impedance channels
+        ph: (ChannelStore) pH channel
+        category, x_values, color_category: (list) labelling parameters
+        path: (str) path of the file the study has been loaded from
+        diary: (DiaryTable) events of the medical diary
+        quality: (QualityReport) problems found by the data-quality scan
+        '''
+
+        self.impedence = impedence
+        self.ph = ph
+        self.category = [] if category is None else list(category)
+        self.x_values = [] if x_values is None else list(x_values)
+        self.color_category = [] if color_category is None else \
+                                                           list(color_category)
+        self.path = path
+        self.diary = diary
+        self.quality = quality
+    ###########################################################################
+
+
+
+    ###########################################################################
+    @property
+    def nbytes(self):
+        return self.impedence.nbytes + self.ph.nbytes
+    ###########################################################################
+
+
+
+#%% Aux functions
+###############################################################################
+def grow_buffer(buffer, n, size, axis=0):
+    """
+    buffer: (array) storage with n used entries along axis
+    size: (int) number of entries needed
+    Returns buffer, or a copy with doubled capacity if it is too small.
+    """
+
+    if buffer.shape[axis] >= size:
+        return buffer
+
+    shape = list(buffer.shape)
+    shape[axis] = max(size, 2*shape[axis], 1024)
+    grown = np.empty(shape, dtype=buffer.dtype)
+    index = (slice(None),)*axis + (slice(0, n),)
+    grown[index] = buffer[index]
+    return grown
+###############################################################################
+
+
+
+###############################################################################
+def quantize_with(values, scale, offset):
+    """
+    values: (2D array) values with shape (n_channels, n_samples)
+    scale, offset: (array) per-channel scale and offset of the codes
+    Returns the int16 codes of the values (missing values: INT16_NAN).
+    """
+
+    values = np.asarray(values, dtype=np.float32)
+    q = np.rint((values - offset[:, None])/scale[:, None])
+    codes = np.clip(np.nan_to_num(q, nan=INT16_NAN), -INT16_MAX, INT16_MAX
+                                                          ).astype(np.int16)
+    codes[~np.isfinite(values)] = INT16_NAN
+    return codes
+###############################################################################
+
+
+
+###############################################################################
+def quantize_int16(values):
+    """
+    values: (2D array) values with shape (n_channels, n_samples)
+    Quantizes each channel on int16 with its own scale and offset.
+    Missing values are stored with the INT16_NAN code.
+    """
+
+    values = np.asarray(values, dtype=np.float32)
+    n_channels = values.shape[0]
+
+    codes = np.empty(values.shape, dtype=np.int16)
+    scale = np.ones(n_channels, dtype=np.float32)
+    offset = np.zeros(n_channels, dtype=np.float32)
+
+    for k in range(n_channels):
+        channel = values[k]
+        finite = np.isfinite(channel)
+
+        if np.any(finite):
+            v_min = float(np.min(channel[finite]))
+            v_max = float(np.max(channel[finite]))
+            offset[k] = (v_max + v_min)/2
+            if v_max > v_min:
+                scale[k] = (v_max - v_min)/(2*INT16_MAX)
+
+        q = np.rint((channel - offset[k])/scale[k])
+        q = np.clip(np.nan_to_num(q, nan=INT16_NAN), INT16_NAN, INT16_MAX)
+        codes[k] = q.astype(np.int16)
+        codes[k][~finite] = INT16_NAN
+
+    return codes, scale, offset
+###############################################################################
+
+
+
+###############################################################################
+def find_sections(path, markers=('Ph Array\n','Impedance Array\n','Diary\n')):
+    """
+    path: (str) path of the raw .txt file
+    markers: (tuple) lines identifying the sections
+    Returns a dictionary marker -> line index, reading the file line by line.
+    """
+
+    sections = {}
+    with open(path, 'r') as opener:
+        for n, line in enumerate(opener):
+            if line in markers and line not in sections:
+                sections[line] = n
+
+    for marker in markers:
+        if marker not in sections:
+            raise ValueError(repr(marker) + ' not found in ' + str(path))
+    return sections
+###############################################################################
+
+
+
+###############################################################################
+def read_table_section(path, first_row, n_rows, n_columns, chunk_rows=1000000,
+                                        dtype=np.float32, verbose=False):
+    """
+    path: (str) path of the raw .txt file
+    first_row: (int) index of the first line of the section
+    n_rows: (int) number of lines of the section
+    n_columns: (int) number of columns to read (time + values)
+    chunk_rows: (int) number of rows parsed at once
+    dtype: (numpy dtype) dtype of the parsed values
+    verbose: (bool) print the load percentage
+    Parses a tab separated section in chunks. Returns the int64 time and the
+    values with shape (n_columns-1, n_rows).
+    """
+
+    time = np.empty(n_rows, dtype=np.int64)
+    values = np.empty((n_columns-1, n_rows), dtype=dtype)
+
+    dtypes = {0: np.int64}
+    dtypes.update({c: dtype for c in range(1, n_columns)})
+
+    reader = pd.read_csv(path, sep='\t', header=None, skiprows=first_row,
+                       nrows=n_rows, usecols=list(range(n_columns)),
+                       dtype=dtypes, chunksize=chunk_rows, engine='c')
+
+    filled = 0
+    printed_percentage = 0
+    if verbose:
+        print("Load percentage: ",printed_percentage)
+
+    for chunk in reader:
+        n = len(chunk)
+        time[filled:filled+n] = chunk[0].to_numpy()
+        values[:, filled:filled+n] = chunk.iloc[:, 1:].to_numpy().T
+        filled = filled + n
+
+        tmp_percentage = int(filled*100/max(n_rows, 1))
+        if verbose and tmp_percentage >= printed_percentage+5:
+            printed_percentage = tmp_percentage
+            print("Load percentage: ",printed_percentage)
+
+    return time[:filled], values[:, :filled]
+###############################################################################
+
+
+
+###############################################################################
+def read_digitrapper_txt(path, mode='float32', chunk_rows=1000000):
+    """
+    path: (str) path of the raw .txt exported by the main software
+    mode: (str) storage mode of the channels
+    chunk_rows: (int) number of rows parsed at once
+    Returns the Study with the pH and the 6 impedance channels.
+    """
+
+    sections = find_sections(path)
+    dtype = np.float64 if mode == 'float64' else np.float32
+
+    # Find the beginning of the 7 signals
+    start_ph_array = sections['Ph Array\n'] + 4
+    start_impedence_array = sections['Impedance Array\n'] + 4
+    start_diary = sections['Diary\n']
+
+    # Ph signal
+    time_ph, values_ph = read_table_section(path, start_ph_array,
+                start_impedence_array-5-start_ph_array, 2, chunk_rows, dtype)
+    ph = ChannelStore(time_ph, values_ph, PH_COLUMNS[1:], mode)
+    del values_ph
+
+    # Impedance signals (the sixth channel replicates the fifth column as in
+    # the original parser of the export)
+    time_impedence, values = read_table_section(path, start_impedence_array,
+             start_diary-1-start_impedence_array, 6, chunk_rows, dtype, True)
+    values = np.concatenate([values, values[4:5]])
+    impedence = ChannelStore(time_impedence, values, IMPEDENCE_COLUMNS[1:],
+                                                                         mode)
+    del values
+
+    # Medical diary (meals, body position, symptoms)
+    diary = read_diary(path, start_diary, impedence.time.min())
+
+    return Study(impedence, ph, path=path, diary=diary)
+###############################################################################
+
+
+
+###############################################################################
+def parse_interval(interval):
+    """
+    interval: (str) interval saved in the csv as '[t_start, t_end]'
+    Returns the interval as a list of two int.
+    """
+    return [int(float(interval.split(",")[0].replace('[',''))),
+            int(float(interval.split(",")[1].replace(']','')))]
+###############################################################################
+
+
+
+###############################################################################
+def read_processed_csv(path, mode='float32'):
+    """
+    path: (str) path of the processed csv
+    mode: (str) storage mode of the channels
+    Returns the Study saved by write_processed_csv.
+    """
+
+    dtype = np.float64 if mode == 'float64' else np.float32
+    dtypes = {name: dtype for name in IMPEDENCE_COLUMNS[1:]+PH_COLUMNS[1:]}
+    dtypes.update({IMPEDENCE_COLUMNS[0]: np.float64,
+                                               PH_COLUMNS[0]: np.float64})
+
+    impedence_df_merged = pd.read_csv(path, dtype=dtypes, low_memory=False)
+
+    # Split the dataframe
+    impedence_df = impedence_df_merged[IMPEDENCE_COLUMNS].dropna(
+                                                subset=[IMPEDENCE_COLUMNS[0]])
+    impedence = ChannelStore(impedence_df[IMPEDENCE_COLUMNS[0]].to_numpy(),
+                    impedence_df[IMPEDENCE_COLUMNS[1:]].to_numpy().T,
+                                                  IMPEDENCE_COLUMNS[1:], mode)
+    del impedence_df
+
+    df_ph = impedence_df_merged[PH_COLUMNS].dropna()
+    ph = ChannelStore(df_ph[PH_COLUMNS[0]].to_numpy(),
+                         df_ph[PH_COLUMNS[1:]].to_numpy().T, PH_COLUMNS[1:],
+                                                                         mode)
+    del df_ph
+
+    study = Study(impedence, ph, path=path)
+    study.category, study.x_values, study.color_category = \
+                                         labels_from_dataframe(impedence_df_merged)
+
+    if DIARY_COLUMNS[0] in impedence_df_merged.keys():
+        study.diary = diary_from_columns(impedence_df_merged)
+
+    if QUALITY_COLUMNS[0] in impedence_df_merged.keys():
+        study.quality = quality_from_columns(impedence_df_merged)
+
+    return study
+###############################################################################
+
+
+
+###############################################################################
+def labels_from_dataframe(impedence_df_merged):
+    """
+    impedence_df_merged: (DataFrame) content of the processed csv
+    Returns the category, x_values and color_category lists of the labels.
+    """
+
+    if 'labels' not in impedence_df_merged.keys():
+        return [], [], []
+
+    # Import the labelling parameters
+    labelling_df = impedence_df_merged[['labels','intervals','color_label']]
+    labelling_df = labelling_df.dropna()
+
+    return (labelling_df['labels'].to_list(),
+            [parse_interval(i) for i in labelling_df['intervals'].to_list()],
+            labelling_df['color_label'].to_list())
+###############################################################################
+
+
+
+###############################################################################
+def read_processed_labels(path):
+    """
+    path: (str) path of the processed csv
+    Returns the category, x_values and color_category lists of the labels,
+    reading only the label columns.
+    """
+
+    impedence_df_merged = pd.read_csv(path, low_memory=False,
+                          usecols=lambda column: column in LABEL_COLUMNS)
+    return labels_from_dataframe(impedence_df_merged)
+###############################################################################
+
+
+
+###############################################################################
+def write_processed_csv(path, study):
+    """
+    path: (str) path of the csv to write
+    study: (Study) signals and labels to save
+    Saves the signals and the labels in the processed csv format.
+    """
+
+    # Define the dataframe list of signals and etiquettes:
+    labelling_df = pd.DataFrame()
+    labelling_df['labels'] = study.category
+    labelling_df['color_label'] = study.color_category
+    labelling_df['intervals'] = study.x_values
+
+    # Diary of the events
+    diary_df = pd.DataFrame(study.diary.to_columns() if study.diary is not None
+                                                                      else {})
+
+    # Problems found by the data-quality scan
+    quality_df = pd.DataFrame(study.quality.to_columns()
+                              if study.quality is not None else {})
+
+    impedence_df_merged = pd.concat([
+                        study.impedence.to_dataframe(IMPEDENCE_COLUMNS[0]),
+                        study.ph.to_dataframe(PH_COLUMNS[0]), labelling_df,
+                                               diary_df, quality_df], axis=1)
+    impedence_df_merged.to_csv(path, index = False)
+###############################################################################
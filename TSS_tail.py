@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live tailing of the recordings of the Time Series Scribe.
+A raw Digitrapper export (.txt) or a processed csv that is still being
+written is followed: each poll reads only the bytes appended since the
+previous one, parses the complete lines and appends them to growable
+channel stores, so that the cost of a poll depends only on the new data.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from TSS_storage import (IMPEDENCE_COLUMNS, PH_COLUMNS, ChannelStore, Study,
+                                                      labels_from_dataframe)
+from TSS_diary import (DIARY_COLUMNS, DiaryTable, parse_diary_lines,
+                                                       diary_from_columns)
+
+
+
+#%% Parameters
+# Sections of the raw export: marker -> (store, columns of the section)
+RAW_SECTIONS = {'Ph Array': ('ph', 2), 'Impedance Array': ('impedence', 6),
+                'Diary': ('diary', None)}
+HEADER_LINES = 3                    # Header lines after each section marker
+POLL_MS = 1000                      # Default polling interval of the GUI
+TAIL_CONTEXT_MS = 120000            # Samples before the new ones rescanned
+
+
+
+#%% Tailer
+class StudyTailer():
+
+    ###########################################################################
+    def __init__(self, path, mode='float32'):
+        '''
+        path: (str) raw .txt export or processed csv being written
+        mode: (str) storage mode of the channels
+        '''
+
+        self.path = path
+        self.mode = mode
+        self.raw = path.lower().endswith('.txt')
+        self.dtype = np.float64 if mode == 'float64' else np.float32
+
+        self.offset = 0                     # Bytes already read
+        self.pending = b''                  # Incomplete last line
+        self.section = None                 # Current section (raw export)
+        self.skip = 0                       # Header lines still to skip
+        self.header = None                  # Header line (processed csv)
+
+        self.stores = {'impedence': None, 'ph': None}
+        self.category, self.x_values, self.color_category = [], [], []
+        self.diary = None
+        self.study = None
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def poll(self):
+        """
+        Reads and parses the bytes appended to the file since the previous
+        poll. Returns a dictionary store -> time of the appended samples.
+        """
+
+        with open(self.path, 'rb') as opener:
+            opener.seek(self.offset)
+            data = opener.read()
+        self.offset = self.offset + len(data)
+
+        # Only complete lines are parsed, the rest waits for the next poll
+        data = self.pending + data
+        end = data.rfind(b'\n') + 1
+        self.pending = data[end:]
+        lines = data[:end].decode('latin-1').splitlines()
+
+        appended = self.parse_raw(lines) if self.raw else \
+                                                      self.parse_processed(lines)
+
+        if self.study is None and all(s is not None and len(s) > 0
+                                                for s in self.stores.values()):
+            self.study = Study(self.stores['impedence'], self.stores['ph'],
+                               self.category, self.x_values,
+                                  self.color_category, self.path, self.diary)
+            # The study shares the (growing) label lists of the tailer
+            self.study.category = self.category
+            self.study.x_values = self.x_values
+            self.study.color_category = self.color_category
+        elif self.study is not None:
+            self.study.diary = self.diary
+
+        return appended
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def size_changed(self):
+        """
+        True if the file holds bytes not read yet.
+        """
+        return os.path.getsize(self.path) > self.offset
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def extend(self, name, time, values, names):
+        """
+        Appends the parsed samples to the store name (created by the first
+        samples, so that the int16 scale is fitted on real data).
+        """
+
+        if len(time) == 0:
+            return
+        if self.stores[name] is None:
+            self.stores[name] = ChannelStore(time, values, names, self.mode)
+        else:
+            self.stores[name].append(time, values)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def extend_diary(self, diary):
+        """
+        Merges the new diary events in the diary table.
+        """
+
+        if len(diary) == 0 and self.diary is not None:
+            return
+        if self.diary is None:
+            self.diary = diary
+        else:
+            self.diary = DiaryTable(np.concatenate([self.diary.time,
+                                                               diary.time]),
+                                    self.diary.kind + diary.kind,
+                                    np.concatenate([self.diary.text,
+                                                               diary.text]))
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def parse_raw(self, lines):
+        """
+        lines: (list) new complete lines of the raw export
+        Routes the lines to the section they belong to and parses the data
+        lines of each section in a single batch.
+        """
+
+        batches = []                        # (section, lines) in file order
+        for line in lines:
+            marker = line.strip()
+            if marker in RAW_SECTIONS:
+                self.section = marker
+                self.skip = HEADER_LINES if RAW_SECTIONS[marker][1] else 0
+                batches.append((marker, []))
+            elif self.skip > 0:
+                self.skip = self.skip - 1
+            elif self.section is not None:
+                if not batches or batches[-1][0] != self.section:
+                    batches.append((self.section, []))
+                batches[-1][1].append(line)
+
+        appended = {}
+        for section, batch in batches:
+            name, n_columns = RAW_SECTIONS[section]
+
+            if name == 'diary':
+                t_start = self.stores['impedence'].time.min() \
+                        if self.stores['impedence'] is not None else None
+                self.extend_diary(parse_diary_lines(batch, t_start))
+                continue
+
+            time, values = parse_table_lines(batch, n_columns, self.dtype)
+            if name == 'impedence':
+                # The sixth channel replicates the fifth column as in the
+                # original parser of the export
+                values = np.concatenate([values, values[4:5]])
+                self.extend(name, time, values, IMPEDENCE_COLUMNS[1:])
+            else:
+                self.extend(name, time, values, PH_COLUMNS[1:])
+            appended[name] = np.concatenate([appended.get(name,
+                                         np.empty(0, dtype=np.int64)), time])
+
+        return appended
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def parse_processed(self, lines):
+        """
+        lines: (list) new complete lines of the processed csv
+        Parses the new rows in a single batch (signals, labels and diary).
+        """
+
+        if self.header is None:
+            if not lines:
+                return {}
+            self.header, lines = lines[0], lines[1:]
+        if not lines:
+            return {}
+
+        df = pd.read_csv(io.StringIO('\n'.join([self.header] + lines)),
+                                                             low_memory=False)
+        appended = {}
+
+        for name, columns in (('impedence', IMPEDENCE_COLUMNS),
+                                                     ('ph', PH_COLUMNS)):
+            rows = df[columns].dropna(subset=[columns[0]])
+            time = rows[columns[0]].to_numpy(dtype=np.float64
+                                                          ).astype(np.int64)
+            self.extend(name, time, rows[columns[1:]].to_numpy(
+                                        dtype=self.dtype).T, columns[1:])
+            appended[name] = time
+
+        category, x_values, color_category = labels_from_dataframe(df)
+        self.category.extend(category)
+        self.x_values.extend(x_values)
+        self.color_category.extend(color_category)
+
+        if DIARY_COLUMNS[0] in df.keys():
+            self.extend_diary(diary_from_columns(df))
+
+        return appended
+    ###########################################################################
+
+
+
+#%% Aux functions
+###############################################################################
+def tail_study(study, t_start):
+    """
+    study: (Study) followed study
+    t_start: (float) first time of the tail (ms)
+    Returns a Study with a copy of the samples of the signals from t_start
+    on (analyses of the new samples, without the whole recording).
+    """
+
+    stores = []
+    for store in (study.impedence, study.ph):
+        i0, n = int(store.time.searchsorted(t_start)), len(store)
+        stores.append(ChannelStore(store.time[i0:n], store.block(i0, n),
+                                                               store.names))
+    return Study(stores[0], stores[1])
+###############################################################################
+
+
+
+###############################################################################
+def parse_table_lines(lines, n_columns, dtype=np.float32):
+    """
+    lines: (list) tab separated lines of a section
+    n_columns: (int) number of columns to read (time + values)
+    dtype: (numpy dtype) dtype of the parsed values
+    Returns the int64 time and the values (n_columns-1, n) of the lines that
+    hold data (the blank and text lines are skipped).
+    """
+
+    data = [line for line in lines if line[:1].isdigit() or
+                                                      line[:1] == '-']
+    if not data:
+        return (np.empty(0, dtype=np.int64),
+                np.empty((n_columns-1, 0), dtype=dtype))
+
+    dtypes = {0: np.int64}
+    dtypes.update({c: dtype for c in range(1, n_columns)})
+    table = pd.read_csv(io.StringIO('\n'.join(data)), sep='\t', header=None,
+                        usecols=list(range(n_columns)), dtype=dtypes,
+                                                                  engine='c')
+    return table[0].to_numpy(), table.iloc[:, 1:].to_numpy().T
+###############################################################################
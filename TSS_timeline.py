@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Unified timeline index of the Time Series Scribe.
+The pH and the impedance channels are sampled with different time bases. The
+timeline maps any time range to the index ranges of every time base at once,
+keeps the (common) bounds of the recording, and resamples on demand one time
+base onto another one.
+
+Giulio Del Corso and Simon Kanka
+01-02-2025
+"""
+
+
+
+#%% Libraries
+from collections import OrderedDict
+
+import numpy as np
+
+
+
+#%% Timeline index
+class TimelineIndex():
+
+    ###########################################################################
+    def __init__(self, stores, max_resampled=8):
+        '''
+        stores: (dict) name -> channel store (with its time base)
+        max_resampled: (int) number of resampled slices kept in memory
+        '''
+
+        self.stores = dict(stores)
+        self.names = list(self.stores)
+
+        # Bounds of each time base, computed once
+        self.bounds_dict = {name: (store.time.min(), store.time.max())
+                                       for name, store in self.stores.items()}
+
+        # Common bounds: interval covered by all the time bases
+        self.common = (max(b[0] for b in self.bounds_dict.values()),
+                       min(b[1] for b in self.bounds_dict.values()))
+
+        self.max_resampled = max_resampled
+        self.resampled = OrderedDict()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def extend(self, name, time):
+        """
+        name: (str) time base that has grown
+        time: (array) time values appended to the time base
+        Updates the bounds with the appended values only.
+        """
+
+        if len(time) == 0:
+            return
+
+        t_min, t_max = self.bounds_dict[name]
+        self.bounds_dict[name] = (min(t_min, int(np.min(time))),
+                                  max(t_max, int(np.max(time))))
+        self.common = (max(b[0] for b in self.bounds_dict.values()),
+                       min(b[1] for b in self.bounds_dict.values()))
+        self.resampled.clear()
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def bounds(self, name=None):
+        """
+        name: (str) time base, None for the whole recording
+        Returns the (minimum, maximum) time of the time base.
+        """
+
+        if name is not None:
+            return self.bounds_dict[name]
+
+        return (min(b[0] for b in self.bounds_dict.values()),
+                max(b[1] for b in self.bounds_dict.values()))
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def common_bounds(self):
+        """
+        Returns the (minimum, maximum) time covered by all the time bases.
+        """
+        return self.common
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def range(self, name, t_min, t_max):
+        """
+        name: (str) time base
+        t_min: (int) minimum time of the interval
+        t_max: (int) maximum time of the interval
+        Returns the slice (i0, i1) of the samples in the interval. As the
+        original bisection, the slice starts from the last sample before
+        t_min and stops before the first sample after t_max.
+        """
+
+        time = self.stores[name].time
+        n = len(time)
+
+        i0 = max(int(time.searchsorted(t_min, side='left')) - 1, 0)
+        i1 = min(max(int(time.searchsorted(t_max, side='left')), i0+1), n)
+        return i0, i1
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def ranges(self, t_min, t_max):
+        """
+        Returns a dictionary name -> (i0, i1) with the slices of all the time
+        bases in the interval [t_min, t_max].
+        """
+        return {name: self.range(name, t_min, t_max) for name in self.names}
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def window_bounds(self, ranges):
+        """
+        ranges: (dict) slices returned by ranges()
+        Returns the (minimum, maximum) time shown by all the slices, i.e. the
+        extent where every time base has samples.
+        """
+
+        first = [self.stores[name].time[i0] for name, (i0, i1) in
+                                                  ranges.items() if i1 > i0]
+        last = [self.stores[name].time[i1-1] for name, (i0, i1) in
+                                                  ranges.items() if i1 > i0]
+        return max(first), min(last)
+    ###########################################################################
+
+
+
+    ###########################################################################
+    def resample(self, source, k, target, i0=0, i1=None):
+        """
+        source: (str) time base of the resampled channel (e.g. 'ph')
+        k: (int) index of the channel in the source store
+        target: (str) time base of the output grid (e.g. 'impedence')
+        i0, i1: (int) slice of the target grid
+        Returns the channel k of source linearly interpolated on the samples
+        [i0, i1) of the target time base. The last slices are cached.
+        """
+
+        i0, i1, _ = slice(i0, i1).indices(len(self.stores[target].time))
+        key = (source, k, target, i0, i1)
+
+        if key in self.resampled:
+            self.resampled.move_to_end(key)
+            return self.resampled[key]
+
+        time_target = self.stores[target].time[i0:i1]
+        if len(time_target) == 0:
+            return np.empty(0, dtype=np.float32)
+
+        # Only the source samples around the target slice are needed
+        s0, s1 = self.range(source, time_target[0], time_target[-1])
+        s1 = min(s1+1, len(self.stores[source].time))
+
+        values = np.interp(time_target, self.stores[source].time[s0:s1],
+                     self.stores[source].channel(k, s0, s1)).astype(np.float32)
+
+        self.resampled[key] = values
+        if len(self.resampled) > self.max_resampled:
+            self.resampled.popitem(last=False)
+
+        return values
+    ###########################################################################